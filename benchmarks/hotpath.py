@@ -0,0 +1,174 @@
+"""Micro-benchmarks of the message and parsing hot path of netargparse.
+
+Every stage, that a message passes in nap mode, is timed in-process across
+small, medium and huge values and across argument counts:
+
+- detect: `Message.__init__` for json, xml and frames
+- json_to_dict, xml_to_dict, frame_to_dict: the received message into a dict
+- dict_to_argslist: `Message.dict_to_argslist`
+- split_args: the split loop of `NetArgumentParser.__call__`
+- parse_args: `parser.parse_args`
+- json_format, xml_format: the response with autoformat
+- call, call_raw: the whole pipeline of a json message without the network,
+  `NetArgumentParser.call` and `NetArgumentParser.call_raw`
+
+Usage:
+    python benchmarks/hotpath.py                  # print the results
+    python benchmarks/hotpath.py --save           # and store them in benchmarks/results/<commit>.json
+    python benchmarks/hotpath.py --compare A.json [B.json]
+                                                  # compare two stored results (B: run now)
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import typing as t
+
+from netargparse import NetArgumentParser
+from netargparse.message import Message, MessageFrame, MessageJson, MessageXml
+
+SIZES = {"small": 8, "medium": 1024, "huge": 256 * 1024}
+COUNTS = (1, 10, 100)
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def cases() -> t.Iterator[t.Tuple[str, int, int]]:
+    """Yield the name, value size and argument count of every case."""
+    for size_name, size in SIZES.items():
+        for count in COUNTS:
+            if size * count > 4 * 1024 * 1024:
+                continue  # would only measure the memory bandwidth
+            yield f"{size_name}_{count}", size, count
+
+
+def stages(size: int, count: int) -> t.Dict[str, t.Callable[[], t.Any]]:
+    """Return the stages of the hot path prepared for one case."""
+    d = {f"--a{i}": "x" * size for i in range(count)}
+    msg_json = json.dumps(d).encode("utf-8")
+    msg_xml = ("<nap>" + "".join(f"<__a{i}>{'x' * size}</__a{i}>" for i in range(count)) + "</nap>").encode("utf-8")
+    msg_frame = MessageFrame.pack(d)
+    argslist = Message.dict_to_argslist(d)
+    split = NetArgumentParser.split_args(argslist)
+    resp = {f"r{i}": "x" * size for i in range(count)}
+
+    nap = NetArgumentParser()
+    for i in range(count):
+        nap.add_argument(f"--a{i}", type=str)
+    frame = MessageFrame()
+    json_meth = MessageJson()
+    xml_meth = MessageXml()
+    echo = lambda args: resp  # noqa: E731 - only the overhead around the function is timed
+
+    return {
+        "detect_json": lambda: Message(msg_json),
+        "detect_xml": lambda: Message(msg_xml),
+        "detect_frame": lambda: Message(msg_frame),
+        "json_to_dict": lambda: MessageJson._to_dict(msg_json),
+        "xml_to_dict": lambda: MessageXml._to_dict(msg_xml),
+        "frame_to_dict": lambda: frame._to_dict(msg_frame),
+        "dict_to_argslist": lambda: Message.dict_to_argslist(d),
+        "split_args": lambda: NetArgumentParser.split_args(argslist),
+        "parse_args": lambda: nap.parser.parse_args(split),
+        "json_format": lambda: json_meth._format(True, resp, ""),
+        "xml_format": lambda: xml_meth._format(True, resp, ""),
+        "call": lambda: nap.call(echo, d),
+        "call_raw": lambda: nap.call_raw(msg_json, echo),
+    }
+
+
+def measure(func: t.Callable[[], t.Any], repeat: int) -> float:
+    """Return the best time of one call in microseconds."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e6
+
+
+def commit() -> str:
+    """Return the short hash of the current commit, `+` when the tree is dirty."""
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                               text=True, check=True).stdout.strip()
+        return rev + ("+" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(repeat: int, only: t.Union[None, str]) -> dict:
+    """Time all stages of all cases."""
+    results = {}
+    for case, size, count in cases():
+        for stage, func in stages(size, count).items():
+            key = f"{stage}/{case}"
+            if only and only not in key:
+                continue
+            results[key] = measure(func, repeat)
+            print(f"{key:<32} {results[key]:>12.2f} us", flush=True)
+    return {"meta": {"commit": commit(), "python": sys.version.split()[0], "platform": platform.platform(),
+                     "date": time.strftime("%Y-%m-%d %H:%M:%S")},
+            "results": results}
+
+
+def compare(base: dict, head: dict, threshold: float) -> int:
+    """Print the ratio head/base of every key and return the number of regressions."""
+    print(f"{'':<32} {base['meta']['commit']:>12} {head['meta']['commit']:>12}   ratio")
+    regressions = 0
+    for key, old in base["results"].items():
+        if key not in head["results"]:
+            continue
+        new = head["results"][key]
+        ratio = new / old if old else 1.0
+        mark = ""
+        if ratio > 1 + threshold:
+            mark = "  slower"
+            regressions += 1
+        elif ratio < 1 - threshold:
+            mark = "  faster"
+        print(f"{key:<32} {old:>12.2f} {new:>12.2f}   {ratio:5.2f}{mark}")
+    return regressions
+
+
+def main() -> None:
+    """Run, store or compare the micro-benchmarks."""
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the message and parsing hot path.")
+    parser.add_argument("--repeat", type=int, default=5, help="Repetitions per stage, the best is kept. Default is 5.")
+    parser.add_argument("--only", type=str, default=None, help="Only run the stages/cases containing this text.")
+    parser.add_argument("--save", nargs="?", const="", default=None, metavar="FILE",
+                        help="Store the results as json. Default file is benchmarks/results/<commit>.json.")
+    parser.add_argument("--compare", nargs="+", default=None, metavar="FILE",
+                        help="Compare stored results with the second file or a new run.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Relative change, that is marked as slower/faster. Default is 0.1.")
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) > 2:
+        parser.error("--compare takes one or two files.")
+    if args.compare and len(args.compare) == 2:
+        head = None
+    else:
+        head = run(args.repeat, args.only)
+
+    if args.save is not None and head is not None:
+        path = args.save or os.path.join(RESULTS, f"{head['meta']['commit']}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(head, f, indent=2)
+        print(f"saved {path}")
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            base = json.load(f)
+        if head is None:
+            with open(args.compare[1]) as f:
+                head = json.load(f)
+        print()
+        sys.exit(1 if compare(base, head, args.threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Import-time benchmark of netargparse in main mode.
+
+A script, that is run as `main`, only needs argparse, so the modules of
+the nap and pipe mode must not be imported:
+
+- import: `python -X importtime`, the cumulative time of `netargparse`
+- main: the wall time of a script run as `main` in a fresh interpreter
+- python: the wall time of an empty interpreter as baseline
+
+The benchmark fails (exit code 1), when one of the lazy modules is imported
+in main mode, so it can guard the startup time in CI.
+
+Usage:
+    python benchmarks/importtime.py               # print the results
+    python benchmarks/importtime.py --runs 50     # more runs, the best is kept
+"""
+import argparse
+import subprocess
+import sys
+import time
+import typing as t
+
+# imported on the nap and pipe path only
+LAZY = ("netargparse.server", "netargparse.message", "netargparse.metrics", "netargparse.shm",
+        "http.server", "json", "xml.etree.ElementTree", "socket", "queue", "multiprocessing")
+
+SCRIPT = """
+import sys
+from netargparse import NetArgumentParser
+
+def main(args):
+    print(",".join(sorted(sys.modules)))
+
+nap = NetArgumentParser()
+nap.add_argument("-x", type=int)
+nap(main)
+"""
+
+
+def wall(cmd: t.List[str], runs: int) -> float:
+    """Return the best wall time of the command in milliseconds."""
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        best = min(best, time.perf_counter() - start)
+    return best * 1e3
+
+
+def import_time(runs: int) -> float:
+    """Return the best cumulative import time of netargparse in milliseconds from `-X importtime`."""
+    best = float("inf")
+    for _ in range(runs):
+        err = subprocess.run([sys.executable, "-X", "importtime", "-c", "from netargparse import NetArgumentParser"],
+                             check=True, capture_output=True, text=True).stderr
+        for line in err.splitlines():
+            fields = [field.strip() for field in line.split("|")]
+            if len(fields) == 3 and fields[2] == "netargparse":
+                best = min(best, int(fields[1]) / 1e3)
+    return best
+
+
+def main() -> None:
+    """Run the benchmark and check, that the lazy modules are not imported in main mode."""
+    parser = argparse.ArgumentParser(description="Import-time benchmark of netargparse in main mode.")
+    parser.add_argument("--runs", type=int, default=20, help="Runs per measurement, the best is kept. Default is 20.")
+    args = parser.parse_args()
+
+    modules = subprocess.run([sys.executable, "-c", SCRIPT, "main", "-x", "1"], check=True, capture_output=True,
+                             text=True).stdout.strip().split(",")
+    print(f"{'import':<8} {import_time(args.runs):>8.2f} ms")
+    print(f"{'main':<8} {wall([sys.executable, '-c', SCRIPT, 'main', '-x', '1'], args.runs):>8.2f} ms")
+    print(f"{'python':<8} {wall([sys.executable, '-c', 'pass'], args.runs):>8.2f} ms")
+
+    imported = [name for name in LAZY if name in modules]
+    if imported:
+        print(f"imported in main mode: {', '.join(imported)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
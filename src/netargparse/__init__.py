@@ -1 +1,14 @@
+import typing as t
+
 from .netargparse import NetArgumentParser
+
+if t.TYPE_CHECKING:
+    from .message import FileResponse
+
+
+def __getattr__(name: str) -> t.Any:
+    """Import `FileResponse` on first use, `message` pulls in json and xml, that the main mode does not need."""
+    if name == "FileResponse":
+        from .message import FileResponse
+        return FileResponse
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,18 @@
+import argparse
+
+from . import bench
+
+
+def main() -> None:
+    """Run the tools of netargparse, e.g. `python -m netargparse bench -p 7000`."""
+    parser = argparse.ArgumentParser(prog="python -m netargparse")
+    subparsers = parser.add_subparsers(dest="_cmd", required=True)
+    bench.add_arguments(subparsers.add_parser("bench", help="Measure throughput and latency of a script in nap mode."))
+
+    args = parser.parse_args()
+    if args._cmd == "bench":
+        bench.main(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import cProfile
+import io
+import marshal
+import pstats
+import time
+import tracemalloc
+import typing as t
+
+COMMANDS = ("profile", "tracemalloc")
+MAX_SECONDS = 300
+
+
+class Session:
+    """A time window, in which the main loop is profiled or the allocations are traced.
+
+    The session is opened by a control message with the meta field `nap_cmd`,
+    whose response is sent, when the window is over. In the meantime, the
+    script keeps answering the other requests.
+
+    - `profile`: `cProfile` runs around the main function and the rest of
+      the main loop for every request in the window. The result are the
+      `pstats` lines (`nap_format=text`) or the `pstats` dump as bytes
+      (`nap_format=pstats`), that can be loaded with `pstats.Stats`.
+    - `tracemalloc`: the allocations of all threads are traced and the top
+      allocation sites are reported.
+
+    Attributes
+    ----------
+    cmd : str
+        The command, `profile` or `tracemalloc`.
+    seconds : float
+        The length of the window.
+    deadline : float
+        The end of the window (`time.monotonic`).
+    sort : str
+        The sort key of the `pstats` lines, e.g. `cumulative` or `tottime`.
+    limit : int
+        The number of lines or allocation sites in the result.
+    fmt : str
+        `text` or `pstats` (only for `profile`).
+    send : Callable
+        Sends the response to the control message, see `server.detach`.
+    extra : dict
+        The extra fields of the envelope of the response, e.g. the `id`.
+
+    """
+
+    def __init__(self, meta: dict, send: t.Callable[..., None], extra: dict) -> None:
+        """Open the window.
+
+        Parameters
+        ----------
+        meta
+            The meta fields of the control message, `nap_cmd` and optionally
+            `nap_seconds`, `nap_sort`, `nap_limit` and `nap_format`.
+        send
+            Sends the response to the control message.
+        extra
+            The extra fields of the envelope of the response.
+
+        Raises
+        ------
+        Exception
+            When the command or a parameter is invalid.
+
+        """
+        self.cmd = meta["nap_cmd"]
+        if self.cmd not in COMMANDS:
+            raise Exception(f"Unknown `nap_cmd` `{self.cmd}`, must be one of {', '.join(COMMANDS)}.")
+        self.seconds = min(float(meta.get("nap_seconds", 10)), MAX_SECONDS)
+        self.sort = str(meta.get("nap_sort", "cumulative"))
+        self.limit = int(meta.get("nap_limit", 30))
+        self.fmt = str(meta.get("nap_format", "text"))
+        if self.fmt not in ("text", "pstats"):
+            raise Exception("`nap_format` must be `text` or `pstats`.")
+        self.send = send
+        self.extra = extra
+        self.deadline = time.monotonic() + self.seconds
+
+        self.profiler = None  # type: t.Union[None, cProfile.Profile]
+        self.tracing = False
+        if self.cmd == "profile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()  # fails now instead of in a request, if another profiler is active
+            self.profiler.disable()
+        else:
+            self.tracing = tracemalloc.is_tracing()  # must not be stopped, if it was started before
+            if not self.tracing:
+                tracemalloc.start(int(meta.get("nap_frames", 1)))
+
+    def enable(self) -> None:
+        """Start profiling the current request."""
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def disable(self) -> None:
+        """Stop profiling after the current request."""
+        if self.profiler is not None:
+            self.profiler.disable()
+
+    def expired(self) -> bool:
+        """Return whether the window is over."""
+        return time.monotonic() >= self.deadline
+
+    def finish(self) -> None:
+        """Close the window and send the result as response to the control message."""
+        exc = ""
+        try:
+            result = self.result()  # type: t.Union[dict, bytes]
+        except Exception as e:
+            result = ""  # type: ignore[assignment]
+            exc = str(e)
+        self.send(True, result, exc, self.extra)
+
+    def result(self) -> t.Union[dict, bytes]:
+        """Return the profile or the top allocation sites."""
+        if self.profiler is not None:
+            if self.fmt == "pstats":
+                self.profiler.create_stats()
+                return marshal.dumps(self.profiler.stats)
+            stream = io.StringIO()
+            stats = pstats.Stats(self.profiler, stream=stream)
+            stats.sort_stats(self.sort).print_stats(self.limit)
+            return {"seconds": self.seconds, "stats": stream.getvalue()}
+
+        snapshot = tracemalloc.take_snapshot()
+        if not self.tracing:
+            tracemalloc.stop()
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                           tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")])
+        top = snapshot.statistics("lineno")[:self.limit]
+        return {"seconds": self.seconds, "stats": "\n".join(str(stat) for stat in top)}
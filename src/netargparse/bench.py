@@ -0,0 +1,183 @@
+import argparse
+import json
+import threading
+import time
+import typing as t
+
+from .client import NapClient, OverloadError, RemoteError
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def percentile(latencies: t.Sequence[float], p: float) -> float:
+    """Return the percentile `p` of the sorted latencies (nearest rank)."""
+    if not latencies:
+        return 0.0
+    rank = max(1, -(-len(latencies) * p // 100))  # ceil without float rounding issues
+    return latencies[int(min(rank, len(latencies))) - 1]
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the arguments of the `bench` command."""
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("-p", "--port", type=int, help="Port of the script in nap mode.")
+    target.add_argument("-u", "--unix", type=str, metavar="PATH", help="Unix socket of the script in nap mode.")
+    parser.add_argument("-i", "--ip", type=str, default="127.0.0.1",
+                        help="IP address of the script in nap mode. Default is 127.0.0.1.")
+    parser.add_argument("--http", action="store_true", help="Use http get/post requests.")
+    parser.add_argument("--format", type=str, default="json", choices=["json", "xml", "frame"],
+                        help="Message format. Default is json.")
+    parser.add_argument("--args", type=json.loads, default={}, metavar="JSON",
+                        help='Arguments of every call as json, e.g. \'{"-x": "1"}\'.')
+    parser.add_argument("--payload-size", type=int, default=0, metavar="BYTES",
+                        help="Size of a payload, that is added to every call. Default is 0 (none).")
+    parser.add_argument("--payload-arg", type=str, default=None, metavar="NAME",
+                        help="Send the payload as this argument instead of as attachment (frames, http post).")
+    parser.add_argument("-c", "--concurrency", type=int, default=1,
+                        help="Number of concurrent connections. Default is 1.")
+    parser.add_argument("-r", "--rate", type=float, default=0, metavar="RPS",
+                        help="Open loop: start requests at this rate per second regardless of the "
+                             "responses. Default is 0: closed loop, every connection sends the next "
+                             "request after the response.")
+    limit = parser.add_mutually_exclusive_group()
+    limit.add_argument("-n", "--requests", type=int, default=None, help="Total number of requests.")
+    limit.add_argument("-d", "--duration", type=float, default=10, metavar="SECONDS",
+                       help="Duration of the benchmark. Default is 10.")
+    parser.add_argument("--warmup", type=int, default=0, help="Requests per connection, that are not measured.")
+    parser.add_argument("--timeout", type=float, default=10, help="Timeout of every request. Default is 10.")
+    parser.add_argument("-o", "--output", type=str, default=None, metavar="FILE",
+                        help="Write the results as json to this file.")
+
+
+def run(args: argparse.Namespace) -> dict:
+    """Drive the script in nap mode and measure throughput and latencies.
+
+    In the closed loop, every connection sends its next request right after
+    the response. In the open loop, request `i` is due at `start + i / rate`
+    and its latency is measured from that moment, so a slow server also
+    delays the following requests in the results (no coordinated omission).
+
+    Parameters
+    ----------
+    args
+        The parsed arguments of the `bench` command.
+
+    Returns
+    -------
+    The configuration, the counts, the throughput and the latencies in ms.
+
+    """
+    call_args = dict(args.args)
+    attachment = None
+    if args.payload_size:
+        if args.payload_arg:
+            call_args[args.payload_arg] = "x" * args.payload_size
+        else:
+            attachment = b"x" * args.payload_size
+
+    client = NapClient(args.ip, args.port, args.unix, args.http, args.format,
+                       pool_size=args.concurrency, timeout=args.timeout)
+    for _ in range(args.warmup * args.concurrency):
+        try:
+            client.call(call_args, attachment)
+        except Exception:
+            pass
+
+    lock = threading.Lock()
+    latencies = []  # type: t.List[float]
+    errors = {"remote": 0, "overload": 0, "connection": 0}
+    issued = 0
+
+    start = time.perf_counter()
+    stop = None if args.requests is not None else start + args.duration
+
+    def next_request() -> t.Union[None, int]:
+        """Return the index of the next request or None, when the benchmark is done."""
+        nonlocal issued
+        with lock:
+            if args.requests is not None and issued >= args.requests:
+                return None
+            if stop is not None and time.perf_counter() >= stop:
+                return None
+            issued += 1
+            return issued - 1
+
+    def worker() -> None:
+        """Send requests until the benchmark is done."""
+        while True:
+            i = next_request()
+            if i is None:
+                return
+            if args.rate:
+                due = start + i / args.rate
+                if stop is not None and due >= stop:
+                    return
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                due = time.perf_counter()
+            try:
+                client.call(call_args, attachment)
+                with lock:
+                    latencies.append(time.perf_counter() - due)
+            except OverloadError:
+                with lock:
+                    errors["overload"] += 1
+            except RemoteError:
+                with lock:
+                    errors["remote"] += 1
+            except Exception:
+                with lock:
+                    errors["connection"] += 1
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(args.concurrency)]
+    for thrd in threads:
+        thrd.start()
+    for thrd in threads:
+        thrd.join()
+    elapsed = time.perf_counter() - start
+    client.close()
+
+    latencies.sort()
+    ms = [lat * 1000 for lat in latencies]
+    return {
+        "config": {"target": args.unix or f"{args.ip}:{args.port}", "http": args.http, "format": args.format,
+                   "concurrency": args.concurrency, "rate": args.rate, "mode": "open" if args.rate else "closed",
+                   "payload_size": args.payload_size, "args": args.args},
+        "requests": len(latencies) + sum(errors.values()),
+        "ok": len(latencies),
+        "errors": errors,
+        "duration_s": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "min": ms[0] if ms else 0.0,
+            "mean": sum(ms) / len(ms) if ms else 0.0,
+            **{f"p{p:g}".replace(".", ""): percentile(ms, p) for p in PERCENTILES},
+            "max": ms[-1] if ms else 0.0,
+        },
+    }
+
+
+def report(results: dict) -> str:
+    """Format the results for the terminal."""
+    lat = results["latency_ms"]
+    lines = [
+        f"target      {results['config']['target']} ({results['config']['mode']} loop, "
+        f"concurrency {results['config']['concurrency']})",
+        f"requests    {results['requests']} ({results['ok']} ok, {results['errors']['remote']} remote errors, "
+        f"{results['errors']['overload']} rejected, {results['errors']['connection']} connection errors)",
+        f"duration    {results['duration_s']:.3f} s",
+        f"throughput  {results['throughput_rps']:.1f} req/s",
+        "latency ms  " + "  ".join(f"{key} {val:.3f}" for key, val in lat.items()),
+    ]
+    return "\n".join(lines)
+
+
+def main(args: argparse.Namespace) -> None:
+    """Run the benchmark, print the results and write them as json, if requested."""
+    results = run(args)
+    print(report(results))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
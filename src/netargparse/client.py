@@ -0,0 +1,682 @@
+import asyncio
+import http.client
+import itertools
+import json
+import socket
+import threading
+import typing as t
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, LifoQueue
+from xml.sax.saxutils import escape
+
+from .deadline import TIMEOUT
+from .health import OVERLOADED
+from .message import META_PREFIX, MessageFrame, MessageJson, sendall
+
+END_JSON = b', "finished": 1}'
+END_XML = b"<finished>1</finished></nap>"
+READ_LIMIT = 2 ** 26  # largest json or xml response of `AsyncNapClient`
+
+
+class RemoteError(Exception):
+    """The exception section of the response of the script in nap mode was not empty."""
+
+
+class OverloadError(RemoteError):
+    """The script in nap mode rejected the request, because it is overloaded, so it can be retried later."""
+
+
+class DeadlineError(RemoteError):
+    """The deadline of the request (`nap_timeout` or `--timeout`) passed in the script in nap mode."""
+
+
+class _SocketConnection:
+    """Persistent plain tcp or unix socket connection to the script in nap mode.
+
+    Attributes
+    ----------
+    sock : socket.socket
+        The connected socket.
+    buf : bytearray
+        The bytes, that were received, but not processed so far.
+
+    """
+
+    def __init__(self, sock: socket.socket) -> None:
+        """Initialize the connection with the connected socket."""
+        self.sock = sock
+        self.buf = bytearray()
+
+    def send(self, bufs: t.List[t.Union[bytes, bytearray, memoryview]]) -> None:
+        """Send the buffers of the messages one after another with as few system calls as possible."""
+        sendall(self.sock, bufs)
+
+    def recv_until(self, length: t.Callable[[bytearray], int]) -> bytes:
+        """Receive bytes until `length` returns the length of a complete message.
+
+        Raises
+        ------
+        ConnectionError
+            When the connection was closed before the message was complete.
+
+        """
+        while True:
+            n = length(self.buf)
+            if n:
+                msg = bytes(self.buf[:n])
+                del self.buf[:n]
+                return msg
+            recv = self.sock.recv(65536)
+            if not recv:
+                raise ConnectionError("Connection was closed by the script in nap mode.")
+            self.buf += recv
+
+    def close(self) -> None:
+        """Close the socket."""
+        self.sock.close()
+
+
+def _terminated(end: bytes) -> t.Callable[[bytearray], int]:
+    """Return a function, that determines the length of a response ending with `end`."""
+    def length(buf: bytearray) -> int:
+        i = buf.find(end)
+        return 0 if i == -1 else i + len(end)
+    return length
+
+
+def _xml_obj(element: ElementTree.Element) -> t.Any:
+    """Convert the element of a xml response into a str or (nested) dict."""
+    if len(element) == 0:
+        return element.text or ""
+    return {child.tag: _xml_obj(child) for child in element}
+
+
+def _arguments(args: t.Union[None, dict], kwargs: dict) -> dict:
+    """Merge the arguments and convert their values for `Message.dict_to_argslist`.
+
+    Keyword arguments with a single character become `-x` and longer ones
+    `--name`, where `_` becomes `-`, e.g. `max_size` becomes `--max-size`.
+    `True` becomes a switch and `False`/`None` are left out.
+    """
+    d = {}
+    for key, val in list((args or {}).items()) + [("-" * min(len(k), 2) + k.replace("_", "-"), v)
+                                                  for k, v in kwargs.items()]:
+        if key.startswith(META_PREFIX):
+            d[key] = val
+        elif val is True:
+            d[key] = ""
+        elif val is False or val is None:
+            continue
+        elif type(val) in (list, tuple):
+            d[key] = [str(v) for v in val]
+        else:
+            d[key] = str(val)  # e.g. 0 must not become a switch without value
+    return d
+
+
+def _xml(d: dict) -> bytes:
+    """Convert the arguments into a xml message."""
+    elements = []
+    for key, val in d.items():
+        tag = key if key.startswith(META_PREFIX) else "_" * (len(key) - len(key.lstrip("-"))) + key.lstrip("-")
+        if type(val) is dict:
+            val = json.dumps(val)
+        for v in (val if type(val) is list else [val]):
+            elements.append(f"<{tag}>{escape(str(v))}</{tag}>")
+    return ("<nap>" + "".join(elements) + "</nap>").encode("utf-8")
+
+
+def _encode(d: dict, attachment: t.Union[None, bytes, bytearray, memoryview], fmt: str,
+            accept_compressed: bool) -> t.List[t.Union[bytes, bytearray, memoryview]]:
+    """Convert the arguments into the buffers of a plain message or frame."""
+    if fmt == "frame":
+        flags = MessageFrame.ACCEPT_COMPRESSED if accept_compressed else 0
+        bufs = [MessageFrame.pack(d, attachment or b"", flags)]  # type: t.List[t.Union[bytes, bytearray, memoryview]]
+        if attachment:
+            bufs.append(attachment)
+        return bufs
+    if fmt == "xml":
+        return [_xml(d)]
+    return [json.dumps(d).encode("utf-8")]
+
+
+def _envelope(env: t.Union[dict, bytes]) -> dict:
+    """Convert the envelope of a json or xml response into a dict."""
+    if type(env) is dict:
+        return env
+    root = ElementTree.fromstring(t.cast(bytes, env))
+    d = {"response": _xml_obj(t.cast(ElementTree.Element, root.find("response"))),
+         "exception": root.findtext("exception") or ""}
+    if root.find("id") is not None:
+        d["id"] = root.findtext("id")
+    return d
+
+
+def _result(env: dict, att: bytes, fmt: str) -> t.Any:
+    """Return the response section or the attachment, or the remote exception."""
+    if env["exception"]:
+        if str(env["exception"]).startswith(OVERLOADED):
+            return OverloadError(env["exception"])
+        if str(env["exception"]).startswith(TIMEOUT):
+            return DeadlineError(env["exception"])
+        return RemoteError(env["exception"])
+    if att or (fmt == "frame" and env["response"] == ""):
+        return att
+    return env["response"]
+
+
+class NapClient:
+    """Client for a script in nap mode with a pool of persistent connections.
+
+    The connections are opened on demand, up to `pool_size`, and reused for
+    the following calls. The client is thread-safe, so several threads can
+    share one client.
+
+    Attributes
+    ----------
+    host : str
+        The ip address or host name of the script in nap mode.
+    port : None | int
+        The port of the script in nap mode.
+    unix : None | str
+        The path of the unix socket of the script in nap mode, instead of
+        `host` and `port`.
+    http : bool
+        Use http get/post requests instead of plain messages.
+    fmt : str
+        The message format: `json`, `xml` or `frame` (binary frames, not for http).
+    pool_size : int
+        The maximum number of connections.
+    timeout : None | float
+        The timeout in seconds for connecting, sending and receiving.
+    accept_compressed : bool
+        Ask the script for compressed responses (frames and http).
+    max_in_flight : int
+        The maximum number of requests, that `pipeline` sends before it
+        reads their responses, so the socket buffers do not fill up in both
+        directions, which would block the client and the script.
+
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: t.Union[None, int] = None,
+                 unix: t.Union[None, str] = None, http: bool = False, fmt: str = "json",
+                 pool_size: int = 4, timeout: t.Union[None, float] = None,
+                 accept_compressed: bool = False, max_in_flight: int = 32) -> None:
+        """Initialize the client without opening a connection.
+
+        Raises
+        ------
+        Exception
+            When the combination of the parameters is not supported.
+
+        """
+        if fmt not in ("json", "xml", "frame"):
+            raise Exception("`fmt` must be `json`, `xml` or `frame`.")
+        if http and (unix or fmt == "frame"):
+            raise Exception("http supports neither unix sockets nor frames.")
+        if port is None and unix is None:
+            raise Exception("Either `port` or `unix` must be given.")
+
+        self.host = host
+        self.port = port
+        self.unix = unix
+        self.http = http
+        self.fmt = fmt
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.accept_compressed = accept_compressed
+        self.max_in_flight = max(1, max_in_flight)
+
+        self._idle = LifoQueue()  # type: LifoQueue
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def __enter__(self) -> "NapClient":
+        """Use the client as context manager, that closes all connections at the end."""
+        return self
+
+    def __exit__(self, *args: t.Any) -> None:
+        """Close all connections."""
+        self.close()
+
+    def call(self, args: t.Union[None, dict] = None,
+             attachment: t.Union[None, bytes, bytearray, memoryview] = None,
+             **kwargs: t.Any) -> t.Any:
+        """Call the function of the script in nap mode.
+
+        Parameters
+        ----------
+        args
+            The arguments with their names as for the cli, e.g. `{"-x": 5}`,
+            and meta fields, e.g. `nap_shm`.
+        attachment
+            Binary attachment for frames or body of an http post request.
+        kwargs
+            Further arguments, where a single character becomes `-x` and a
+            longer name becomes `--name` with `-` instead of `_`.
+
+        Raises
+        ------
+        RemoteError
+            When the exception section of the response is not empty.
+
+        Returns
+        -------
+        The response section of the response or the binary attachment.
+
+        """
+        req = (_arguments(args, kwargs), attachment)
+        conn = self._acquire()
+        ok = False
+        try:
+            resp = self._txrx(conn, [req])[0]
+            ok = True
+        finally:
+            self._release(conn, ok)
+        ret = _result(_envelope(resp[0]), resp[1], self.fmt)
+        if isinstance(ret, RemoteError):
+            raise ret
+        return ret
+
+    def pipeline(self, calls: t.Sequence[t.Union[dict, t.Tuple[dict, t.Any]]]) -> list:
+        """Send several calls over one connection before reading the responses.
+
+        Plain messages are sent in groups of up to `max_in_flight`, so the
+        network round trips are saved. http requests are sent one after
+        another over the same connection.
+
+        Parameters
+        ----------
+        calls
+            The arguments of every call, as dict or as tuple of dict and attachment.
+
+        Returns
+        -------
+        The results in the order of the calls. A call, that failed in the
+        script, has a `RemoteError` instead of its result.
+
+        """
+        reqs = []
+        for c in calls:
+            args, attachment = c if type(c) is tuple else (c, None)
+            reqs.append((_arguments(t.cast(dict, args), {}), attachment))
+        conn = self._acquire()
+        ok = False
+        try:
+            resps = self._txrx(conn, reqs)
+            ok = True
+        finally:
+            self._release(conn, ok)
+        return [_result(_envelope(env), att, self.fmt) for env, att in resps]
+
+    def batch(self, calls: t.Sequence[t.Union[dict, t.Tuple[dict, t.Any]]]) -> list:
+        """Distribute several calls over the connections of the pool.
+
+        Every connection pipelines its share of the calls.
+
+        Parameters
+        ----------
+        calls
+            The arguments of every call, as dict or as tuple of dict and attachment.
+
+        Returns
+        -------
+        The results in the order of the calls. A call, that failed in the
+        script, has a `RemoteError` instead of its result.
+
+        """
+        n = max(1, min(self.pool_size, len(calls)))
+        shares = [calls[i::n] for i in range(n)]
+        with ThreadPoolExecutor(n) as executor:
+            results = list(executor.map(self.pipeline, shares))
+        ret = [None] * len(calls)  # type: list
+        for i, result in enumerate(results):
+            ret[i::n] = result
+        return ret
+
+    def close(self) -> None:
+        """Close all idle connections."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                return
+
+    def _acquire(self) -> t.Any:
+        """Take an idle connection from the pool or open a new one."""
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+        try:
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, conn: t.Any, ok: bool) -> None:
+        """Put the connection back into the pool or close it, if it is broken."""
+        if ok:
+            self._idle.put(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def _connect(self) -> t.Any:
+        """Open a new connection."""
+        if self.http:
+            return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        if self.unix is not None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.unix)
+        else:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # small messages are not delayed
+        return _SocketConnection(sock)
+
+    def _txrx(self, conn: t.Any, reqs: list) -> list:
+        """Send the requests and receive the responses in the same order.
+
+        At most `max_in_flight` requests are unanswered. When half of them
+        are answered, the next requests are sent in one go.
+        """
+        if self.http:
+            return [self._txrx_http(conn, *req) for req in reqs]
+
+        resps = []  # type: list
+        sent = 0
+        while len(resps) < len(reqs):
+            if sent < len(reqs) and sent - len(resps) <= self.max_in_flight // 2:
+                bufs = []  # type: t.List[t.Union[bytes, bytearray, memoryview]]
+                for d, attachment in reqs[sent:len(resps) + self.max_in_flight]:
+                    bufs.extend(_encode(d, attachment, self.fmt, self.accept_compressed))
+                conn.send(bufs)
+                sent = min(len(reqs), len(resps) + self.max_in_flight)
+            resps.append(self._recv(conn))
+        return resps
+
+    def _recv(self, conn: _SocketConnection) -> t.Tuple[t.Any, bytes]:
+        """Receive the next plain response or frame."""
+        if self.fmt == "frame":
+            header = conn.recv_until(lambda buf: MessageFrame.HEADER.size if len(buf) >= MessageFrame.HEADER.size else 0)
+            flags, env_len, att_len = MessageFrame._lengths(header)
+            env = conn.recv_until(lambda buf: env_len if len(buf) >= env_len else 0)
+            att = conn.recv_until(lambda buf: att_len if len(buf) >= att_len else 0) if att_len else b""
+            return MessageFrame.unpack(flags, env, att)
+        if self.fmt == "xml":
+            return conn.recv_until(_terminated(END_XML)), b""
+        return MessageJson._to_dict(conn.recv_until(_terminated(END_JSON))), b""
+
+    def _txrx_http(self, conn: http.client.HTTPConnection, d: dict,
+                   attachment: t.Union[None, bytes, bytearray, memoryview]) -> t.Tuple[t.Any, bytes]:
+        """Send one http request and receive its response."""
+        query = []
+        for key, val in d.items():
+            if type(val) is dict:
+                val = json.dumps(val)
+            for v in (val if type(val) is list else [val]):
+                query.append((key, v))
+        url = ("/xml" if self.fmt == "xml" else "/") + "?" + urllib.parse.urlencode(query, quote_via=urllib.parse.quote)
+        headers = {"Accept-Encoding": "gzip, deflate" if self.accept_compressed else "identity"}
+
+        if attachment is None:
+            conn.request("GET", url, headers=headers)
+        else:
+            headers["Content-Type"] = "application/octet-stream"
+            conn.request("POST", url, body=attachment, headers=headers)
+        r = conn.getresponse()
+        body = r.read()
+        if r.status not in (200, 503):  # 503: rejected, the body has the exception
+            raise Exception(f"http status {r.status} {r.reason}")
+
+        coding = r.getheader("Content-Encoding")
+        if coding == "gzip":
+            body = zlib.decompress(body, 47)
+        elif coding == "deflate":
+            body = zlib.decompress(body)
+        if r.getheader("Content-Type", "").startswith("application/json"):
+            return MessageJson._to_dict(body), b""
+        if r.getheader("Content-Type", "").startswith("application/xml"):
+            return body, b""
+        return {"response": "", "exception": ""}, body
+
+
+class _AsyncConnection:
+    """Connection of `AsyncNapClient`, that has several requests outstanding.
+
+    Attributes
+    ----------
+    reader : asyncio.StreamReader
+        The reading end of the connection.
+    writer : asyncio.StreamWriter
+        The writing end of the connection.
+    fmt : str
+        The message format: `json`, `xml` or `frame`.
+    pending : dict[str, asyncio.Future]
+        The futures of the outstanding requests with their `nap_id` as key,
+        in the order, in which the requests were sent.
+    in_flight : asyncio.Semaphore
+        Limit of the requests, that are outstanding at the same time. A slot
+        is given back, when the response arrives or the connection fails.
+    load : int
+        The number of calls, that use the connection or wait for it.
+    closed : bool
+        Whether the connection is broken or closed.
+
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 fmt: str, max_in_flight: int) -> None:
+        """Start reading the responses of the connection."""
+        self.reader = reader
+        self.writer = writer
+        self.fmt = fmt
+        self.pending = {}  # type: t.Dict[str, asyncio.Future]
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.load = 0
+        self.closed = False
+        self.task = asyncio.ensure_future(self.read_responses())
+
+    async def read_responses(self) -> None:
+        """Resolve the futures of the outstanding requests by the `id` of the responses.
+
+        A response without `id`, e.g. to a message, that the script could
+        not read, belongs to the oldest request, because the script answers
+        the messages of a connection in order. The requests, that timed out,
+        stay outstanding until their response arrives, which is dropped then.
+        """
+        try:
+            while True:
+                env, att = await self.read_response()
+                d = _envelope(env)
+                key = str(d["id"]) if "id" in d else next(iter(self.pending), "")
+                fut = self.pending.pop(key, None)
+                if fut is not None:
+                    self.in_flight.release()
+                    if not fut.done():
+                        fut.set_result((d, att))
+        except Exception as e:
+            self.fail(e)
+
+    async def read_response(self) -> t.Tuple[t.Any, bytes]:
+        """Read the next complete response."""
+        if self.fmt == "frame":
+            header = await self.reader.readexactly(MessageFrame.HEADER.size)
+            flags, env_len, att_len = MessageFrame._lengths(header)
+            env = await self.reader.readexactly(env_len)
+            att = await self.reader.readexactly(att_len) if att_len else b""
+            return MessageFrame.unpack(flags, env, att)
+        if self.fmt == "xml":
+            return await self.reader.readuntil(END_XML), b""
+        return MessageJson._to_dict(await self.reader.readuntil(END_JSON)), b""
+
+    def fail(self, exc: BaseException) -> None:
+        """Close the connection and fail all outstanding requests."""
+        self.closed = True
+        for fut in self.pending.values():
+            self.in_flight.release()
+            if not fut.done():
+                fut.set_exception(ConnectionError(f"Connection to the script in nap mode was lost: {exc!r}"))
+        self.pending.clear()
+        self.writer.close()
+
+
+class AsyncNapClient:
+    """asyncio client, that multiplexes many outstanding calls over few connections.
+
+    Every call gets a `nap_id`, which the script in nap mode echoes as `id`
+    in the envelope of the response, so the responses are matched to their
+    calls independently of their order. Calls are spread over up to
+    `connections` connections, and every connection has at most
+    `max_in_flight` outstanding requests, further calls wait (backpressure).
+    A request, that timed out, stays outstanding until its response arrives.
+    http is not supported, because an http/1.1 connection cannot have
+    several outstanding requests.
+
+    Attributes
+    ----------
+    host : str
+        The ip address or host name of the script in nap mode.
+    port : None | int
+        The port of the script in nap mode.
+    unix : None | str
+        The path of the unix socket of the script in nap mode, instead of
+        `host` and `port`.
+    fmt : str
+        The message format: `json`, `xml` or `frame` (binary frames).
+    connections : int
+        The maximum number of connections.
+    max_in_flight : int
+        The maximum number of outstanding requests per connection.
+    timeout : None | float
+        The timeout in seconds for connecting and for every call.
+    accept_compressed : bool
+        Ask the script for compressed frames.
+
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: t.Union[None, int] = None,
+                 unix: t.Union[None, str] = None, fmt: str = "json", connections: int = 2,
+                 max_in_flight: int = 64, timeout: t.Union[None, float] = None,
+                 accept_compressed: bool = False) -> None:
+        """Initialize the client without opening a connection.
+
+        Raises
+        ------
+        Exception
+            When the combination of the parameters is not supported.
+
+        """
+        if fmt not in ("json", "xml", "frame"):
+            raise Exception("`fmt` must be `json`, `xml` or `frame`.")
+        if port is None and unix is None:
+            raise Exception("Either `port` or `unix` must be given.")
+
+        self.host = host
+        self.port = port
+        self.unix = unix
+        self.fmt = fmt
+        self.connections = connections
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.accept_compressed = accept_compressed
+
+        self._conns = []  # type: t.List[_AsyncConnection]
+        self._lock = None  # type: t.Union[None, asyncio.Lock]
+        self._ids = itertools.count(1)
+
+    async def __aenter__(self) -> "AsyncNapClient":
+        """Use the client as async context manager, that closes all connections at the end."""
+        return self
+
+    async def __aexit__(self, *args: t.Any) -> None:
+        """Close all connections."""
+        await self.close()
+
+    async def call(self, args: t.Union[None, dict] = None,
+                   attachment: t.Union[None, bytes, bytearray, memoryview] = None,
+                   **kwargs: t.Any) -> t.Any:
+        """Call the function of the script in nap mode, e.g. within `asyncio.gather`.
+
+        Parameters
+        ----------
+        args
+            The arguments with their names as for the cli, e.g. `{"-x": 5}`,
+            and meta fields, e.g. `nap_shm`.
+        attachment
+            Binary attachment for frames.
+        kwargs
+            Further arguments, where a single character becomes `-x` and a
+            longer name becomes `--name` with `-` instead of `_`.
+
+        Raises
+        ------
+        RemoteError
+            When the exception section of the response is not empty.
+        asyncio.TimeoutError
+            When the response did not arrive or no request could be sent
+            within `timeout`.
+        ConnectionError
+            When the connection was lost before the response arrived.
+
+        Returns
+        -------
+        The response section of the response or the binary attachment.
+
+        """
+        d = _arguments(args, kwargs)
+        key = str(next(self._ids))
+        d["nap_id"] = int(key)
+
+        conn = await self._connection()
+        try:
+            await asyncio.wait_for(conn.in_flight.acquire(), self.timeout)
+            if conn.closed:
+                conn.in_flight.release()
+                raise ConnectionError("Connection to the script in nap mode was lost.")
+            fut = asyncio.get_running_loop().create_future()
+            conn.pending[key] = fut  # removed with its slot by its response, also after a timeout
+            for buf in _encode(d, attachment, self.fmt, self.accept_compressed):
+                conn.writer.write(buf)
+            await conn.writer.drain()
+            env, att = await asyncio.wait_for(fut, self.timeout)
+        finally:
+            conn.load -= 1
+
+        ret = _result(env, att, self.fmt)
+        if isinstance(ret, RemoteError):
+            raise ret
+        return ret
+
+    async def close(self) -> None:
+        """Close all connections."""
+        conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.task.cancel()
+            conn.fail(ConnectionError("closed"))
+            try:
+                await conn.writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _connection(self) -> _AsyncConnection:
+        """Choose the connection with the lowest load or open a new one."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()  # created within the running loop
+        async with self._lock:
+            self._conns = [conn for conn in self._conns if not conn.closed]
+            conn = min(self._conns, key=lambda c: c.load, default=None)
+            if conn is None or (conn.load and len(self._conns) < self.connections):
+                if self.unix is not None:
+                    opening = asyncio.open_unix_connection(self.unix, limit=READ_LIMIT)
+                else:
+                    opening = asyncio.open_connection(self.host, self.port, limit=READ_LIMIT)
+                reader, writer = await asyncio.wait_for(opening, self.timeout)
+                conn = _AsyncConnection(reader, writer, self.fmt, self.max_in_flight)
+                self._conns.append(conn)
+            conn.load += 1
+            return conn
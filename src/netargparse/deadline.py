@@ -0,0 +1,114 @@
+import threading
+import time
+import typing as t
+from threading import Thread
+
+TIMEOUT = "Timeout"  # start of the exception of a request, whose deadline passed
+
+
+class Watchdog:
+    """Answer the request of the main thread, when its deadline passed.
+
+    The main function runs in the main thread and cannot be killed. So when
+    the deadline passes, the daemon thread of the watchdog sends the timeout
+    as response instead, and the response of the main function is dropped,
+    when it finally returns. The client and the slot of the request are
+    freed right away, while the main thread is still busy. The main function
+    can check `args._deadline` to give up early.
+
+    Only one request is in the main function at a time, so one thread
+    watches all deadlines.
+
+    Attributes
+    ----------
+    cond : threading.Condition
+        Protects the armed deadline and wakes up the thread of the watchdog.
+    deadline : None | float
+        The deadline (`time.monotonic`) of the running request.
+    send : None | Callable
+        Sends the timeout as response to the running request.
+    fired : bool
+        Whether the watchdog already answered the running request.
+
+    """
+
+    def __init__(self) -> None:
+        """Start the daemon thread of the watchdog."""
+        self.cond = threading.Condition()
+        self.deadline = None  # type: t.Union[None, float]
+        self.send = None  # type: t.Union[None, t.Callable[[str], None]]
+        self.fired = False
+        Thread(target=self.watch, daemon=True).start()
+
+    def arm(self, deadline: float, send: t.Callable[[str], None]) -> None:
+        """Watch the deadline of the request, that is passed to the main function.
+
+        Parameters
+        ----------
+        deadline
+            The deadline (`time.monotonic`) of the request.
+        send
+            Sends the exception as response to the request.
+
+        """
+        with self.cond:
+            self.deadline = deadline
+            self.send = send
+            self.fired = False
+            self.cond.notify()
+
+    def disarm(self) -> bool:
+        """Stop watching after the main function returned.
+
+        Returns
+        -------
+        True: The response of the main function can be sent.
+        False: The watchdog already sent the timeout, the response is dropped.
+
+        """
+        with self.cond:
+            fired = self.fired
+            self.deadline = None
+            self.send = None
+            self.fired = False
+            self.cond.notify()
+        return not fired
+
+    def watch(self) -> None:
+        """Daemon thread, that sends the timeout, when the armed deadline passes."""
+        with self.cond:
+            while True:
+                if self.deadline is None or self.fired:
+                    self.cond.wait()
+                    continue
+                remaining = self.deadline - time.monotonic()
+                if remaining > 0:
+                    self.cond.wait(remaining)
+                    continue
+                self.fired = True  # sent while holding the lock, so the main thread waits for it in `disarm`
+                t.cast(t.Callable[[str], None], self.send)(
+                    f"{TIMEOUT}: the main function did not return within the deadline.")
+
+
+def deadline_of(stamp: float, meta: dict, default: float) -> t.Union[None, float]:
+    """Return the deadline of a request from `nap_timeout` and the default timeout.
+
+    Parameters
+    ----------
+    stamp
+        The time (`time.monotonic`), when the request was received.
+    meta
+        The meta fields of the request, optionally with `nap_timeout` in seconds.
+    default
+        The timeout of the script in seconds. 0: No timeout.
+
+    Returns
+    -------
+    None: The request has no deadline.
+    float: The deadline (`time.monotonic`), the shorter of both timeouts.
+
+    """
+    timeouts = [float(meta["nap_timeout"])] if "nap_timeout" in meta else []
+    if default:
+        timeouts.append(default)
+    return stamp + min(timeouts) if timeouts else None
@@ -0,0 +1,177 @@
+import json
+import threading
+import time
+import typing as t
+
+OVERLOADED = "Overloaded"  # start of the exception of a rejected request
+PATHS = ("/healthz", "/readyz")
+RETRY_AFTER = 1  # seconds in the `Retry-After` header of a rejected http request
+
+
+class Load:
+    """Count the requests, that wait for the main thread or are in flight.
+
+    The counters are updated by the threads of the connections and the main
+    thread and are read by the http threads for `/healthz` and `/readyz`, so
+    a health check never waits for the main function.
+
+    With limits, the load is also the admission control. A request over
+    `max_queue` or `max_in_flight` is rejected by the thread of its
+    connection, and a request, that waited longer than `max_queue_time`, is
+    rejected by the main thread without calling the main function. The
+    exception of a rejected request starts with `Overloaded`, and http
+    responds with 503 and `Retry-After`.
+
+    Attributes
+    ----------
+    queued : int
+        Requests, that were received, but not taken by the main thread yet.
+    in_flight : int
+        Requests, that were received, but not answered yet.
+    ready_queue : int
+        The queue depth, at which the script is not ready for more requests.
+    max_queue : int
+        The queue depth, at which requests are rejected. 0: No limit.
+    max_in_flight : int
+        The number of requests in flight, at which requests are rejected. 0: No limit.
+    max_queue_time : float
+        The seconds, that a request may wait for the main thread. 0: No limit.
+    started : bool
+        Whether the main thread waits for messages.
+    draining : bool
+        Whether the script stops after the requests in flight, see `restart.Restart`.
+    connecting : int
+        Connections, that were accepted, but did not send their first message yet.
+
+    """
+
+    def __init__(self, ready_queue: int = 16, max_queue: int = 0, max_in_flight: int = 0,
+                 max_queue_time: float = 0) -> None:
+        """Initialize the counters with 0.
+
+        Parameters
+        ----------
+        ready_queue
+            The queue depth, at which `/readyz` reports, that the script is
+            saturated.
+        max_queue
+            The queue depth, at which requests are rejected. 0: No limit.
+        max_in_flight
+            The number of requests in flight, at which requests are rejected.
+            0: No limit.
+        max_queue_time
+            The seconds, that a request may wait for the main thread. 0: No limit.
+
+        """
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+        self.ready_queue = ready_queue
+        self.max_queue = max_queue
+        self.max_in_flight = max_in_flight
+        self.max_queue_time = max_queue_time
+        self.started = False
+        self.draining = False
+        self.connecting = 0
+
+    def admit(self) -> t.Union[None, str]:
+        """Count a request, that is handed to the main thread, unless it is over a limit.
+
+        Returns
+        -------
+        None: The request was admitted.
+        str: The exception of the rejected request.
+
+        """
+        with self.lock:
+            if self.max_queue and self.queued >= self.max_queue:
+                return f"{OVERLOADED}: {self.queued} requests wait for the main thread."
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                return f"{OVERLOADED}: {self.in_flight} requests are in flight."
+            self.queued += 1
+            self.in_flight += 1
+        return None
+
+    @staticmethod
+    def stamp() -> float:
+        """Return the time, when a request was handed to the main thread, for `waited` and deadlines."""
+        return time.monotonic()
+
+    def waited(self, stamp: float) -> None:
+        """Reject the request, that was taken by the main thread, if it waited too long.
+
+        Parameters
+        ----------
+        stamp
+            The time from `stamp`, when the request was handed to the main thread.
+
+        Raises
+        ------
+        Exception
+            When the request waited longer than `max_queue_time`.
+
+        """
+        if self.max_queue_time:
+            waited = time.monotonic() - stamp
+            if waited > self.max_queue_time:
+                raise Exception(f"{OVERLOADED}: the request waited {waited:.3f} s for the main thread.")
+
+    def dequeued(self) -> None:
+        """Count a request, that was taken by the main thread."""
+        with self.lock:
+            self.queued -= 1
+
+    def answered(self) -> None:
+        """Count a request, whose response came back from the main thread."""
+        with self.lock:
+            self.in_flight -= 1
+
+    def accepted(self) -> None:
+        """Count a new connection, so a drain waits for its first message."""
+        with self.lock:
+            self.connecting += 1
+
+    def greeted(self) -> None:
+        """Count a new connection, that sent its first message or was closed."""
+        with self.lock:
+            self.connecting -= 1
+
+    def busy(self) -> bool:
+        """Return whether requests are in flight or new connections did not send their first message."""
+        return bool(self.in_flight or self.connecting)
+
+    def status(self) -> str:
+        """Return `starting`, `draining`, `saturated` or `ok`."""
+        if not self.started:
+            return "starting"
+        if self.draining:
+            return "draining"
+        if self.queued >= self.ready_queue or (self.max_queue and self.queued >= self.max_queue) or \
+                (self.max_in_flight and self.in_flight >= self.max_in_flight):
+            return "saturated"
+        return "ok"
+
+    def report(self, path: str) -> t.Tuple[int, bytes]:
+        """Return the http status and the json body of `/healthz` or `/readyz`.
+
+        `/healthz` is always 200, as long as the http thread answers.
+        `/readyz` is 503, while the main thread did not start, the script
+        drains, the queue is saturated or a limit is reached, so a load
+        balancer routes the requests elsewhere.
+
+        Parameters
+        ----------
+        path
+            `/healthz` or `/readyz`.
+
+        Returns
+        -------
+        The http status and the body, e.g.
+        `{"status": "ok", "queue_depth": 0, "in_flight": 1}`.
+
+        """
+        with self.lock:
+            status = self.status()
+            body = {"status": status, "queue_depth": self.queued, "in_flight": self.in_flight}
+        code = 200 if path == "/healthz" or status == "ok" else 503
+        return code, json.dumps(body).encode("utf-8")
@@ -0,0 +1,136 @@
+import time
+import typing as t
+
+# stage: (boundary at the start, boundary at the end)
+STAGES = {
+    "receive": ("recv", "received"),
+    "queue": ("received", "dequeued"),
+    "decode": ("dequeued", "decoded"),
+    "split": ("decoded", "split"),
+    "parse_args": ("split", "parsed"),
+    "func": ("parsed", "func"),
+    "resp_delay": ("func", "delayed"),
+    "format": ("delayed", "formatted"),
+    "send": ("formatted", "sent"),
+}
+
+
+class Record(dict):
+    """The timestamps of the boundaries of one request.
+
+    Attributes
+    ----------
+    instrument : Instrumentation
+        The instrumentation, that created the record.
+    error : bool
+        Whether the response has an exception.
+    bytes_in : int
+        The size of the received message.
+    bytes_out : int
+        The size of the sent response before compression.
+
+    """
+
+    __slots__ = ("instrument", "error", "bytes_in", "bytes_out")
+
+    def __init__(self, instrument: "Instrumentation") -> None:
+        """Create an empty record."""
+        super().__init__()
+        self.instrument = instrument
+        self.error = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def mark(self, boundary: str) -> None:
+        """Record the timestamp of the boundary."""
+        self.instrument.mark(self, boundary)
+
+    def sent(self) -> None:
+        """Record the last boundary and hand the record to `on_request`."""
+        self.instrument.mark(self, "sent")
+        self.instrument.on_request(self)
+
+
+class Instrumentation:
+    """Collect the timestamps of the stage boundaries of every request.
+
+    Every request has its own record, a dict with the name of the boundary
+    as key and `time.perf_counter_ns()` as value. The record is created by
+    the server, when the first bytes of the message arrive, travels with the
+    message to the main thread and back, and is handed to `on_request` after
+    the response was sent. Without instrumentation, no record is created.
+
+    The boundaries are `recv`, `received`, `dequeued`, `decoded`, `split`,
+    `parsed`, `func`, `delayed`, `formatted` and `sent`, see `STAGES` for the
+    stages in between. Boundaries of stages, that did not run, e.g. `func`
+    after an invalid argument, are missing.
+
+    Hooks are either given as callbacks or by overriding the methods in a
+    subclass. They are called in the thread, that reached the boundary, so
+    they must be thread-safe and fast.
+
+    Attributes
+    ----------
+    timing : bool
+        True: Every response has a `timing` section with the durations of the
+              stages until the response is formatted.
+        False: Only responses to requests with the meta field `nap_timing`.
+
+    """
+
+    def __init__(self, on_mark: t.Union[None, t.Callable[[str, int, dict], None]] = None,
+                 on_request: t.Union[None, t.Callable[[dict], None]] = None,
+                 timing: bool = False) -> None:
+        """Initialize the instrumentation with optional callbacks.
+
+        Parameters
+        ----------
+        on_mark
+            Called with the name of the boundary, its timestamp in ns and the
+            record at every boundary.
+        on_request
+            Called with the complete record after the response was sent.
+        timing
+            Add the `timing` section to every response.
+
+        """
+        self._on_mark = on_mark
+        self._on_request = on_request
+        self.timing = timing
+
+    def record(self) -> Record:
+        """Create the record of a new request."""
+        return Record(self)
+
+    def mark(self, rec: dict, boundary: str) -> None:
+        """Record the timestamp of the boundary and call `on_mark`."""
+        ns = time.perf_counter_ns()
+        rec[boundary] = ns
+        self.on_mark(boundary, ns, rec)
+
+    def on_mark(self, boundary: str, ns: int, rec: dict) -> None:
+        """Call the `on_mark` callback at every boundary (hook)."""
+        if self._on_mark is not None:
+            self._on_mark(boundary, ns, rec)
+
+    def on_request(self, rec: dict) -> None:
+        """Call the `on_request` callback after the response was sent (hook)."""
+        if self._on_request is not None:
+            self._on_request(rec)
+
+    @staticmethod
+    def durations(rec: dict) -> t.Dict[str, float]:
+        """Return the durations of the stages of the record in microseconds.
+
+        Parameters
+        ----------
+        rec
+            The record of the request.
+
+        Returns
+        -------
+        The duration of every stage, whose boundaries were both reached.
+
+        """
+        return {stage: (rec[end] - rec[start]) / 1000 for stage, (start, end) in STAGES.items()
+                if start in rec and end in rec}
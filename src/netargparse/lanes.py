@@ -0,0 +1,211 @@
+import threading
+import time
+import typing as t
+from collections import OrderedDict, deque
+
+from .health import OVERLOADED
+
+DEFAULT = "default"  # the lane of requests without a matching priority or function
+
+
+class Lane:
+    """The queue of one priority or function in front of the main thread.
+
+    Attributes
+    ----------
+    name : str
+        The priority (`nap_priority`) or function (`nap_func`), that uses the lane.
+    weight : int
+        The share of the main thread, while several lanes have waiting requests.
+    cap : int
+        The maximum number of requests of the lane in flight, 0: No limit.
+    items : collections.OrderedDict[str, collections.deque]
+        The waiting requests by client, in the order of the round robin.
+    current : int
+        The state of the smooth weighted round robin.
+    in_flight : int
+        The requests of the lane, that were admitted, but not answered yet.
+
+    """
+
+    __slots__ = ("name", "weight", "cap", "items", "current", "in_flight")
+
+    def __init__(self, name: str, weight: int = 1, cap: int = 0) -> None:
+        """Initialize the empty lane."""
+        if weight < 1 or cap < 0:
+            raise Exception(f"Lane `{name}` needs a weight >= 1 and a cap >= 0.")
+        self.name = name
+        self.weight = weight
+        self.cap = cap
+        self.items = OrderedDict()  # type: OrderedDict[str, deque]
+        self.current = 0
+        self.in_flight = 0
+
+    @classmethod
+    def parse(cls, spec: str) -> "Lane":
+        """Create the lane from `NAME:WEIGHT[:CAP]`, e.g. `interactive:8` or `batch:1:4`."""
+        parts = spec.split(":")
+        try:
+            if len(parts) not in (2, 3) or not parts[0]:
+                raise ValueError()
+            return cls(parts[0], int(parts[1]), int(parts[2]) if len(parts) == 3 else 0)
+        except ValueError:
+            raise Exception(f"Invalid lane `{spec}`, must be NAME:WEIGHT[:CAP].") from None
+
+
+class Scheduler:
+    """Queue of the requests for the main thread with one lane per priority or function.
+
+    The main thread takes the requests with a smooth weighted round robin
+    over the lanes with waiting requests, so a lane with weight 8 gets 8 of
+    9 turns against a lane with weight 1, while both have waiting requests,
+    and cheap requests do not wait behind a backlog of heavy ones. Within a
+    lane, the clients take turns and the requests of a client keep their
+    order, so a client with many connections cannot starve the others. A
+    lane with a cap rejects further requests, while `cap` of its requests
+    are in flight.
+
+    With a rate, every client has a token bucket with `burst` tokens, that
+    is refilled with `rate` tokens per second, and a request without a
+    token is rejected. The buckets are kept in the order of their last
+    request, so the full ones are dropped from the front and every decision
+    costs amortized O(1).
+
+    It replaces the queue `q_get` of the servers, which only holds one
+    request, so the requests wait in their lanes instead of in the threads
+    of their connections.
+
+    Attributes
+    ----------
+    lanes : dict[str, Lane]
+        The lanes by name, always with the lane `default`.
+    cond : threading.Condition
+        Protects the lanes and wakes up the main thread.
+    control : collections.deque
+        Items, that are taken before all lanes, e.g. the wakeup of the main thread.
+    waiting : int
+        The number of requests in all lanes.
+    rate : float
+        The requests per second of every client. 0: No limit.
+    burst : float
+        The size of the token bucket of every client.
+    buckets : collections.OrderedDict[str, tuple[float, float]]
+        The tokens and the time of the last request by client, the least
+        recently used first.
+
+    """
+
+    def __init__(self, lanes: t.Iterable[Lane] = (), rate: float = 0, burst: float = 0) -> None:
+        """Initialize the scheduler with the lanes and the lane `default`, if missing.
+
+        Parameters
+        ----------
+        lanes
+            The lanes of the priorities and functions.
+        rate
+            The requests per second of every client. 0: No limit.
+        burst
+            The requests of a client, that may arrive at once. 0: `rate`, at least 1.
+
+        """
+        self.lanes = {lane.name: lane for lane in lanes}
+        self.lanes.setdefault(DEFAULT, Lane(DEFAULT))
+        self.cond = threading.Condition()
+        self.control = deque()  # type: deque
+        self.waiting = 0
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.buckets = OrderedDict()  # type: OrderedDict[str, t.Tuple[float, float]]
+
+    def lane(self, meta: dict) -> str:
+        """Return the lane of a request from its meta fields `nap_priority` or `nap_func`."""
+        for key in ("nap_priority", "nap_func"):
+            name = meta.get(key)
+            if name in self.lanes:
+                return t.cast(str, name)
+        return DEFAULT
+
+    @staticmethod
+    def client(meta: dict, addr: t.Any) -> str:
+        """Return the client of a request, its API key `nap_key` or the host of its address."""
+        if "nap_key" in meta:
+            return f"key {meta['nap_key']}"
+        return str(addr[0]) if isinstance(addr, tuple) else str(addr)
+
+    def admit(self, name: str, client: str = "") -> t.Union[None, str]:
+        """Count a request of the lane in flight, unless the client or the lane is over its limit.
+
+        Returns
+        -------
+        None: The request was admitted.
+        str: The exception of the rejected request.
+
+        """
+        lane = self.lanes[name]
+        with self.cond:
+            if self.rate and not self.take(client):
+                return f"{OVERLOADED}: client `{client}` exceeds {self.rate:g} requests/s."
+            if lane.cap and lane.in_flight >= lane.cap:
+                return f"{OVERLOADED}: lane `{name}` has {lane.in_flight} requests in flight."
+            lane.in_flight += 1
+        return None
+
+    def take(self, client: str) -> bool:
+        """Take a token from the bucket of the client, while holding the lock."""
+        now = time.monotonic()
+        while self.buckets:  # drop the buckets, that are full again
+            tokens, last = next(iter(self.buckets.values()))
+            if tokens + (now - last) * self.rate < self.burst:
+                break
+            self.buckets.popitem(last=False)
+        bucket = self.buckets.pop(client, None)
+        tokens = self.burst if bucket is None else min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        if tokens >= 1:
+            self.buckets[client] = (tokens - 1, now)
+            return True
+        self.buckets[client] = (tokens, now)
+        return False
+
+    def answered(self, name: str) -> None:
+        """Count a request of the lane, that was answered."""
+        with self.cond:
+            self.lanes[name].in_flight -= 1
+
+    def put(self, item: t.Any, name: t.Union[None, str] = None, client: str = "") -> None:
+        """Add a request of the client to its lane, or a control item (`name` None) before all lanes."""
+        with self.cond:
+            if name is None:
+                self.control.append(item)
+            else:
+                items = self.lanes[name].items
+                if client not in items:
+                    items[client] = deque()
+                items[client].append(item)
+                self.waiting += 1
+            self.cond.notify()
+
+    def get(self) -> t.Any:
+        """Wait for the next request by the weighted round robin over the lanes."""
+        with self.cond:
+            while not self.control and not self.waiting:
+                self.cond.wait()
+            if self.control:
+                return self.control.popleft()
+            best = None  # type: t.Union[None, Lane]
+            total = 0
+            for lane in self.lanes.values():
+                if lane.items:
+                    lane.current += lane.weight
+                    total += lane.weight
+                    if best is None or lane.current > best.current:
+                        best = lane
+            best = t.cast(Lane, best)
+            best.current -= total
+            self.waiting -= 1
+            client, items = next(iter(best.items.items()))
+            item = items.popleft()
+            if items:
+                best.items.move_to_end(client)  # the next client of the lane takes its turn
+            else:
+                del best.items[client]
+            return item
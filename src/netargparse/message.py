@@ -1,7 +1,79 @@
 import json
+import os
+import re
+import struct
 import typing as t
 import warnings
 import xml.etree.ElementTree as ElementTree
+import zlib
+
+META_PREFIX = "nap_"
+BINARY = (bytes, bytearray, memoryview)
+IOV_MAX = 1024  # buffers per `sendmsg`, the limit of writev on linux and macos
+_BRACES = re.compile(rb"[{}]")
+
+
+class FileResponse:
+    """Return of the function `func` to respond with the content of a file.
+
+    The file is streamed to the client with `socket.sendfile`, so its content
+    neither passes through Python memory nor is embedded in a formatted
+    message. In a binary frame, the file is the attachment. With http, the
+    file is the body. In a json or xml message, the content is put "as is" in
+    the response section like with `autoformat=False`.
+
+    Attributes
+    ----------
+    path : str
+        The path of the file.
+    content_type : str
+        The content type of the http response.
+    remove : bool
+        Whether the file is removed after it was sent, e.g. for temporary files.
+    size : int
+        The size of the file in bytes, determined by `open`.
+
+    """
+
+    def __init__(self, path: t.Union[str, "os.PathLike[str]"],
+                 content_type: str = "application/octet-stream",
+                 remove: bool = False) -> None:
+        """Initialize the file response.
+
+        Parameters
+        ----------
+        path
+            The path of the file.
+        content_type
+            The content type of the http response.
+        remove
+            Whether the file is removed after it was sent.
+
+        """
+        self.path = os.fspath(path)
+        self.content_type = content_type
+        self.remove = remove
+        self.size = 0
+
+    def open(self) -> t.BinaryIO:
+        """Open the file for sending and determine its size."""
+        f = open(self.path, "rb")
+        self.size = os.fstat(f.fileno()).st_size
+        return f
+
+    def close(self, f: t.BinaryIO) -> None:
+        """Close the file after sending and remove it, if requested."""
+        f.close()
+        if self.remove:
+            os.remove(self.path)
+
+    def discard(self) -> None:
+        """Remove the file of a response, that is not sent, e.g. after a timeout, if requested."""
+        if self.remove:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
 
 
 class Message:
@@ -13,7 +85,7 @@ class Message:
 
     Attributes
     ----------
-    msg_meth : MessageXml | MessageJson
+    msg_meth : MessageXml | MessageJson | MessageFrame
         The message method, which `Message` should behave like.
 
     """
@@ -25,7 +97,7 @@ class Message:
         ----------
         msg
             Depending on the content of msg, either set `msg_meth`
-            to an instance of `MessageXml` or `MessageJson`
+            to an instance of `MessageXml`, `MessageJson` or `MessageFrame`.
 
         Raises
         ------
@@ -34,8 +106,10 @@ class Message:
             fullfill the needs for the xml or json message.
 
         """
-        if msg.strip().startswith(b"<nap>"):
-            self.msg_meth = MessageXml()  # type: t.Union[MessageXml, MessageJson]
+        if msg.startswith(MessageFrame.MAGIC):
+            self.msg_meth = MessageFrame()  # type: t.Union[MessageXml, MessageJson, MessageFrame]
+        elif msg.strip().startswith(b"<nap>"):
+            self.msg_meth = MessageXml()
         elif msg.strip().startswith(b"{"):
             self.msg_meth = MessageJson()
         else:
@@ -57,6 +131,55 @@ class Message:
         """
         return getattr(self.msg_meth, name)
 
+    @staticmethod
+    def split_meta(d: dict) -> t.Tuple[dict, dict]:
+        """Separate the meta fields of the message from the arguments.
+
+        Keys starting with `nap_` are no arguments for the main `parser`, but
+        tell NetArgumentParser how to handle the message, e.g. `nap_shm`.
+        Url parameters are always lists, so only the last value is kept.
+
+        ANNOTATION: DO NOT USE ARGUMENTS FOR THE MAIN PARSER THAT START WITH
+                    `nap_`, BECAUSE THEY WILL BE HANDLED AS META FIELDS.
+
+        Parameters
+        ----------
+        d
+            The message converted into a dict.
+
+        Returns
+        -------
+        The arguments for `dict_to_argslist` and the meta fields.
+
+        """
+        args = {}
+        meta = {}
+        for key, value in d.items():
+            if key.startswith(META_PREFIX):
+                meta[key] = value[-1] if type(value) is list else value
+            else:
+                args[key] = value
+        return args, meta
+
+    @staticmethod
+    def echo(meta: dict) -> dict:
+        """Return the fields, that are sent back in the envelope of the response.
+
+        A client, that has several requests outstanding on one connection,
+        sends `nap_id` and matches the responses by their `id`.
+
+        Parameters
+        ----------
+        meta
+            The meta fields of the received message.
+
+        Returns
+        -------
+        The extra fields of the envelope, e.g. `{"id": 7}`.
+
+        """
+        return {"id": meta["nap_id"]} if "nap_id" in meta else {}
+
     @staticmethod
     def dict_to_argslist(d: dict) -> list:
         """Convert the dict with the main `parser` arguments into a list.
@@ -220,7 +343,29 @@ class MessageXml:
         """
         return string.strip().endswith(b"</nap>")
 
-    def _format(self, autoformat: bool, resp: t.Union[dict, str], exc: str) -> bytes:
+    @staticmethod
+    def _msg_len(string: t.Union[bytes, bytearray]) -> int:
+        """Determine the length of the first complete message.
+
+        Unlike `_end_of_msg`, further messages may follow the first message,
+        e.g. when a client sends several messages without waiting for the
+        responses (pipelining).
+
+        Parameters
+        ----------
+        string
+            The messages, that were received by the client so far.
+
+        Returns
+        -------
+        The length of the first message or 0, if it is not complete.
+
+        """
+        end = string.find(b"</nap>")
+        return 0 if end == -1 else end + 6
+
+    def _format(self, autoformat: bool, resp: t.Union[dict, str], exc: str,
+                extra: t.Union[None, dict] = None) -> bytes:
         """Format the message to be sent to the client.
 
         Parameters
@@ -234,6 +379,8 @@ class MessageXml:
             The information that should be sent in the response section.
         exc
             The information that should be sent in the exception section.
+        extra
+            Further fields of the envelope before `finished`, see `Message.echo`.
 
         Returns
         -------
@@ -249,7 +396,30 @@ class MessageXml:
             except Exception as e1:
                 e = self._replace_breaking_chars(str(e1))
                 warnings.warn(str(e1))
-        return "<nap><response>{}</response><exception>{}</exception><finished>1</finished></nap>".format(r, e).encode("utf-8")
+        x = self._from_dict(extra) if extra else ""
+        return "<nap><response>{}</response><exception>{}</exception>{}<finished>1</finished></nap>".format(r, e, x).encode("utf-8")
+
+    def _envelope(self, exc: str, extra: t.Union[None, dict] = None) -> t.Tuple[bytes, bytes]:
+        """Return the message before and after the response section.
+
+        Used to stream a response, e.g. a file, into the message without
+        formatting it. The response is put in "as is" like with `autoformat=False`.
+
+        Parameters
+        ----------
+        exc
+            The information that should be sent in the exception section.
+        extra
+            Further fields of the envelope before `finished`, see `Message.echo`.
+
+        Returns
+        -------
+        The head and the tail of the message.
+
+        """
+        e = self._replace_breaking_chars(exc)
+        x = self._from_dict(extra) if extra else ""
+        return b"<nap><response>", "</response><exception>{}</exception>{}<finished>1</finished></nap>".format(e, x).encode("utf-8")
 
 
 class MessageJson:
@@ -320,7 +490,37 @@ class MessageJson:
         """
         return string.count(b"{") == string.count(b"}")
 
-    def _format(self, autoformat: bool, resp: t.Union[dict, str], exc: str) -> bytes:
+    @staticmethod
+    def _msg_len(string: t.Union[bytes, bytearray]) -> int:
+        """Determine the length of the first complete message.
+
+        Unlike `_end_of_msg`, further messages may follow the first message,
+        e.g. when a client sends several messages without waiting for the
+        responses (pipelining). The first message ends, when its first `{`
+        is closed.
+
+        ANNOTATION: DO NOT SEND STRING ARGUMENTS WITH INCOMPLETE
+                    CURLY PARENTHESES.
+
+        Parameters
+        ----------
+        string
+            The messages, that were received by the client so far.
+
+        Returns
+        -------
+        The length of the first message or 0, if it is not complete.
+
+        """
+        depth = 0
+        for m in _BRACES.finditer(string):
+            depth += 1 if m.group() == b"{" else -1
+            if depth == 0:
+                return m.end()
+        return 0
+
+    def _format(self, autoformat: bool, resp: t.Union[dict, str], exc: str,
+                extra: t.Union[None, dict] = None) -> bytes:
         """Format the message to be sent to the client.
 
         Parameters
@@ -334,6 +534,8 @@ class MessageJson:
             The information that should be sent in the response section.
         exc
             The information that should be sent in the exception section.
+        extra
+            Further fields of the envelope before `finished`, see `Message.echo`.
 
         Returns
         -------
@@ -349,4 +551,351 @@ class MessageJson:
             except Exception as e1:
                 e = self._replace_breaking_chars(str(e1))
                 warnings.warn(str(e1))
-        return '{{"response": {}, "exception": "{}", "finished": 1}}'.format(r, e).encode("utf-8")
+        x = ", " + json.dumps(extra)[1:-1] if extra else ""
+        return '{{"response": {}, "exception": "{}"{}, "finished": 1}}'.format(r, e, x).encode("utf-8")
+
+    def _envelope(self, exc: str, extra: t.Union[None, dict] = None) -> t.Tuple[bytes, bytes]:
+        """Return the message before and after the response section.
+
+        Used to stream a response, e.g. a file, into the message without
+        formatting it. The response is put in "as is" like with `autoformat=False`.
+
+        Parameters
+        ----------
+        exc
+            The information that should be sent in the exception section.
+        extra
+            Further fields of the envelope before `finished`, see `Message.echo`.
+
+        Returns
+        -------
+        The head and the tail of the message.
+
+        """
+        e = self._replace_breaking_chars(exc)
+        x = ", " + json.dumps(extra)[1:-1] if extra else ""
+        return b'{"response": ', ', "exception": "{}"{}, "finished": 1}}'.format(e, x).encode("utf-8")
+
+
+class MessageFrame:
+    """Handle length-prefixed frames with a json envelope and a binary attachment.
+
+    A frame starts with the header: `NAPF`, one byte for flags, the length of
+    the envelope (4 bytes) and the length of the attachment (8 bytes), all in
+    network byte order. The header is followed by the envelope, which is a
+    json message, and the raw bytes of the attachment. Binary arguments and
+    results are therefore neither encoded as text nor copied into the envelope.
+
+    Flags
+    -----
+    COMPRESSED
+        Envelope and attachment are each compressed with zlib. The lengths in
+        the header are the compressed lengths.
+    ACCEPT_COMPRESSED
+        The sender of the request accepts a compressed response.
+
+    Attributes
+    ----------
+    flags : int
+        The flags of the last received frame.
+    attachment : None | memoryview
+        The attachment of the last received frame.
+    max_size : int
+        The bytes of envelope and attachment of a received frame after the
+        decompression, so a small compressed frame cannot exceed the maximum
+        message size. 0: No limit.
+
+    """
+
+    MAGIC = b"NAPF"
+    HEADER = struct.Struct("!4sBIQ")
+    COMPRESSED = 0x01
+    ACCEPT_COMPRESSED = 0x02
+
+    def __init__(self) -> None:
+        """Initialize without an attachment."""
+        self.flags = 0
+        self.attachment = None  # type: t.Union[None, memoryview]
+        self.max_size = 0
+
+    @classmethod
+    def pack(cls, d: dict, attachment: t.Union[bytes, bytearray, memoryview] = b"",
+             flags: int = 0) -> bytes:
+        """Build the header and envelope of a frame, e.g. for a client.
+
+        The attachment itself is not part of the return and must be sent
+        right after it, so large attachments are not copied.
+
+        Parameters
+        ----------
+        d
+            The envelope, e.g. the arguments for the main `parser`.
+        attachment
+            The attachment, that is sent after the envelope.
+        flags
+            The flags of the frame, e.g. `ACCEPT_COMPRESSED`.
+
+        Returns
+        -------
+        Header and envelope of the frame.
+
+        """
+        env = json.dumps(d).encode("utf-8")
+        return cls._header(len(env), memoryview(attachment).nbytes, flags) + env
+
+    @classmethod
+    def unpack(cls, flags: int, env: bytes, attachment: bytes, max_size: int = 0) -> t.Tuple[dict, bytes]:
+        """Decode the envelope and attachment of a received frame, e.g. for a client.
+
+        Parameters
+        ----------
+        flags
+            The flags from the header of the frame.
+        env
+            The envelope of the frame.
+        attachment
+            The attachment of the frame.
+        max_size
+            The bytes of envelope and attachment after the decompression. 0: No limit.
+
+        Raises
+        ------
+        Exception
+            When the decompressed frame exceeds `max_size`.
+
+        Returns
+        -------
+        The envelope as dict and the attachment.
+
+        """
+        if flags & cls.COMPRESSED:
+            env = decompress(env, max_size)
+            attachment = decompress(attachment, max_size, len(env)) if attachment else attachment
+        return MessageJson._to_dict(env), attachment
+
+    @classmethod
+    def _header(cls, env_len: int, att_len: int, flags: int = 0) -> bytes:
+        """Return the header of the frame."""
+        return cls.HEADER.pack(cls.MAGIC, flags, env_len, att_len)
+
+    @classmethod
+    def _lengths(cls, data: t.Union[bytes, bytearray, memoryview]) -> t.Tuple[int, int, int]:
+        """Return the flags and the lengths of envelope and attachment from the header.
+
+        Raises
+        ------
+        Exception
+            When the frame does not start with `NAPF`.
+
+        """
+        magic, flags, env_len, att_len = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise Exception("Frame must start with `NAPF`.")
+        return flags, env_len, att_len
+
+    def _end_of_msg(self, string: t.Union[bytes, bytearray]) -> bool:
+        """Determine, if the received frame is complete.
+
+        Parameters
+        ----------
+        string
+            The frame, that was received by the client so far.
+
+        Returns
+        -------
+        Whether the frame is fully received.
+
+        """
+        return self._msg_len(string) > 0
+
+    def _msg_len(self, string: t.Union[bytes, bytearray]) -> int:
+        """Determine the length of the first complete frame.
+
+        Parameters
+        ----------
+        string
+            The frames, that were received by the client so far.
+
+        Returns
+        -------
+        The length of the first frame or 0, if it is not complete.
+
+        """
+        if len(string) < self.HEADER.size:
+            return 0
+        _, env_len, att_len = self._lengths(string)
+        length = self.HEADER.size + env_len + att_len
+        return length if len(string) >= length else 0
+
+    def _to_dict(self, frame: t.Union[bytes, bytearray]) -> dict:
+        """Convert the envelope of the frame into a dict and keep the attachment.
+
+        Parameters
+        ----------
+        frame
+            The complete frame.
+
+        Returns
+        -------
+        A dict with the keys of the json envelope and its values.
+
+        """
+        self.flags, env_len, att_len = self._lengths(frame)
+        view = memoryview(frame)
+        start = self.HEADER.size + env_len
+        env = view[self.HEADER.size:start]
+        self.attachment = view[start:start + att_len] if att_len else None
+        if self.flags & self.COMPRESSED:
+            env = memoryview(decompress(env, self.max_size))
+            if self.attachment is not None:
+                self.attachment = memoryview(decompress(self.attachment, self.max_size, env.nbytes))
+        return MessageJson._to_dict(env.tobytes())
+
+    def _frame(self, autoformat: bool, resp: t.Union[dict, str, bytes], exc: str,
+               level: int = 0, min_size: int = 0,
+               extra: t.Union[None, dict] = None) -> t.List[t.Union[bytes, bytearray, memoryview]]:
+        """Format the frame to be sent to the client.
+
+        When `resp` is binary, the response section is empty and `resp` is the
+        attachment. The frame is compressed, when `level` is not 0, the
+        received frame had the flag `ACCEPT_COMPRESSED` and envelope and
+        attachment have at least `min_size` bytes.
+
+        Parameters
+        ----------
+        autoformat
+            True: resp is converted into a json string, where the keys of the
+                  dict will be json keys and the values of the dict will be
+                  the json keys texts.
+            False: resp will be sent to the client "as is".
+        resp
+            The information that should be sent in the response section or
+            the binary attachment.
+        exc
+            The information that should be sent in the exception section.
+        level
+            The zlib compression level. 0: Never compress.
+        min_size
+            The minimum size in bytes of envelope and attachment to compress.
+        extra
+            Further fields of the envelope before `finished`, see `Message.echo`.
+
+        Returns
+        -------
+        The buffers, that are sent one after another: header and envelope and,
+        if there is one, the attachment, which is not copied.
+
+        """
+        att = None  # type: t.Union[None, bytes, bytearray, memoryview]
+        if isinstance(resp, BINARY):
+            att = resp
+            resp = ""
+        env = MessageJson()._format(autoformat, resp, exc, extra)
+        att_len = 0 if att is None else memoryview(att).nbytes
+
+        flags = 0
+        if level and self.flags & self.ACCEPT_COMPRESSED and len(env) + att_len >= min_size:
+            flags = self.COMPRESSED
+            env = zlib.compress(env, level)
+            if att is not None:
+                att = zlib.compress(att, level)
+                att_len = len(att)
+
+        msg = [self._header(len(env), att_len, flags) + env]  # type: t.List[t.Union[bytes, bytearray, memoryview]]
+        if att is not None:
+            msg.append(att)
+        return msg
+
+    def _format(self, autoformat: bool, resp: t.Union[dict, str, bytes, "FileResponse"],
+                exc: str, extra: t.Union[None, dict] = None) -> bytes:
+        """Format the header and envelope of the frame to be sent to the client.
+
+        When `resp` is binary or an opened `FileResponse`, the response section
+        is empty and `resp` is the attachment, which is NOT part of the return
+        and must be sent right after.
+
+        Parameters
+        ----------
+        autoformat
+            True: resp is converted into a json string, where the keys of the
+                  dict will be json keys and the values of the dict will be
+                  the json keys texts.
+            False: resp will be sent to the client "as is".
+        resp
+            The information that should be sent in the response section or
+            the binary attachment.
+        exc
+            The information that should be sent in the exception section.
+        extra
+            Further fields of the envelope before `finished`, see `Message.echo`.
+
+        Returns
+        -------
+        Header and envelope of the frame.
+
+        """
+        if isinstance(resp, FileResponse):
+            env = MessageJson()._format(autoformat, "", exc, extra)
+            return self._header(len(env), resp.size) + env
+        return bytes(self._frame(autoformat, resp, exc, extra=extra)[0])
+
+
+def decompress(data: t.Union[bytes, memoryview], max_size: int = 0, used: int = 0) -> bytes:
+    """Decompress zlib data without exceeding the limit of a frame, e.g. against zip bombs.
+
+    Parameters
+    ----------
+    data
+        The compressed envelope or attachment.
+    max_size
+        The bytes of the decompressed frame. 0: No limit.
+    used
+        The bytes of the frame, that were already decompressed.
+
+    Raises
+    ------
+    Exception
+        When the frame exceeds `max_size` or the data is incomplete.
+
+    """
+    if not max_size:
+        return zlib.decompress(data)
+    d = zlib.decompressobj()
+    out = d.decompress(data, max(max_size - used, 0) + 1)  # one byte more tells, that it exceeds
+    if used + len(out) > max_size:
+        raise Exception(f"Decompressed frame exceeds {max_size} bytes.")
+    if not d.eof:
+        raise Exception("Compressed frame is incomplete.")
+    return out
+
+
+def sendall(sock: t.Any, bufs: t.Sequence[t.Union[bytes, bytearray, memoryview]]) -> None:
+    """Send the buffers one after another with as few `sendmsg` (writev) calls as possible.
+
+    Unlike `sendall` for every buffer, the buffers are handed to the kernel
+    at once without joining them, so an attachment is not copied and small
+    messages leave in as few segments as possible. Without `sendmsg`
+    (windows), every buffer is sent with `sendall`.
+
+    Parameters
+    ----------
+    sock
+        The connected socket.
+    bufs
+        The buffers, e.g. header and envelope and the attachment of a frame.
+
+    """
+    if not hasattr(sock, "sendmsg"):
+        for buf in bufs:
+            sock.sendall(buf)
+        return
+    views = [view for view in (memoryview(buf).cast("B") for buf in bufs) if view.nbytes]
+    i = 0
+    while i < len(views):
+        sent = sock.sendmsg(views[i:i + IOV_MAX])
+        while sent:  # skip the sent buffers, a partly sent buffer keeps its rest
+            if sent < views[i].nbytes:
+                views[i] = views[i][sent:]
+                break
+            sent -= views[i].nbytes
+            i += 1
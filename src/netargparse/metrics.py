@@ -0,0 +1,261 @@
+import http.server
+import itertools
+import threading
+import typing as t
+from threading import Thread
+
+from .health import PATHS as HEALTH_PATHS
+from .health import Load
+from .instrument import STAGES, Instrumentation
+from .restart import adopt
+
+# upper bounds of the histogram buckets in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+COUNTERS = ("requests", "errors", "bytes_in", "bytes_out")
+GAUGES = ("queue_depth", "in_flight")
+HISTOGRAMS = ("request",) + tuple(STAGES)
+
+
+class _Shard:
+    """Counters and histograms of some threads, protected by their own lock."""
+
+    __slots__ = ("lock", "counters", "buckets", "sums")
+
+    def __init__(self) -> None:
+        """Initialize all counters with 0."""
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.buckets = {name: [0] * (len(BUCKETS) + 1) for name in HISTOGRAMS}  # last: +Inf
+        self.sums = dict.fromkeys(HISTOGRAMS, 0.0)
+
+
+class Metrics(Instrumentation):
+    """Count the requests and collect the latency histograms of every stage.
+
+    The counters are spread over shards, which are assigned to the threads
+    round robin, so the threads of the connections rarely wait for the same
+    lock. The shards are only summed, when the metrics are scraped. The
+    gauges are read from the load of the server, like `/readyz`, so they
+    also count the requests, that were rejected by the admission control.
+
+    Attributes
+    ----------
+    shards : list[_Shard]
+        The shards of the counters and histograms.
+    load : None | health.Load
+        The load of the server, that has the queue depth and the requests in
+        flight. None: Both gauges are 0.
+    local : threading.local
+        The shard of the current thread, once it recorded something.
+    turns : itertools.count
+        The round robin of the shards over the threads.
+
+    """
+
+    def __init__(self, on_mark: t.Union[None, t.Callable[[str, int, dict], None]] = None,
+                 on_request: t.Union[None, t.Callable[[dict], None]] = None,
+                 timing: bool = False, shards: int = 16) -> None:
+        """Initialize the metrics with optional callbacks like `Instrumentation`.
+
+        Parameters
+        ----------
+        on_mark
+            Called with the name of the boundary, its timestamp in ns and the
+            record at every boundary.
+        on_request
+            Called with the complete record after the response was sent.
+        timing
+            Add the `timing` section to every response.
+        shards
+            The number of shards of the counters.
+
+        """
+        super().__init__(on_mark, on_request, timing)
+        self.shards = [_Shard() for _ in range(shards)]
+        self.load = None  # type: t.Union[None, Load]
+        self.local = threading.local()
+        self.turns = itertools.count()
+
+    def _shard(self) -> _Shard:
+        """Return the shard of the current thread, a new thread gets the next one.
+
+        Not by the id of the thread, which is the aligned address of its
+        stack on linux, so the ids modulo the shards would all be 0.
+        """
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = self.shards[next(self.turns) % len(self.shards)]
+        return t.cast(_Shard, shard)
+
+    def on_request(self, rec: t.Any) -> None:
+        """Count the finished request and add its durations to the histograms.
+
+        Parameters
+        ----------
+        rec
+            The record of the request (`instrument.Record`).
+
+        """
+        durations = {stage: us / 1e6 for stage, us in self.durations(rec).items()}
+        if "recv" in rec and "sent" in rec:
+            durations["request"] = (rec["sent"] - rec["recv"]) / 1e9
+        indices = {name: _bucket(sec) for name, sec in durations.items()}
+
+        shard = self._shard()
+        with shard.lock:
+            shard.counters["requests"] += 1
+            shard.counters["errors"] += rec.error
+            shard.counters["bytes_in"] += rec.bytes_in
+            shard.counters["bytes_out"] += rec.bytes_out
+            for name, sec in durations.items():
+                shard.buckets[name][indices[name]] += 1
+                shard.sums[name] += sec
+        super().on_request(rec)
+
+    def snapshot(self) -> dict:
+        """Return the sums of all shards, e.g. to combine the metrics of several processes."""
+        snap = {"counters": dict.fromkeys(COUNTERS, 0),
+                "gauges": dict.fromkeys(GAUGES, 0),
+                "buckets": {name: [0] * (len(BUCKETS) + 1) for name in HISTOGRAMS},
+                "sums": dict.fromkeys(HISTOGRAMS, 0.0)}  # type: dict
+        if self.load is not None:
+            with self.load.lock:
+                snap["gauges"] = {"queue_depth": self.load.queued, "in_flight": self.load.in_flight}
+        for shard in self.shards:
+            with shard.lock:
+                _add(snap, {"counters": shard.counters, "buckets": shard.buckets, "sums": shard.sums})
+        return snap
+
+    def render(self, *others: dict) -> bytes:
+        """Return the metrics in the Prometheus text format.
+
+        Parameters
+        ----------
+        others
+            Snapshots of other processes, that are added to the own metrics.
+
+        """
+        snap = self.snapshot()
+        for other in others:
+            _add(snap, other)
+        return render(snap)
+
+
+def _bucket(sec: float) -> int:
+    """Return the index of the first bucket, that contains the duration."""
+    for i, bound in enumerate(BUCKETS):
+        if sec <= bound:
+            return i
+    return len(BUCKETS)
+
+
+def _add(snap: dict, other: dict) -> None:
+    """Add the counters, gauges and histograms of `other` to `snap`."""
+    for key, val in other["counters"].items():
+        snap["counters"][key] += val
+    for key, val in other.get("gauges", {}).items():
+        snap["gauges"][key] += val
+    for name, counts in other["buckets"].items():
+        snap["buckets"][name] = [a + b for a, b in zip(snap["buckets"][name], counts)]
+        snap["sums"][name] += other["sums"][name]
+
+
+def render(snap: dict) -> bytes:
+    """Format a snapshot of `Metrics` in the Prometheus text format."""
+    c = snap["counters"]
+    g = snap["gauges"]
+    lines = [
+        "# HELP nap_requests_total Requests, that were answered.",
+        "# TYPE nap_requests_total counter",
+        f"nap_requests_total {c['requests']}",
+        "# HELP nap_errors_total Requests with an exception in the response.",
+        "# TYPE nap_errors_total counter",
+        f"nap_errors_total {c['errors']}",
+        "# HELP nap_received_bytes_total Bytes of the received messages.",
+        "# TYPE nap_received_bytes_total counter",
+        f"nap_received_bytes_total {c['bytes_in']}",
+        "# HELP nap_sent_bytes_total Bytes of the sent responses before compression.",
+        "# TYPE nap_sent_bytes_total counter",
+        f"nap_sent_bytes_total {c['bytes_out']}",
+        "# HELP nap_queue_depth Requests, that wait for the main thread.",
+        "# TYPE nap_queue_depth gauge",
+        f"nap_queue_depth {g['queue_depth']}",
+        "# HELP nap_in_flight Requests, that were received, but not answered yet.",
+        "# TYPE nap_in_flight gauge",
+        f"nap_in_flight {g['in_flight']}",
+    ]
+    for name, metric, label in [("request", "nap_request_duration_seconds", "")] + \
+                               [(stage, "nap_stage_duration_seconds", f'stage="{stage}",') for stage in STAGES]:
+        if name == "request":
+            lines += [f"# HELP {metric} Time from the first received byte until the response was sent.",
+                      f"# TYPE {metric} histogram"]
+        elif name == "receive":
+            lines += [f"# HELP {metric} Time of every stage of the requests.",
+                      f"# TYPE {metric} histogram"]
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), snap["buckets"][name]):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+            lines.append(f'{metric}_bucket{{{label}le="{le}"}} {cumulative}')
+        braces = "{" + label.rstrip(",") + "}" if label else ""
+        lines.append(f"{metric}_sum{braces} {snap['sums'][name]:.9f}")
+        lines.append(f"{metric}_count{braces} {cumulative}")
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def serve(ip: str, port: int, metrics: Metrics, load: t.Union[None, Load] = None,
+          fd: t.Union[None, int] = None) -> http.server.ThreadingHTTPServer:
+    """Serve `/metrics` on a side port, e.g. for plain tcp messages.
+
+    The metrics are answered by the daemon thread of http.server, so a
+    scrape neither waits for nor delays the main function. With `load`,
+    also `/healthz` and `/readyz` are served.
+
+    Parameters
+    ----------
+    ip
+        The ip address, where the metrics are served.
+    port
+        The port, where the metrics are served.
+    metrics
+        The metrics, that are rendered.
+    load
+        The load of the server for `/healthz` and `/readyz`, see `health.Load`.
+    fd
+        The file descriptor of an inherited socket, that already listens,
+        see `restart.Restart`. None: Bind to `ip` and `port`.
+
+    Returns
+    -------
+    The http.server, e.g. to close it.
+
+    """
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self) -> None:  # noqa: N802 - is defined by BaseHTTPRequestHandler
+            path = self.path.split("?", 1)[0]
+            if path == "/metrics":
+                code, content_type, body = 200, CONTENT_TYPE, metrics.render()
+            elif path in HEALTH_PATHS and load is not None:
+                code, body = load.report(path)
+                content_type = "application/json"
+            else:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: t.Any) -> None:  # noqa: A002 - is defined by BaseHTTPRequestHandler
+            pass  # scrapes must not flood the log
+
+    httpd = http.server.ThreadingHTTPServer((ip, port), MetricsHandler, bind_and_activate=fd is None)
+    if fd is not None:
+        adopt(httpd, fd)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
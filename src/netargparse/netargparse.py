@@ -1,8 +1,18 @@
 import argparse
+import sys
 import time
 import typing as t
+from functools import partial
 
-from .server import HttpServer, TcpSocketServer
+if t.TYPE_CHECKING:  # imported on the nap and pipe path only, the main mode just needs argparse
+    from .admin import Session
+    from .health import Load
+    from .instrument import Instrumentation, Record
+    from .lanes import Scheduler
+    from .server import HttpServer, Limits, PipeServer, TcpSocketServer
+
+
+RESERVED = ("nap", "pipe", "main", "healthz", "readyz", "metrics", "_nap")  # the modes and the http paths of the script
 
 
 class ArgumentParserNoExit(argparse.ArgumentParser):
@@ -19,15 +29,18 @@ class NetArgumentParser:
     Attributes
     ----------
     meta_parser : ArgumentParserNoExit
-        The parser, that contains two subparsers, to determine whether the script,
-        that uses this library, runs as standalone (function arguments passed by cli) or
-        network argument parser (function arguments passed by tcp message).
+        The parser, that contains three subparsers, to determine whether the script,
+        that uses this library, runs as standalone (function arguments passed by cli),
+        network argument parser (function arguments passed by tcp message) or
+        pipe (function arguments passed as json lines by stdin).
     parser : ArgumentParserNoExit
         The pendant to `parser = argparse.ArgumentParser()` but at level 1 (subparser)
         instead of level 0.
     args : argparse.Namespace
         The arguments from the `meta_parser`. Either containing the arguments, that
         are required for the function or the arguments to run the tcp server.
+    functions : dict[str, tuple[ArgumentParserNoExit, Callable]]
+        The further functions with their own parser, see `add_function`.
 
     """
 
@@ -36,79 +49,654 @@ class NetArgumentParser:
         self.meta_parser = ArgumentParserNoExit(*args, **kwargs)
 
         subparser = self.meta_parser.add_subparsers(dest="_cmd")
+        self._subparser = subparser
+        self.functions = {}  # type: t.Dict[str, t.Tuple[ArgumentParserNoExit, t.Callable]]
 
         nap_parser = subparser.add_parser("nap")
         nap_parser.add_argument("-i", "--ip", type=str, required=False, default="127.0.0.1",
                                 help="IP address where NetArgumentParser listens. Default is 127.0.0.1.")
-        nap_parser.add_argument("-p", "--port", type=int, required=True,
-                                help="Port number where NetArgumentParser listens.")
+        nap_addr = nap_parser.add_mutually_exclusive_group()
+        nap_addr.add_argument("-p", "--port", type=int,
+                              help="Port number where NetArgumentParser listens.")
+        nap_addr.add_argument("-u", "--unix", type=str,
+                              help="Path of the unix socket where NetArgumentParser listens instead of a port.")
+        nap_addr.add_argument("--fd", type=int,
+                              help="File descriptor of an inherited socket, that already listens, instead of a port. "
+                                   "Without -p, -u and --fd, the first socket of LISTEN_FDS is used.")
         nap_parser.add_argument("--http", action="store_true",
                                 help="Use http get requests instead of plain tcp messages.")
+        nap_parser.add_argument("--compress-level", type=int, required=False, default=0, choices=range(10),
+                                help="zlib compression level of responses for clients, that accept it. Default is 0 (off).")
+        nap_parser.add_argument("--compress-min-size", type=int, required=False, default=1024,
+                                help="Minimum size in bytes of a response to be compressed. Default is 1024.")
+        nap_parser.add_argument("--metrics", action="store_true",
+                                help="Collect metrics and serve them at /metrics (with --http).")
+        nap_parser.add_argument("--metrics-port", type=int, required=False, default=None,
+                                help="Serve the metrics at /metrics on this port (implies --metrics).")
+        nap_parser.add_argument("--ready-queue", type=int, required=False, default=16,
+                                help="Queue depth, at which /readyz reports, that the script is saturated. Default is 16.")
+        nap_parser.add_argument("--max-queue", type=int, required=False, default=0,
+                                help="Reject requests, while this many wait for the main thread. Default is 0 (no limit).")
+        nap_parser.add_argument("--max-in-flight", type=int, required=False, default=0,
+                                help="Reject requests, while this many are in flight. Default is 0 (no limit).")
+        nap_parser.add_argument("--max-queue-time", type=float, required=False, default=0,
+                                help="Reject requests, that waited longer for the main thread (seconds). "
+                                     "Default is 0 (no limit).")
+        nap_parser.add_argument("--lane", type=str, action="append", default=[], metavar="NAME:WEIGHT[:CAP]",
+                                help="Queue the requests with `nap_priority` or `nap_func` NAME in their own lane, "
+                                     "that gets WEIGHT turns of the main thread and rejects requests, while CAP "
+                                     "are in flight. Repeat for several lanes, the others use the lane `default`.")
+        nap_parser.add_argument("--fair", action="store_true",
+                                help="Take the waiting requests round robin across clients (`nap_key` or address).")
+        nap_parser.add_argument("--rate-limit", type=float, required=False, default=0,
+                                help="Reject the requests of a client over this many per second (implies --fair). "
+                                     "Default is 0 (no limit).")
+        nap_parser.add_argument("--rate-burst", type=float, required=False, default=0,
+                                help="Requests of a client, that may arrive at once. Default is the rate, at least 1.")
+        nap_parser.add_argument("--timeout", type=float, required=False, default=0,
+                                help="Deadline of every request in seconds after it was received, clients can "
+                                     "shorten it with `nap_timeout`. Default is 0 (none).")
+        nap_parser.add_argument("--idle-timeout", type=float, required=False, default=0,
+                                help="Close connections without a new message for this many seconds. Default is 0 (never).")
+        nap_parser.add_argument("--read-timeout", type=float, required=False, default=0,
+                                help="Close connections, that need longer for one message (seconds). Default is 0 (never).")
+        nap_parser.add_argument("--max-message-size", type=int, required=False, default=0,
+                                help="Close connections with larger messages (bytes). Default is 0 (no limit).")
+        nap_parser.add_argument("--max-messages", type=int, required=False, default=0,
+                                help="Close connections after this many messages. Default is 0 (no limit).")
+        nap_parser.add_argument("--flush-size", type=int, required=False, default=65536,
+                                help="Bytes of responses to pipelined messages, that a connection keeps at most, "
+                                     "before it sends them with one system call. Default is 65536.")
+        nap_parser.add_argument("--flush-count", type=int, required=False, default=16,
+                                help="Responses to pipelined messages, that a connection keeps at most. "
+                                     "Default is 16, 1: Send every response at once.")
+        nap_parser.add_argument("--drain-timeout", type=float, required=False, default=30,
+                                help="Seconds, that SIGTERM waits for the requests in flight and SIGHUP for the "
+                                     "new process. Default is 30.")
+        nap_parser.add_argument("--admin", action="store_true",
+                                help="Accept control messages (`nap_cmd`) for profiling, e.g. /_nap/profile.")
+
+        subparser.add_parser("pipe")
 
         self.parser = subparser.add_parser("main")
 
-    def __call__(self, func: t.Callable,
+    def add_function(self, name: str, func: t.Callable, **kwargs: t.Any) -> ArgumentParserNoExit:
+        """Register a further function with its own parser, that is served by the same script.
+
+        Standalone, the function is run with `python <file> <name> <arg> <val> ...`.
+        In nap and pipe mode, a message with the meta field `nap_func` or an
+        http request to `/<name>` or `/<name>/xml` is dispatched to it, so
+        several functions share one process, its port and its warm state.
+
+        Parameters
+        ----------
+        name
+            The name of the function. `nap`, `pipe`, `main` and the paths of
+            the http server (`healthz`, `readyz`, `metrics` and `_nap`) are
+            reserved.
+        func
+            The function, that is called with the parsed arguments.
+        kwargs
+            Passed to `add_parser` of argparse, e.g. `help` or `parents` to
+            reuse the arguments of an existing parser.
+
+        Raises
+        ------
+        ValueError
+            When the name is reserved or already registered.
+
+        Returns
+        -------
+        The parser of the function, for `add_argument`.
+
+        """
+        if name in RESERVED or name in self.functions or "/" in name:
+            raise ValueError(f"`{name}` is reserved or already registered.")
+        parser = self._subparser.add_parser(name, **kwargs)
+        self.functions[name] = (parser, func)
+        return parser
+
+    def __call__(self, func: t.Union[None, t.Callable] = None,
                  autoformat: bool = True,
                  resp_delay: t.Union[int, float] = 0,
-                 parse_args: t.Union[None, t.List[str]] = None) -> None:
-        """Run the function `func` either directly from the cli or with nap.
+                 parse_args: t.Union[None, t.List[str]] = None,
+                 instrument: t.Union[None, "Instrumentation"] = None,
+                 setup: t.Union[None, t.Callable[[], t.Any]] = None,
+                 warmup: t.Iterable[dict] = ()) -> None:
+        """Run the function `func` either directly from the cli, with nap or pipe.
 
-        The function `func` is either executed directly or runs as tcp server
-        and accepts arguments from tcp clients.
+        The function `func` is either executed directly, runs as tcp server
+        and accepts arguments from tcp clients or reads the arguments as json
+        lines from stdin and writes the responses as json lines to stdout.
 
         Parameters
         ----------
         func
-            THE function.
+            THE function. None: Only the functions of `add_function` are served.
         autoformat
             True: The return of the function `func` can be a dict or str and is
                   automatically formatted to a valid xml or json format as response
-                  in nap mode.
+                  in nap or pipe mode.
             False: The return of the function `func` is handed "as is" as response
-                   in nap mode. The function `func` is required to form a valid
+                   in nap or pipe mode. The function `func` is required to form a valid
                    response.
         resp_delay
             Wait `resp_delay` in seconds before sending the response (return of
-            `func`) in nap mode.
+            `func`) in nap or pipe mode.
         parse_args
             None: Parse the arguments from the cli.
             List[str]: Parse the arguments from the list.
+        instrument
+            None: No instrumentation, which costs nothing.
+            Instrumentation: Record the stage boundaries of every request in
+            nap or pipe mode and call its hooks. With `--metrics`, it is
+            wrapped in `Metrics`, unless it already is.
+        setup
+            None: No shared context.
+            Callable: Called once before anything else, e.g. to load models
+            or open connections. Its return is passed to every call of the
+            functions as `args._context`.
+        warmup
+            Messages, e.g. `[{"-x": 1}]`, that are run through the pipeline
+            of a request in nap or pipe mode before the script starts
+            listening, so the first requests are not slow. The responses are
+            dropped. `/readyz` is only reachable after the warm-up.
+
+        A request with a deadline (`--timeout` or the meta field `nap_timeout`)
+        is dropped, when the deadline passed before the main function was
+        called. If the main function is still running at the deadline, the
+        timeout is sent by `deadline.Watchdog` and the late response is dropped.
+
+        With `--admin`, a message with the meta field `nap_cmd` opens a
+        profiling window (`admin.Session`). Its response is sent, when the
+        window is over, and the other messages are answered in the meantime.
+
+        In nap mode, SIGTERM drains the script and SIGHUP starts it again
+        with the inherited listening sockets, see `restart.Restart`. The
+        signals are only handled, when this is called in the main thread.
 
         """
         self.parse_args(parse_args)
+        if self.args._cmd == "nap":  # the options are checked before the setup, which may be slow
+            if self.args.http and self.args.unix:
+                raise Exception("`--unix` is only supported for plain tcp messages.")
+            fd, metrics_fd = self.sockets()
+        context = {"_context": setup()} if setup is not None else {}  # added to the args of every call
 
         if self.args._cmd == "main":
+            if func is None:
+                raise Exception("There is no `main` function, use one of the functions.")
+            vars(self.args).update(context)
             func(self.args)
             return
+        if self.args._cmd in self.functions:
+            vars(self.args).update(context)
+            self.functions[self.args._cmd][1](self.args)
+            return
+
+        from .deadline import TIMEOUT, Watchdog, deadline_of
+        from .instrument import Instrumentation
+        from .message import FileResponse, Message
+        from .metrics import Metrics
+        from .metrics import serve as serve_metrics
+        from .restart import Restart, notify_ready
+        from .server import HttpServer, PipeServer, TcpSocketServer
+
+        for msg in warmup:
+            self.warm_up(msg, func, autoformat, context)
 
-        if self.args.http:
-            server = HttpServer(self.args.ip, self.args.port)  # type: t.Union[HttpServer, TcpSocketServer]
+        if self.args._cmd == "nap" and (self.args.metrics or self.args.metrics_port):
+            if instrument is None:
+                instrument = Metrics()
+            elif not isinstance(instrument, Metrics):
+                instrument = Metrics(instrument.on_mark, instrument.on_request, instrument.timing)
+
+        restart = None  # type: t.Union[None, Restart]
+        if self.args._cmd == "pipe":
+            server = PipeServer(instrument)  # type: t.Union[HttpServer, PipeServer, TcpSocketServer]
+        elif self.args.http:
+            server = HttpServer(self.args.ip, self.args.port,
+                                self.args.compress_level, self.args.compress_min_size, instrument, self.load(),
+                                self.limits(), self.functions, self.lanes(), fd)
         else:
-            server = TcpSocketServer(self.args.ip, self.args.port)
+            server = TcpSocketServer(self.args.ip, self.args.port,
+                                     self.args.compress_level, self.args.compress_min_size,
+                                     self.args.unix, instrument, self.load(), self.limits(), self.lanes(), fd,
+                                     self.args.flush_size, self.args.flush_count)
+        if self.args._cmd == "nap":
+            if isinstance(instrument, Metrics):
+                instrument.load = t.cast(t.Union[HttpServer, TcpSocketServer], server).load
+            metrics = None
+            if self.args.metrics_port:
+                metrics = serve_metrics(self.args.ip, self.args.metrics_port, t.cast(Metrics, instrument),
+                                        t.cast(t.Union[HttpServer, TcpSocketServer], server).load, metrics_fd)
+            argv = [sys.argv[0], *(parse_args if parse_args is not None else sys.argv[1:])]
+            restart = Restart(server, metrics, argv, self.args.drain_timeout)
+            restart.install()
+            notify_ready()
 
+        session = None  # type: t.Union[None, Session]
+        watchdog = Watchdog()
         while True:
-            ans = ""  # type: t.Union[dict, str]
+            if session is not None and session.expired():
+                session.finish()
+                session = None
+            ans: t.Union[dict, str, bytes, FileResponse] = ""
             exc = ""
+            shared = {}  # type: dict
+            armed = False
 
             try:
                 args = server.get_msg()
+                if args is None:  # stdin of pipe was closed
+                    return
                 if args is False:  # can also be `[]`, so no `not args_s`
+                    if restart is not None and restart.done:
+                        return
+                    continue
+                if "nap_cmd" in server.meta:
+                    session = self.open_session(server, session)
                     continue
-                args_l = []
-                for item in args:
-                    val = item.split(" ", 1)
-                    if len(val) == 2 and (val[1].startswith("'") or val[1].startswith('"')):
-                        args_l.extend([val[0], val[1].replace("'", "").replace('"', "")])
-                    else:
-                        args_l.extend(item.split(" "))
-                args_d = self.parser.parse_args(args_l)
-                args_d._cmd = "nap"
-                ans = func(args_d)
+                if session is not None:
+                    session.enable()
+                rec = server.rec
+                deadline = deadline_of(server.stamp, server.meta, getattr(self.args, "timeout", 0))
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise Exception(f"{TIMEOUT}: the deadline passed, before the main function was called.")
+                fn, args_d, shared = self.prepare(args, server.meta, func, context, self.args._cmd, rec)
+                if rec is not None:
+                    rec.mark("parsed")
+                if deadline is not None:
+                    args_d._deadline = deadline
+                    watchdog.arm(deadline, partial(self.timeout, server, autoformat))
+                    armed = True
+                ans = fn(args_d)
+                if rec is not None:
+                    rec.mark("func")
             except Exception as e:
                 exc = str(e)
+            finally:
+                for arr in shared.values():
+                    arr.close()
+
+            if not armed or watchdog.disarm():  # else the watchdog already sent the timeout
+                time.sleep(resp_delay)
+                extra = Message.echo(server.meta)
+                if server.rec is not None:
+                    server.rec.error = bool(exc)
+                    server.rec.mark("delayed")
+                    if server.rec.instrument.timing or "nap_timing" in server.meta:
+                        extra["timing"] = Instrumentation.durations(server.rec)
+                server.send_msg(autoformat, response=ans, exception=exc, extra=extra)
+            elif isinstance(ans, FileResponse):  # the late response is dropped
+                ans.discard()
+            if session is not None:
+                session.disable()
+
+    def prepare(self, args: t.List[str], meta: dict, func: t.Union[None, t.Callable], context: dict, cmd: str,
+                rec: t.Union[None, "Record"] = None) -> t.Tuple[t.Callable, argparse.Namespace, dict]:
+        """Parse the arguments of a message for its function, like for every request in nap and pipe mode.
+
+        Parameters
+        ----------
+        args
+            Argument(s) from `Message.dict_to_argslist`.
+        meta
+            The meta fields of the message, e.g. `nap_func` or `nap_shm`.
+        func
+            The main function, if any.
+        context
+            `{"_context": ...}` with the return of `setup`, or empty.
+        cmd
+            Set as `args._cmd`, e.g. `nap`.
+        rec
+            The record of the message, that gets the `split` boundary.
+
+        Raises
+        ------
+        Exception
+            When there is no such function, the arguments are invalid or a
+            name in `nap_shm` starts with `_` or is already an argument.
+
+        Returns
+        -------
+        The function, its arguments and the attached shared arrays, which
+        must be closed after the call.
+
+        """
+        args_l = self.split_args(args)
+        if rec is not None:
+            rec.mark("split")
+        parser, fn = self.dispatch(meta.get("nap_func"), func)
+        args_d = parser.parse_args(args_l)
+        args_d._cmd = cmd
+        vars(args_d).update(context)
+        if "nap_attachment" in meta:
+            args_d._attachment = meta["nap_attachment"]
+        shared = {}  # type: dict
+        if "nap_shm" in meta:
+            from .shm import attach_all
+
+            shared = attach_all(meta["nap_shm"])
+            for name in shared:
+                if name.startswith("_") or hasattr(args_d, name):
+                    for arr in shared.values():
+                        arr.close()
+                    raise Exception(f"`{name}` in nap_shm is no free attribute name of the arguments.")
+            for name, arr in shared.items():
+                setattr(args_d, name, arr.view)
+        return fn, args_d, shared
+
+    def call(self, func: t.Union[None, t.Callable], args: t.Union[None, dict] = None, autoformat: bool = True,
+             context: t.Any = None) -> dict:
+        """Call a function in-process with a message as dict, e.g. to embed the script or to test it.
+
+        The message takes the path of a json message in nap mode, without
+        the network and the main loop, and the response is the envelope,
+        that a client would receive.
+
+        Parameters
+        ----------
+        func
+            The main function. None: Only the functions of `add_function`.
+        args
+            The arguments with their names as for the cli, e.g. `{"-x": 5}`,
+            and meta fields, e.g. `nap_func` or `nap_id`.
+        autoformat
+            Like for `__call__`.
+        context
+            Passed to the function as `args._context`, e.g. the return of
+            `setup`. None: No `_context`.
+
+        Returns
+        -------
+        The envelope, e.g. `{"response": {"sum": 5}, "exception": "", "finished": 1}`.
+
+        """
+        from .message import Message, MessageJson
+
+        d, meta = Message.split_meta(dict(args or {}))
+        msg = self.respond(MessageJson(), Message.dict_to_argslist(d), meta, func, autoformat,
+                           {"_context": context} if context is not None else {})
+        return MessageJson._to_dict(msg)
+
+    def call_raw(self, msg: bytes, func: t.Union[None, t.Callable] = None, autoformat: bool = True,
+                 context: t.Any = None) -> bytes:
+        """Call a function in-process with a received message and return the response, that would be sent.
+
+        Parameters
+        ----------
+        msg
+            One complete json or xml message or frame, like a client sends it.
+        func
+            The main function. None: Only the functions of `add_function`.
+        autoformat
+            Like for `__call__`.
+        context
+            Passed to the function as `args._context`, e.g. the return of
+            `setup`. None: No `_context`.
+
+        Raises
+        ------
+        Exception
+            When the message is in an unknown format or cannot be decoded,
+            so there is no format for the response.
+
+        Returns
+        -------
+        The response with its envelope, a frame also with its attachment.
+
+        """
+        from .message import Message, MessageFrame
+
+        msg_meth = Message(msg)
+        d, meta = Message.split_meta(msg_meth._to_dict(msg))
+        if isinstance(msg_meth.msg_meth, MessageFrame) and msg_meth.attachment is not None:
+            meta["nap_attachment"] = msg_meth.attachment
+        return self.respond(msg_meth, Message.dict_to_argslist(d), meta, func, autoformat,
+                            {"_context": context} if context is not None else {})
+
+    def respond(self, msg_meth: t.Any, args: t.List[str], meta: dict, func: t.Union[None, t.Callable],
+                autoformat: bool, context: dict, cmd: str = "nap", strict: bool = False) -> bytes:
+        """Run a message in-process through its function and format the response, see `call` and `call_raw`.
+
+        A deadline (`nap_timeout`) is checked before the function is called
+        and passed as `args._deadline`, but the function is not interrupted.
+        A `FileResponse` is read into the response. `context` is added to the
+        arguments and `cmd` is their `_cmd`, like in `prepare`, by default
+        `nap`, so a call has the same arguments as in nap mode. With `strict`,
+        a response with an exception is not formatted, but the exception is
+        raised, e.g. for `warm_up`.
+        """
+        from .deadline import TIMEOUT, deadline_of
+        from .message import BINARY, FileResponse, Message, MessageFrame
+
+        ans = ""  # type: t.Union[dict, str, bytes, FileResponse]
+        exc = ""
+        shared = {}  # type: dict
+        file = None  # type: t.Union[None, bytes]
+        try:
+            if "nap_cmd" in meta:
+                raise Exception("Control messages (`nap_cmd`) are not supported in-process.")
+            deadline = deadline_of(time.monotonic(), meta, 0)
+            fn, args_d, shared = self.prepare(args, meta, func, context, cmd)
+            if deadline is not None:
+                if time.monotonic() >= deadline:
+                    raise Exception(f"{TIMEOUT}: the deadline passed, before the main function was called.")
+                args_d._deadline = deadline
+            ans = fn(args_d)
+            if isinstance(ans, FileResponse):
+                response, ans = ans, ""
+                f = response.open()
+                try:
+                    file = f.read()
+                finally:
+                    response.close(f)
+        except Exception as e:
+            exc = str(e)
+        finally:
+            for arr in shared.values():
+                arr.close()
 
-            time.sleep(resp_delay)
-            server.send_msg(autoformat, response=ans, exception=exc)
+        extra = Message.echo(meta)
+        frame = isinstance(getattr(msg_meth, "msg_meth", msg_meth), MessageFrame)
+        if not frame and file is None and isinstance(ans, BINARY):
+            ans, exc = "", "Binary responses need a frame."
+        if strict and exc:
+            raise Exception(exc)
+        if frame:
+            return b"".join(msg_meth._frame(autoformat, ans if file is None else file, exc, extra=extra))
+        if file is not None:
+            head, tail = msg_meth._envelope(exc, extra)
+            return t.cast(bytes, head + file + tail)
+        return t.cast(bytes, msg_meth._format(autoformat, ans, exc, extra))
+
+    def warm_up(self, msg: dict, func: t.Union[None, t.Callable], autoformat: bool, context: dict) -> None:
+        """Run a warm-up message through the pipeline of a request and drop the response.
+
+        The message is parsed, passed to its function and the response is
+        formatted as json, like a request in nap or pipe mode, see `respond`.
+
+        Parameters
+        ----------
+        msg
+            The message as dict, e.g. `{"-x": 1}` or `{"nap_func": "add", "-a": 1}`.
+        func
+            The main function, if any.
+        autoformat
+            Like for `__call__`.
+        context
+            `{"_context": ...}` with the return of `setup`, or empty.
+
+        Raises
+        ------
+        Exception
+            When the response has an exception or cannot be formatted, so a
+            broken script fails at the start instead of at the first request.
+
+        """
+        from .message import Message, MessageJson
+
+        try:
+            d, meta = Message.split_meta(dict(msg))
+            self.respond(MessageJson(), Message.dict_to_argslist(d), meta, func, autoformat, context,
+                         self.args._cmd, strict=True)
+        except Exception as e:
+            raise Exception(f"Warm-up with {msg} failed: {e}") from e
+
+    def dispatch(self, name: t.Union[None, str],
+                 func: t.Union[None, t.Callable]) -> t.Tuple[ArgumentParserNoExit, t.Callable]:
+        """Return the parser and the function for a message.
+
+        Parameters
+        ----------
+        name
+            The meta field `nap_func` of the message. None: The main function.
+        func
+            The main function, if any.
+
+        Raises
+        ------
+        Exception
+            When there is no such function. The exception is sent as response.
+
+        """
+        if name is None:
+            if func is None:
+                raise Exception(f"`nap_func` is missing, one of {', '.join(self.functions)}.")
+            return self.parser, func
+        if name not in self.functions:
+            raise Exception(f"Unknown function `{name}`.")
+        return self.functions[name]
+
+    @staticmethod
+    def timeout(server: "t.Union[HttpServer, PipeServer, TcpSocketServer]", autoformat: bool, exc: str) -> None:
+        """Send the timeout as response, while the main function is still running (`deadline.Watchdog`)."""
+        from .message import Message
+
+        if server.rec is not None:
+            server.rec.error = True
+        server.send_msg(autoformat, response="", exception=exc, extra=Message.echo(server.meta))
+
+    def load(self) -> "Load":
+        """Return the load with the limits of the admission control from the nap arguments."""
+        from .health import Load
+
+        return Load(self.args.ready_queue, self.args.max_queue, self.args.max_in_flight, self.args.max_queue_time)
+
+    def limits(self) -> t.Union[None, "Limits"]:
+        """Return the limits of every connection from the nap arguments, None without limits."""
+        from .server import Limits
+
+        limits = Limits(self.args.idle_timeout, self.args.read_timeout, self.args.max_message_size,
+                        self.args.max_messages)
+        return limits if any(getattr(limits, name) for name in Limits.__slots__) else None
+
+    def sockets(self) -> t.Tuple[t.Union[None, int], t.Union[None, int]]:
+        """Return the inherited listening sockets of the server and of `--metrics-port`.
+
+        The sockets of the previous process (SIGHUP, see `restart.Restart`)
+        come first, then `--fd`, then `LISTEN_FDS` of a supervisor, whose
+        second socket is used for `--metrics-port`.
+
+        Raises
+        ------
+        Exception
+            When there is neither an address nor an inherited socket.
+
+        Returns
+        -------
+        The file descriptors, None: Bind the socket.
+
+        """
+        from .restart import LISTEN_FD, METRICS_FD, inherited, listen_fds
+
+        fds = listen_fds()
+        handoff = inherited(LISTEN_FD), inherited(METRICS_FD)
+        if handoff[0] is not None:
+            return handoff
+        fd = self.args.fd
+        if fd is None and self.args.port is None and self.args.unix is None:
+            if not fds:
+                raise Exception("One of `--port`, `--unix` or `--fd` is required, or a socket in `LISTEN_FDS`.")
+            fd = fds[0]
+        return fd, fds[1] if len(fds) > 1 else None
+
+    def lanes(self) -> t.Union[None, "Scheduler"]:
+        """Return the scheduler with the lanes and rate limits from the nap arguments, None without."""
+        from .lanes import Lane, Scheduler
+
+        if not (self.args.lane or self.args.fair or self.args.rate_limit):
+            return None
+        return Scheduler((Lane.parse(spec) for spec in self.args.lane), self.args.rate_limit, self.args.rate_burst)
+
+    def open_session(self, server: "t.Union[HttpServer, PipeServer, TcpSocketServer]",
+                     session: t.Union[None, "Session"]) -> "Session":
+        """Open the profiling window of the control message, that was received last.
+
+        A timer wakes up the main thread at the end of the window, so the
+        report is also sent, when no other message arrives.
+
+        Parameters
+        ----------
+        server
+            The server, that received the control message.
+        session
+            The profiling window, that is already open, if any.
+
+        Raises
+        ------
+        Exception
+            When `--admin` is not set, a window is already open or the
+            control message is invalid. The exception is sent as response.
+
+        Returns
+        -------
+        The new profiling window.
+
+        """
+        from threading import Timer
+
+        from .admin import Session
+        from .message import Message
+        from .server import PipeServer
+
+        if not getattr(self.args, "admin", False) or isinstance(server, PipeServer):
+            raise Exception("Control messages (`nap_cmd`) need `--admin`.")
+        if session is not None:
+            raise Exception("A profiling window is already open.")
+        session = Session(server.meta, server.detach(), Message.echo(server.meta))
+        timer = Timer(session.seconds, server.wakeup)
+        timer.daemon = True
+        timer.start()
+        return session
+
+    @staticmethod
+    def split_args(args: t.List[str]) -> t.List[str]:
+        """Split the arguments from `Message.dict_to_argslist` for `parser.parse_args`.
+
+        Every item is split at its spaces into the argument and its values,
+        unless the value is quoted, e.g. `--var "hello world"`, then the
+        quotes are removed and the value is kept as one.
+
+        Parameters
+        ----------
+        args
+            Argument(s) for the main `parser`, e.g. `["-x 1 2", "--var"]`.
+
+        Returns
+        -------
+        The list for `parser.parse_args`, e.g. `["-x", "1", "2", "--var"]`.
+
+        """
+        args_l = []
+        for item in args:
+            val = item.split(" ", 1)
+            if len(val) == 2 and (val[1].startswith("'") or val[1].startswith('"')):
+                args_l.extend([val[0], val[1].replace("'", "").replace('"', "")])
+            else:
+                args_l.extend(item.split(" "))
+        return args_l
 
     def add_argument(self, *args: t.Any, **kwargs: t.Any) -> None:
         """Provide the same method as ArgumentParser."""
@@ -127,10 +715,11 @@ class NetArgumentParser:
         ------
         Exception
             When not specified if the script, that is using this lib, should run
-            as standalone (`main`) or tcp server (`nap`).
+            as standalone (`main` or a function), tcp server (`nap`) or json lines
+            filter (`pipe`).
 
         """
         self.args = self.meta_parser.parse_args(parse_args)
 
-        if self.args._cmd not in ["main", "nap"]:
-            raise Exception("Either `main` or `nap` must be passed as positional argument.")
+        if self.args._cmd not in ["main", "nap", "pipe", *self.functions]:
+            raise Exception("Either `main`, `nap`, `pipe` or a function must be passed as positional argument.")
@@ -0,0 +1,169 @@
+import http.server
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import typing as t
+from threading import Thread
+
+LISTEN_FD = "NAP_LISTEN_FD"  # env of the new process: the inherited listening socket of the server
+METRICS_FD = "NAP_METRICS_FD"  # env of the new process: the inherited listening socket of `--metrics-port`
+READY_FD = "NAP_READY_FD"  # env of the new process: the pipe, that tells the old process, that it is ready
+LISTEN_FDS_START = 3  # the first socket of `LISTEN_FDS` (socket activation of systemd)
+
+
+class Restart:
+    """Drain the script on SIGTERM and hand its listening sockets to a new process on SIGHUP.
+
+    The signal handlers only start a daemon thread, because the main thread
+    may hold the locks of the queues, when the signal arrives.
+
+    - Drain: the listening sockets are closed, `/readyz` reports
+      `draining`, and every connection is closed after its next response.
+      When all requests in flight are answered and the last accepted
+      connections sent their first message (or `timeout` passed), the main
+      loop returns. Idle connections are closed with the process.
+    - Re-exec: the script is started again with the same arguments and the
+      inherited listening sockets, so the kernel queues the connections,
+      while the new process imports and warms up. When its main loop
+      starts, it tells the old process through a pipe, which drains then.
+      If the new process fails, the old one keeps serving.
+
+    Attributes
+    ----------
+    server : server.HttpServer | server.TcpSocketServer
+        The server, that is drained.
+    metrics : None | http.server.ThreadingHTTPServer
+        The server of `--metrics-port`, if any.
+    argv : list[str]
+        The script and its arguments for the new process.
+    timeout : float
+        The seconds, that the drain waits for the requests in flight and
+        the re-exec for the new process.
+    done : bool
+        Whether the drain is over and the main loop returns.
+
+    """
+
+    def __init__(self, server: t.Any, metrics: t.Union[None, http.server.ThreadingHTTPServer],
+                 argv: t.List[str], timeout: float) -> None:
+        """Initialize the restart, the signal handlers are set by `install`."""
+        self.server = server
+        self.metrics = metrics
+        self.argv = argv
+        self.timeout = timeout
+        self.done = False
+        self.lock = threading.Lock()
+        self.running = False
+
+    def install(self) -> None:
+        """Set the handlers of SIGTERM and SIGHUP, which is only possible in the main thread."""
+        if threading.current_thread() is not threading.main_thread():
+            return
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.start(self.drain))
+        if hasattr(signal, "SIGHUP"):  # not on windows
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.start(self.reexec))
+
+    def start(self, target: t.Callable[[], None]) -> None:
+        """Run the drain or re-exec in a daemon thread, unless one is already running."""
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+        Thread(target=target, daemon=True).start()
+
+    def drain(self) -> None:
+        """Daemon thread, that stops accepting, waits for the requests in flight and wakes up the main thread."""
+        self.server.load.draining = True
+        self.server.close()
+        if self.metrics is not None:
+            self.metrics.shutdown()
+            self.metrics.server_close()
+        end = time.monotonic() + self.timeout
+        while self.server.load.busy() and time.monotonic() < end:
+            time.sleep(0.01)
+        self.done = True
+        self.server.wakeup()
+
+    def reexec(self) -> None:
+        """Daemon thread, that starts the new process with the listening sockets and drains, when it is ready."""
+        fds = {LISTEN_FD: self.server.fileno()}
+        if self.metrics is not None:
+            fds[METRICS_FD] = self.metrics.fileno()
+        read, write = os.pipe()
+        env = dict(os.environ, **{key: str(fd) for key, fd in fds.items()})
+        env[READY_FD] = str(write)
+        try:
+            proc = subprocess.Popen(command(self.argv), env=env, pass_fds=(*fds.values(), write),
+                                    start_new_session=True)  # survives the old process and its signals
+        except OSError as e:
+            print(f"Re-exec failed: {e}")
+            os.close(read)
+            os.close(write)
+            with self.lock:
+                self.running = False
+            return
+        os.close(write)
+        ready = select.select([read], [], [], self.timeout)[0] and os.read(read, 1)
+        os.close(read)
+        if not ready:  # exited or too slow
+            print(f"The new process {proc.pid} did not get ready, keep serving.")
+            proc.kill()
+            with self.lock:
+                self.running = False
+            return
+        self.drain()
+
+
+def command(argv: t.List[str]) -> t.List[str]:
+    """Return the command line of the new process with the options of the interpreter, e.g. `-X` or `-O`.
+
+    `sys.orig_argv` (python 3.10+) holds the interpreter, its options and the
+    script as it was started (e.g. `-m module` or `-c code`), followed by the
+    arguments, which are replaced by the ones in `argv`.
+    """
+    orig = getattr(sys, "orig_argv", None)
+    start = len(orig) - len(sys.argv) + 1 if orig else 0
+    if not orig or start < 2 or orig[start:] != sys.argv[1:]:
+        return [sys.executable, *argv]
+    return [*orig[:start], *argv[1:]]
+
+
+def inherited(key: str) -> t.Union[None, int]:
+    """Return the listening socket, that was inherited from the old process, and forget it for child processes."""
+    fd = os.environ.pop(key, None)
+    return int(fd) if fd else None
+
+
+def listen_fds() -> t.List[int]:
+    """Return the listening sockets, that a supervisor passed with `LISTEN_FDS` and `LISTEN_PID`.
+
+    This is the socket activation of systemd: the sockets start at file
+    descriptor 3 and are only meant for the process `LISTEN_PID`, if set.
+    The variables are removed, so child processes do not take the sockets.
+    """
+    pid = os.environ.pop("LISTEN_PID", None)
+    count = os.environ.pop("LISTEN_FDS", None)
+    os.environ.pop("LISTEN_FDNAMES", None)
+    if not count or (pid is not None and pid != str(os.getpid())):
+        return []
+    return list(range(LISTEN_FDS_START, LISTEN_FDS_START + int(count)))
+
+
+def notify_ready() -> None:
+    """Tell the old process, that the new one is ready, so it drains."""
+    fd = inherited(READY_FD)
+    if fd is not None:
+        os.write(fd, b"1")
+        os.close(fd)
+
+
+def adopt(httpd: http.server.HTTPServer, fd: int) -> None:
+    """Replace the socket of http.server, that was not bound, by the inherited listening socket."""
+    httpd.socket.close()
+    httpd.socket = socket.socket(fileno=fd)
+    httpd.server_address = httpd.socket.getsockname()
@@ -1,34 +1,215 @@
 import http.server
 import io
+import os
+import select
 import socket
+import stat
+import sys
+import time
 import typing as t
 import urllib.parse
+import zlib
 from queue import Queue
 from threading import Thread
 
-from .message import Message, MessageJson, MessageXml
+from .health import OVERLOADED, RETRY_AFTER, Load
+from .health import PATHS as HEALTH_PATHS
+from .instrument import Instrumentation, Record
+from .lanes import DEFAULT as DEFAULT_LANE
+from .lanes import Scheduler
+from .message import (
+    BINARY,
+    FileResponse,
+    Message,
+    MessageFrame,
+    MessageJson,
+    MessageXml,
+    sendall,
+)
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from .metrics import Metrics
+from .restart import adopt
+
+ADMIN_PATHS = {"/_nap/profile": "profile", "/_nap/tracemalloc": "tracemalloc"}
+ACCEPT_INTERVAL = 0.5  # seconds, in which the accept loop notices `close`
+FLUSH_SIZE = 65536  # bytes of responses, that a connection keeps at most before sending them
+FLUSH_COUNT = 16  # responses, that a connection keeps at most before sending them
+
+
+class Limits:
+    """The limits of every connection, so slow or malicious clients cannot tie up the server.
+
+    A connection, that violates a limit, is closed without a response.
+
+    Attributes
+    ----------
+    idle_timeout : float
+        Seconds without the first byte of the next message. 0: No limit.
+    read_timeout : float
+        Seconds from the first byte of a message until it is complete. 0: No limit.
+    max_message_size : int
+        Bytes of a message (the body of an http request). 0: No limit.
+    max_messages : int
+        Messages per connection. 0: No limit.
+
+    """
+
+    __slots__ = ("idle_timeout", "read_timeout", "max_message_size", "max_messages")
+
+    def __init__(self, idle_timeout: float = 0, read_timeout: float = 0, max_message_size: int = 0,
+                 max_messages: int = 0) -> None:
+        """Initialize the limits, 0 is no limit."""
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.max_message_size = max_message_size
+        self.max_messages = max_messages
+
+
+class Output:
+    """The write buffer of a connection, that sends the ready responses with one `sendmsg` (writev).
+
+    While the next message of the client is already received (pipelining),
+    the response is kept and sent together with the following ones, that
+    are ready without the main thread, e.g. rejections. The responses are
+    sent, before the next message goes to the main thread, when the
+    connection would wait for the client or when a threshold is reached, so
+    a response is never held, while `func` runs. Without pipelining, every
+    response is sent at once.
+
+    Attributes
+    ----------
+    conn : socket.socket
+        Established connection of the client.
+    bufs : list[bytes | bytearray | memoryview]
+        The buffers of the responses, that were not sent yet.
+    size : int
+        The bytes in `bufs`.
+    count : int
+        The responses in `bufs`.
+    flush_size : int
+        Send the responses, when they have this many bytes.
+    flush_count : int
+        Send the responses, when there are this many. 1: Send every response at once.
+
+    """
+
+    __slots__ = ("conn", "bufs", "size", "count", "flush_size", "flush_count")
+
+    def __init__(self, conn: socket.socket, flush_size: int = FLUSH_SIZE, flush_count: int = FLUSH_COUNT) -> None:
+        """Initialize the empty buffer of the connection."""
+        self.conn = conn
+        self.bufs = []  # type: t.List[t.Union[bytes, bytearray, memoryview]]
+        self.size = 0
+        self.count = 0
+        self.flush_size = flush_size
+        self.flush_count = flush_count
+
+    def add(self, *bufs: t.Union[bytes, bytearray, memoryview]) -> None:
+        """Keep the buffers of one response."""
+        self.bufs.extend(bufs)
+        self.size += sum(memoryview(buf).nbytes for buf in bufs)
+        self.count += 1
+
+    def full(self) -> bool:
+        """Return whether a threshold is reached, so the responses must be sent."""
+        return self.size >= self.flush_size or self.count >= self.flush_count
+
+    def flush(self) -> None:
+        """Send the kept responses, an OSError means, that the connection is broken."""
+        if self.bufs:
+            bufs = self.bufs
+            self.bufs = []
+            self.size = self.count = 0
+            sendall(self.conn, bufs)
+
+
+def nodelay(conn: socket.socket) -> None:
+    """Disable Nagle's algorithm for a tcp connection, so small responses are not delayed."""
+    if conn.family in (socket.AF_INET, socket.AF_INET6):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def admit(load: Load, lanes: t.Union[None, Scheduler], lane: t.Union[None, str],
+          client: str = "") -> t.Union[None, str]:
+    """Admit a request by the rate of its client, the cap of its lane and the limits of the load.
+
+    Returns
+    -------
+    None: The request was admitted and is counted in its lane and the load.
+    str: The exception of the rejected request, see `health.Load.admit`.
+
+    """
+    if lanes is None or lane is None:
+        return load.admit()
+    reason = lanes.admit(lane, client)
+    if reason is None:
+        reason = load.admit()
+        if reason is not None:
+            lanes.answered(lane)
+    return reason
 
 
 class TcpSocketServer:
     """The script in nap mode accepts plain tcp messages without overhead.
 
+    Every connection is served by its own daemon thread, so several clients
+    can keep their connections open at the same time. Like with `HttpServer`,
+    the received messages are sent to the main thread through a queue, and
+    the responses are sent back to the thread of the connection.
+
     Attributes
     ----------
-    connected : bool
-        Indicate whether the socket has an active connection.
     sock : socket.socket
         The socket for the tcp server.
-    conn : socket.socket
-        Established connection of the client via tcp.
-    addr : tuple[str, int]
-        Contain the ip address and port of the connected client.
+    q_get : queue.Queue | lanes.Scheduler
+        The queue, that sends the received messages from the threads of the
+        connections to the main thread, or the lanes of the scheduler.
+    reply : queue.Queue
+        The queue, that sends the response to the thread of the connection,
+        that received the last message.
+    addr : tuple[str, int] | str
+        Contain the ip address and port (or the path of the unix socket) of
+        the client, that sent the last message.
     msg_meth : None | message.Message
-        The meta message class, that can handle message.MessageXml and
-        message.MessageJson. Also determines the type of the message.
+        The meta message class, that can handle message.MessageXml,
+        message.MessageJson and message.MessageFrame. Also determines the
+        type of the last message.
+    meta : dict
+        The meta fields (keys starting with `nap_`) of the last message.
+    compress_level : int
+        The zlib compression level for frames. 0: Never compress.
+    compress_min_size : int
+        The minimum size in bytes of a frame to be compressed.
+    instrument : None | instrument.Instrumentation
+        The instrumentation, that records the stage boundaries of every request.
+    rec : None | instrument.Record
+        The record of the last message, None without instrumentation.
+    load : health.Load
+        The requests, that wait for the main thread or are in flight, and
+        the limits of the admission control.
+    stamp : float
+        The time (`time.monotonic`), when the last message was received.
+    limits : None | Limits
+        The limits of every connection, e.g. timeouts and the maximum message size.
+    lanes : None | lanes.Scheduler
+        The lanes and rate limits of the requests, None: One queue in the
+        order of arrival.
+    closing : bool
+        Whether the accept loop stops, see `close`.
+    flush_size : int
+        The bytes of responses to pipelined messages, that a connection
+        keeps at most, see `Output`.
+    flush_count : int
+        The responses to pipelined messages, that a connection keeps at most.
 
     """
 
-    def __init__(self, ip: str, port: int) -> None:
+    def __init__(self, ip: str, port: int, compress_level: int = 0,
+                 compress_min_size: int = 1024, unix: t.Union[None, str] = None,
+                 instrument: t.Union[None, Instrumentation] = None, load: t.Union[None, Load] = None,
+                 limits: t.Union[None, Limits] = None, lanes: t.Union[None, Scheduler] = None,
+                 fd: t.Union[None, int] = None, flush_size: int = FLUSH_SIZE,
+                 flush_count: int = FLUSH_COUNT) -> None:
         """Initialize the socket as server to accept tcp connections from clients.
 
         Parameters
@@ -37,75 +218,372 @@ class TcpSocketServer:
             The ip address, where the socket should listen.
         port
             The port, where the socket should listen.
+        compress_level
+            The zlib compression level for frames of clients, that accept
+            compression. 0: Never compress.
+        compress_min_size
+            The minimum size in bytes of a frame to be compressed.
+        unix
+            None: Listen on `ip` and `port`.
+            str: Listen on the unix socket with this path instead.
+        instrument
+            The instrumentation, that records the stage boundaries of every request.
+        load
+            The load with the limits of the admission control, see `health.Load`.
+            None: No limits.
+        limits
+            The limits of every connection. None: No limits.
+        lanes
+            The lanes, that the main thread takes the messages from by
+            weighted round robin, and the rate limits of the clients.
+            None: One queue in the order of arrival.
+        fd
+            None: Bind the socket to `ip` and `port` or `unix`.
+            int: The file descriptor of an inherited socket, that already
+            listens, e.g. from the previous process, see `restart.Restart`.
+        flush_size
+            The bytes of responses to pipelined messages, that a connection
+            keeps at most, before it sends them with one system call.
+        flush_count
+            The responses to pipelined messages, that a connection keeps at
+            most. 1: Send every response at once.
+
+        """
+        self.compress_level = compress_level
+        self.compress_min_size = compress_min_size
+        self.instrument = instrument
+        self.load = load if load is not None else Load()
+        self.limits = limits
+        self.lanes = lanes
+        self.q_get = lanes if lanes is not None else Queue(maxsize=1)  # type: t.Union[Queue, Scheduler]
+        self.msg_meth = None  # type: t.Union[None, Message]
+        self.meta = {}  # type: dict
+        self.rec = None  # type: t.Union[None, Record]
+        self.stamp = 0.0
+        self.closing = False
+        self.flush_size = flush_size
+        self.flush_count = flush_count
+
+        if fd is not None:
+            self.sock = socket.socket(fileno=fd)
+        elif unix is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.bind((ip, port))
+        else:
+            if os.path.exists(unix) and stat.S_ISSOCK(os.stat(unix).st_mode):
+                os.unlink(unix)  # left over from a previous run
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(unix)
+        if fd is None:
+            self.sock.listen()
+        self.sock.settimeout(ACCEPT_INTERVAL)  # the accepted connections still block
+
+        self.thrd_serve = Thread(target=self.serve, daemon=True)
+        self.thrd_serve.start()
+
+    def serve(self) -> None:
+        """Daemon thread, that accepts the connections of the clients until `close`."""
+        while not self.closing:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.timeout:
+                continue
+            self.load.accepted()
+            thrd_conn = Thread(target=self.handle, args=(conn, addr), daemon=True)
+            thrd_conn.start()
+        self.sock.close()  # not `shutdown`, the socket may be shared with the next process
+
+    def close(self) -> None:
+        """Stop accepting connections and wait for the accept loop, the open connections are still served."""
+        self.closing = True
+        self.thrd_serve.join()
+
+    def fileno(self) -> int:
+        """Return the file descriptor of the listening socket, e.g. for the next process."""
+        return self.sock.fileno()
+
+    def handle(self, conn: socket.socket, addr: t.Any) -> None:
+        """Daemon thread, that serves one connection until it is closed.
+
+        The messages of the connection are received one after another. The
+        client may send the next message before it received the response to
+        the previous message (pipelining), the responses keep the order.
+        Nagle's algorithm is disabled, and the responses to pipelined
+        messages, that are ready at the same time, are sent together, see
+        `Output`.
+
+        Parameters
+        ----------
+        conn
+            Established connection of the client.
+        addr
+            The address of the client.
 
         """
-        self.connected = False
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.bind((ip, port))
-        self.sock.listen(1)
+        data = bytearray()
+        reply = Queue(maxsize=1)  # type: Queue
+        rec = None  # type: t.Union[None, Record]
+        messages = 0
+        out = Output(conn, self.flush_size, self.flush_count)
+        with conn:
+            try:
+                nodelay(conn)
+                while True:
+                    if self.limits is not None and self.limits.max_messages and messages >= self.limits.max_messages:
+                        return
+                    messages += 1
+                    if self.instrument is not None:
+                        rec = self.instrument.record()
+                    msg = self.recv_msg(conn, data, rec, self.limits, out)
+                    if messages == 1:
+                        self.load.greeted()
+                    if msg is None:
+                        return
+                    msg_meth, msg_data = msg
+                    if rec is not None:
+                        rec.mark("received")
+                        rec.bytes_in = len(msg_data)
+                    lane = None  # type: t.Union[None, str]
+                    client = ""
+                    payload = msg_data  # type: t.Union[bytearray, tuple]
+                    if self.lanes is not None:
+                        payload, lane, client = self.classify(self.lanes, msg_meth, msg_data, addr)
+                    reason = admit(self.load, self.lanes, lane, client)
+                    if reason is None:
+                        try:
+                            out.flush()  # never held, while the main thread runs `func`
+                        except OSError:
+                            pass  # the connection is broken, which the response finds out
+                        item = (msg_meth, payload, addr, reply, rec, self.load.stamp())
+                        if self.lanes is not None:
+                            self.lanes.put(item, lane, client)
+                        else:
+                            self.q_get.put(item)
+                        autoformat, response, exception, extra = reply.get()
+                    else:  # rejected without the main thread
+                        autoformat, response, exception, extra = True, "", reason, self.echo(msg_meth, msg_data)
+                        if rec is not None:
+                            rec.error = True
+                    # kept, while the next message is already there, see `Output`
+                    ok = self.send_msg_to(out, msg_meth, autoformat, response, exception, extra, rec, not data)
+                    if reason is None:  # counted in flight until the response was sent
+                        self.load.answered()
+                        if lane is not None:
+                            t.cast(Scheduler, self.lanes).answered(lane)
+                    if rec is not None:
+                        rec.error |= not ok
+                        rec.sent()
+                    if not ok or self.load.draining:  # the client reconnects to the next process
+                        return
+            finally:
+                try:
+                    out.flush()  # the responses to the last pipelined messages
+                except OSError:
+                    pass
 
-    def disconnect(self) -> t.Literal[False]:
-        """Tell the `TcpSocketServer` instance, that no client is connected.
+    @staticmethod
+    def classify(lanes: Scheduler, msg_meth: Message, data: bytearray,
+                 addr: t.Any) -> t.Tuple[t.Union[bytearray, tuple], str, str]:
+        """Decode a message in the thread of its connection to find its lane and client.
 
         Returns
         -------
-        False
-            Indicate that a disconnection had taken place.
+        The decoded fields and meta fields of the message for `get_msg`, the
+        lane and the client. A message, that cannot be decoded, stays as it
+        is in the lane `default`, so the main thread sends the exception.
 
         """
-        self.conn.close()
-        self.connected = False
-        return False
+        try:
+            decoded = Message.split_meta(msg_meth._to_dict(data))
+        except Exception:
+            return data, DEFAULT_LANE, lanes.client({}, addr)
+        return decoded, lanes.lane(decoded[1]), lanes.client(decoded[1], addr)
 
-    def get_msg(self) -> t.Union[t.Literal[False], list]:
-        """Receive the message that was sent from the client to the tcp server.
+    @staticmethod
+    def echo(msg_meth: Message, data: bytearray) -> dict:
+        """Return the extra fields of the envelope for a message, that is not handed to the main thread."""
+        try:
+            return Message.echo(Message.split_meta(msg_meth._to_dict(data))[1])
+        except Exception:
+            return {}
+
+    @staticmethod
+    def recv_msg(conn: socket.socket, data: bytearray, rec: t.Union[None, Record] = None,
+                 limits: t.Union[None, Limits] = None,
+                 out: t.Union[None, Output] = None) -> t.Union[None, t.Tuple[Message, bytearray]]:
+        """Receive the next message of the connection.
 
         Loop through the received message and wait until the client has sent
-        the complete message. A break of the connection is handled in the
-        exception, otherwise the received message is processed and converted
-        into a valid `parser` string.
+        the complete message. Bytes of the following message are kept in
+        `data` for the next call. Without limits, the socket blocks.
+
+        Parameters
+        ----------
+        conn
+            Established connection of the client.
+        data
+            The bytes, that were received, but not processed so far.
+        rec
+            The record of the message, that gets the `recv` boundary, when
+            the first bytes of the message are there.
+        limits
+            The timeouts and the maximum message size of the connection.
+        out
+            The kept responses of the connection, that are sent, before it
+            waits for the client.
 
         Returns
         -------
-        False: Something went wrong during receiving the message.
-        str: Argument(s) for the main `parser` of `NetArgumentParser`.
+        None: The connection was closed or broken, the message is in an
+              unknown format or violates a limit.
+        tuple: The message class and the complete message.
 
         """
-        if not self.connected:
-            self.conn, self.addr = self.sock.accept()
-            self.connected = True
-
-        data = io.BytesIO()
-        self.msg_meth = None
+        msg_meth = None
+        started = 0.0
         try:
             while True:
-                recv = self.conn.recv(256)
+                if not msg_meth:
+                    del data[:len(data) - len(data.lstrip())]
+                    if len(data) >= 5 or data[:1] == b"{":  # enough to detect the type
+                        msg_meth = Message(bytes(data[:5]))
+                        if limits is not None and isinstance(msg_meth.msg_meth, MessageFrame):
+                            msg_meth.msg_meth.max_size = limits.max_message_size
+                        if rec is not None:
+                            rec.mark("recv")
+                if msg_meth:
+                    length = msg_meth._msg_len(data)
+                    if length:
+                        if limits is not None and limits.max_message_size and length > limits.max_message_size:
+                            raise Exception(f"Message exceeds {limits.max_message_size} bytes.")
+                        msg = data[:length]
+                        del data[:length]
+                        if limits is not None and conn.gettimeout() is not None:
+                            conn.settimeout(None)  # the response is sent without a timeout
+                        return msg_meth, msg
+
+                if out is not None:
+                    out.flush()  # the client may wait for them
+                if limits is not None:
+                    if not data:
+                        conn.settimeout(limits.idle_timeout or None)
+                    else:  # the message is incomplete, so `data` only has bytes of this message
+                        if limits.max_message_size and len(data) > limits.max_message_size:
+                            raise Exception(f"Message exceeds {limits.max_message_size} bytes.")
+                        if not started:
+                            started = time.monotonic()
+                        if limits.read_timeout:
+                            remaining = limits.read_timeout - (time.monotonic() - started)
+                            if remaining <= 0:
+                                return None
+                            conn.settimeout(remaining)
+                        else:
+                            conn.settimeout(None)
+                recv = conn.recv(65536)
                 if not recv:
-                    return self.disconnect()
+                    return None
+                data += recv
 
-                if not self.msg_meth:
-                    self.msg_meth = Message(recv)
+        except socket.timeout:
+            return None  # idle or slow connection
+        except Exception as e:
+            print(e)
+            return None
 
-                data.write(recv)
+    def get_msg(self) -> t.Union[t.Literal[False], list]:
+        """Receive the next message, that was sent from a client to the tcp server.
 
-                if self.msg_meth._end_of_msg(data.getvalue()):
-                    break
+        Wait until one of the threads of the connections received a complete
+        message, which is processed and converted into a valid `parser` string.
 
-        except Exception as e:
-            print(e)
-            return self.disconnect()
+        Raises
+        ------
+        Exception
+            When the message waited too long for the main thread, see
+            `health.Load.waited`. The exception is sent as response.
+
+        Returns
+        -------
+        False: The main thread was woken up without a message, see `wakeup`.
+        list: Argument(s) for the main `parser` of `NetArgumentParser`.
 
+        """
+        self.load.started = True
+        item = self.q_get.get()
+        if item is None:
+            return False
+        self.load.dequeued()
+        self.msg_meth, data, self.addr, self.reply, self.rec, self.stamp = item
+        if self.rec is not None:
+            self.rec.mark("dequeued")
+        self.meta = {}
+        if isinstance(data, tuple):  # decoded by the thread of the connection, see `classify`
+            d, self.meta = data
         else:
-            data_str = data.getvalue().decode("utf-8")
-            d = self.msg_meth._to_dict(data_str)
-            return Message.dict_to_argslist(d)
+            d, self.meta = Message.split_meta(self.msg_meth._to_dict(data))
+        if isinstance(self.msg_meth.msg_meth, MessageFrame) and self.msg_meth.attachment is not None:
+            self.meta["nap_attachment"] = self.msg_meth.attachment
+        args = Message.dict_to_argslist(d)
+        if self.rec is not None:
+            self.rec.mark("decoded")
+        self.load.waited(self.stamp)
+        return args
+
+    def detach(self) -> t.Callable[..., None]:
+        """Return a function, that sends the response to the last message later.
 
-    def send_msg(self, autoformat: bool, response: t.Union[dict, str],
-                 exception: str) -> None:
+        The main thread can go on with the next messages, while the thread
+        of the connection waits for the response, e.g. to a profiling window.
+        The function takes the same arguments as `send_msg`.
+        """
+        reply = self.reply
+        return lambda *response: reply.put(response)
+
+    def wakeup(self) -> None:
+        """Let the waiting `get_msg` of the main thread return False."""
+        self.q_get.put(None)
+
+    def send_msg(self, autoformat: bool, response: t.Union[dict, str, bytes, FileResponse],
+                 exception: str, extra: t.Union[None, dict] = None) -> None:
+        """Send the response to the thread of the connection, that received the message.
+
+        Parameters
+        ----------
+        autoformat
+            True: The return of the function `func` can be a dict or str and is
+                  automatically formatted to a valid xml or json format as response
+                  in nap mode.
+            False: The return of the function `func` is handed "as is" as response
+                   in nap mode. The function `func` is required to form a valid
+                   response.
+        response
+            The information that should be sent in the response section or
+            the binary attachment.
+        exception
+            The information that should be sent in the exception section.
+        extra
+            Further fields of the envelope, e.g. the echoed `id`, see `Message.echo`.
+
+        """
+        self.reply.put((autoformat, response, exception, extra))
+
+    def send_msg_to(self, out: Output, msg_meth: Message, autoformat: bool,
+                    response: t.Union[dict, str, bytes, FileResponse], exception: str,
+                    extra: t.Union[None, dict] = None, rec: t.Union[None, Record] = None,
+                    flush: bool = True) -> bool:
         """Send a message to the client.
 
+        A binary response to a frame is sent as attachment right after the
+        envelope, without copying it into the message. A json or xml message
+        gets an exception instead of a binary response. A `FileResponse` is
+        streamed with `socket.sendfile` and is never compressed.
+
         Parameters
         ----------
+        out
+            The write buffer of the connection of the client.
+        msg_meth
+            The message class of the received message.
         autoformat
             True: The return of the function `func` can be a dict or str and is
                   automatically formatted to a valid xml or json format as response
@@ -114,45 +592,145 @@ class TcpSocketServer:
                    in nap mode. The function `func` is required to form a valid
                    response.
         response
-            The information that should be sent in the response section.
+            The information that should be sent in the response section or
+            the binary attachment.
         exception
             The information that should be sent in the exception section.
+        extra
+            Further fields of the envelope, e.g. the echoed `id`, see `Message.echo`.
+        rec
+            The record of the message, that gets the `formatted` boundary.
+        flush
+            False: Keep the message in `out`, until a threshold is reached,
+            e.g. while the next message is already received.
+
+        Returns
+        -------
+        Whether the message was sent or kept. False: The connection is broken.
 
         """
         try:
-            if not self.msg_meth:
-                raise Exception("`msg_meth` was `None` when `send_msg` was called.")
+            if isinstance(response, FileResponse):
+                if rec is not None:
+                    rec.mark("formatted")
+                self.send_file(out, msg_meth, response, exception, extra)
+                if rec is not None:
+                    rec.bytes_out = response.size
+            elif isinstance(msg_meth.msg_meth, MessageFrame):
+                bufs = msg_meth._frame(autoformat, response, exception,
+                                       self.compress_level, self.compress_min_size, extra)
+                if rec is not None:
+                    rec.mark("formatted")
+                    rec.bytes_out = sum(memoryview(buf).nbytes for buf in bufs)
+                out.add(*bufs)
             else:
-                msg = self.msg_meth._format(autoformat, response, exception)
-                self.conn.sendall(msg)
+                if isinstance(response, BINARY):
+                    response, exception = "", "Binary responses need a frame."
+                msg = msg_meth._format(autoformat, response, exception, extra)
+                if rec is not None:
+                    rec.mark("formatted")
+                    rec.bytes_out = len(msg)
+                out.add(msg)
+            if flush or out.full():
+                out.flush()
         except Exception as e:
             print(e)
-            self.disconnect()
+            return False
+        return True
+
+    def send_file(self, out: Output, msg_meth: Message, response: FileResponse,
+                  exception: str, extra: t.Union[None, dict] = None) -> None:
+        """Stream the file of the response to the client.
+
+        In a frame, the file is the attachment. In a json or xml message, the
+        content of the file is put "as is" in the response section. The kept
+        responses and the head are sent before the file, the tail is kept.
+
+        Parameters
+        ----------
+        out
+            The write buffer of the connection of the client.
+        msg_meth
+            The message class of the received message.
+        response
+            The file, that should be sent in the response section.
+        exception
+            The information that should be sent in the exception section.
+        extra
+            Further fields of the envelope, e.g. the echoed `id`, see `Message.echo`.
+
+        """
+        try:
+            f = response.open()
+        except OSError as e:
+            out.add(msg_meth._format(False, "", str(e), extra))
+            return
+
+        try:
+            if isinstance(msg_meth.msg_meth, MessageFrame):
+                out.add(msg_meth._format(False, response, exception, extra))
+                out.flush()
+                out.conn.sendfile(f, count=response.size)
+            else:
+                head, tail = msg_meth._envelope(exception, extra)
+                out.add(head)
+                out.flush()
+                out.conn.sendfile(f, count=response.size)
+                out.add(tail)
+        finally:
+            response.close(f)
 
 
 class HttpServer:
     """The script in nap mode accepts http get requests with url parameters.
 
     The url parameters are processed and converted to the script arguments for
-    the main `parser` of `NetArgumentParser`.
+    the main `parser` of `NetArgumentParser`. The body of a post request is
+    passed as binary attachment.
 
     Attributes
     ----------
-    q_get : queue.Queue
+    q_get : queue.Queue | lanes.Scheduler
         The queue, that sends and receives the message received by the client
-        from the http.server daemon thread to the main thread.
-    q_send : queue.Queue
+        from the http.server daemon threads to the main thread, or the lanes
+        of the scheduler.
+    reply : queue.Queue
         The queue, that sends and receives the message from `NetArgumentParser`
-        from the main thread to the http.server daemon thread.
+        from the main thread to the http.server daemon thread, that received
+        the last request.
+    meta : dict
+        The meta fields (url parameters starting with `nap_`) of the last request.
+    instrument : None | instrument.Instrumentation
+        The instrumentation, that records the stage boundaries of every request.
+    rec : None | instrument.Record
+        The record of the last request, None without instrumentation.
+    load : health.Load
+        The requests, that wait for the main thread or are in flight, and
+        the limits of the admission control.
+    stamp : float
+        The time (`time.monotonic`), when the last message was received.
+    limits : None | Limits
+        The limits of every connection, e.g. timeouts and the maximum message size.
+    lanes : None | lanes.Scheduler
+        The lanes and rate limits of the requests, None: One queue in the
+        order of arrival.
+    httpd : None | http.server.ThreadingHTTPServer
+        The http.server, once its daemon thread started.
 
     """
 
-    def __init__(self, ip: str, port: int) -> None:
+    def __init__(self, ip: str, port: int, compress_level: int = 0,
+                 compress_min_size: int = 1024,
+                 instrument: t.Union[None, Instrumentation] = None, load: t.Union[None, Load] = None,
+                 limits: t.Union[None, Limits] = None, functions: t.Collection[str] = (),
+                 lanes: t.Union[None, Scheduler] = None, fd: t.Union[None, int] = None) -> None:
         """Initialize http.server as daemon thread to accept http get requests.
 
         http.server is started as daemon thread and the url parameters are sent
         to the main thread through queues for converting them into the argument
-        string, that is needed for the main `parser`.
+        string, that is needed for the main `parser`. Every connection is
+        served by its own thread and kept alive (HTTP/1.1), so clients can
+        reuse their connections.
 
         Parameters
         ----------
@@ -160,15 +738,50 @@ class HttpServer:
             The ip address, where http.server should listen.
         port
             The port, where the socket should listen.
+        compress_level
+            The zlib compression level for responses to clients, that accept
+            gzip or deflate. 0: Never compress.
+        compress_min_size
+            The minimum size in bytes of a response to be compressed.
+        instrument
+            The instrumentation, that records the stage boundaries of every request.
+        load
+            The load with the limits of the admission control and the queue
+            depth for `/readyz`, see `health.Load`. None: No limits.
+        limits
+            The limits of every connection. The socket timeout of a
+            connection is the shorter of `idle_timeout` and `read_timeout`,
+            and a larger body is answered with 413. None: No limits.
+        functions
+            The names of the further functions, that are served at
+            `/<name>` and `/<name>/xml`, see `NetArgumentParser.add_function`.
+        lanes
+            The lanes, that the main thread takes the requests from by
+            weighted round robin, and the rate limits of the clients.
+            None: One queue in the order of arrival.
+        fd
+            None: Bind the socket to `ip` and `port`.
+            int: The file descriptor of an inherited socket, that already
+            listens, e.g. from the previous process, see `restart.Restart`.
 
         """
-        self.q_get = Queue(maxsize=1)  # type: Queue
-        self.q_send = Queue(maxsize=1)  # type: Queue
+        self.lanes = lanes
+        self.httpd = None  # type: t.Union[None, http.server.ThreadingHTTPServer]
+        self.q_get = lanes if lanes is not None else Queue(maxsize=1)  # type: t.Union[Queue, Scheduler]
+        self.meta = {}  # type: dict
+        self.instrument = instrument
+        self.load = admission = load if load is not None else Load()
+        self.limits = limits
+        conn_timeout = min([sec for sec in (limits.idle_timeout, limits.read_timeout) if sec] or [0]) if limits else 0
+        max_message_size = limits.max_message_size if limits is not None else 0
+        max_messages = limits.max_messages if limits is not None else 0
+        self.rec = None  # type: t.Union[None, Record]
+        self.stamp = 0.0
 
-        def serve(q_get: Queue, q_send: Queue) -> None:
+        def serve(q_get: t.Union[Queue, Scheduler]) -> None:
             """Daemon thread, that is running http.server."""
             def msg_handler(autoformat: bool, response: t.Union[dict, str],
-                            exception: str,
+                            exception: str, extra: t.Union[None, dict],
                             message_method: t.Union[t.Type[MessageJson], t.Type[MessageXml]]) -> bytes:
                 """Format the message to the client either as json or xml.
 
@@ -185,6 +798,8 @@ class HttpServer:
                     The information that should be sent in the response section.
                 exception
                     The information that should be sent in the exception section.
+                extra
+                    Further fields of the envelope, see `Message.echo`.
                 message_method
                     Either MessageJson for json output or
                     MessageXml for xml output.
@@ -196,60 +811,371 @@ class HttpServer:
 
                 """
                 msg_meth = message_method()
-                msg = msg_meth._format(autoformat, response, exception)
+                msg = msg_meth._format(autoformat, response, exception, extra)
                 return msg
 
+            class HttpRequestServer(http.server.ThreadingHTTPServer):
+                def verify_request(self, request: t.Any, client_address: t.Any) -> bool:
+                    admission.accepted()  # in the accept loop, so a drain also waits for the last connections
+                    return True
+
             class HttpRequestHandler(http.server.BaseHTTPRequestHandler):
+                protocol_version = "HTTP/1.1"
+                timeout = conn_timeout or None  # socket timeout of the connection, see `StreamRequestHandler`
+
+                rec = None  # type: t.Union[None, Record]
+                messages = 0
+
+                def setup(self) -> None:
+                    super().setup()
+                    nodelay(self.connection)  # headers and body are written separately
+
                 def do_GET(self) -> None:  # noqa: N802 - is defined by BaseHTTPRequestHandler
+                    if instrument is not None:
+                        self.rec = instrument.record()
+                        self.rec.mark("recv")
+                    self.handle_args(None)
+
+                def do_POST(self) -> None:  # noqa: N802 - is defined by BaseHTTPRequestHandler
+                    if instrument is not None:
+                        self.rec = instrument.record()
+                        self.rec.mark("recv")
+                    length = self.headers.get("Content-Length", "")
+                    if not length.isdigit():  # missing, not a number or negative, so the body cannot be read
+                        self.reject(400)
+                    elif max_message_size and int(length) > max_message_size:
+                        self.reject(413)
+                    else:
+                        self.handle_args(self.rfile.read(int(length)))
+
+                def reject(self, code: int) -> None:
+                    """Answer the post request with the error code, without reading its body, and close the connection."""
+                    self.rec = None
+                    self.close_connection = True
+                    self.send_response(code)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+
+                def handle_args(self, attachment: t.Union[None, bytes]) -> None:
+                    """Put the url parameters and the body as attachment in the queue.
+
+                    A binary return of the function `func` is sent as
+                    `application/octet-stream` and a `FileResponse` is
+                    streamed with `socket.sendfile` instead of json or xml.
+                    With `Metrics` as instrumentation, `/metrics` is answered
+                    directly without the queues, like `/healthz` and
+                    `/readyz`, see `health.Load`. A request over the limits
+                    of the admission control gets 503 and `Retry-After`.
+                    `/<name>` and `/<name>/xml` call the further function
+                    `name` (meta field `nap_func`). `/_nap/profile` and
+                    `/_nap/tracemalloc` are control messages (`nap_cmd`), whose
+                    url parameters are the meta fields without `nap_`, and
+                    their report is sent as plain text.
+
+                    Parameters
+                    ----------
+                    attachment
+                        None: The request is a get request without body.
+                        bytes: The body of the post request.
+
+                    """
+                    self.messages += 1
+                    if self.messages == 1:
+                        admission.greeted()
+                    if max_messages and self.messages >= max_messages:
+                        self.close_connection = True
                     full_path = urllib.parse.urlparse(self.path)
                     path = full_path.path
-                    args = urllib.parse.parse_qs(full_path.query, keep_blank_values=True)
-
-                    if path == "/" or path == "/xml":
-                        resp_code = 200
-                        q_get.put(args)
-                        r = q_send.get()  # type: tuple[t.Any, t.Any, t.Any]
-                        if path == "/":
-                            content_type = "application/json"
-                            resp = msg_handler(*r, MessageJson)
+                    name = path[1:-4] if path.endswith("/xml") else path[1:]  # of a further function
+                    args = urllib.parse.parse_qs(full_path.query, keep_blank_values=True)  # type: t.Dict[str, list]
+                    if attachment is not None:
+                        args["nap_attachment"] = [memoryview(attachment)]
+
+                    if path == "/metrics" and isinstance(instrument, Metrics):
+                        # answered by this thread, the main function is not involved
+                        self.rec = None
+                        self.send_body(METRICS_CONTENT_TYPE, instrument.render())
+                    elif path in HEALTH_PATHS:
+                        self.rec = None
+                        code, body = admission.report(path)
+                        self.send_body("application/json", body, code)
+                    elif path == "/" or path == "/xml" or path in ADMIN_PATHS or name in functions:
+                        if name in functions:
+                            args["nap_func"] = [name]
+                        elif path in ADMIN_PATHS:
+                            args = {key if key.startswith("nap_") else "nap_" + key: val
+                                    for key, val in args.items()}
+                            args["nap_cmd"] = [ADMIN_PATHS[path]]
+                        if self.rec is not None:
+                            self.rec.mark("received")
+                            self.rec.bytes_in = len(self.path) + (len(attachment) if attachment is not None else 0)
+                        reply = Queue(maxsize=1)  # type: Queue
+                        lane = None  # type: t.Union[None, str]
+                        client = ""
+                        if lanes is not None:
+                            meta = Message.split_meta(args)[1]
+                            lane, client = lanes.lane(meta), lanes.client(meta, self.client_address)
+                        reason = admit(admission, lanes, lane, client)
+                        if reason is None:
+                            item = (args, reply, self.rec, admission.stamp())
+                            if lanes is not None:
+                                lanes.put(item, lane, client)
+                            else:
+                                q_get.put(item)
+                            r = reply.get()  # type: tuple[t.Any, t.Any, t.Any, t.Any]
+                        else:  # rejected without the main thread
+                            r = (True, "", reason, Message.echo(Message.split_meta(args)[1]))
+                            if self.rec is not None:
+                                self.rec.error = True
+                        if admission.draining:
+                            self.close_connection = True  # the client reconnects to the next process
+                        try:
+                            self.respond(path, r)
+                        finally:
+                            if reason is None:  # counted in flight until the response was sent
+                                admission.answered()
+                                if lanes is not None and lane is not None:
+                                    lanes.answered(lane)
+                    else:
+                        self.send_response(400)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+
+                def respond(self, path: str, r: t.Tuple[t.Any, t.Any, t.Any, t.Any]) -> None:
+                    """Send the response from the main thread, as json, xml, plain text, binary or file."""
+                    if isinstance(r[1], FileResponse) and not r[2]:
+                        try:
+                            f = r[1].open()
+                        except OSError as e:
+                            r = (r[0], "", str(e), r[3])
                         else:
-                            content_type = "application/xml; charset=utf-8"
-                            resp = msg_handler(*r, MessageXml)
+                            if self.rec is not None:
+                                self.rec.mark("formatted")
+                                self.rec.bytes_out = r[1].size
+                            self.send_file(r[1], f)
+                            if self.rec is not None:
+                                self.rec.sent()
+                            return
+                    if isinstance(r[1], BINARY) and not r[2]:
+                        content_type = "application/octet-stream"
+                        resp = r[1]
+                    elif path in ADMIN_PATHS and isinstance(r[1], dict) and not r[2]:
+                        content_type = "text/plain; charset=utf-8"
+                        resp = r[1]["stats"].encode("utf-8")
+                    elif path.endswith("/xml"):
+                        content_type = "application/xml; charset=utf-8"
+                        resp = msg_handler(*r, MessageXml)
                     else:
-                        resp_code = 400
-                        resp = "".encode("utf-8")
+                        content_type = "application/json"
+                        resp = msg_handler(*r, MessageJson)
+                    if self.rec is not None:
+                        self.rec.mark("formatted")
+                        self.rec.bytes_out = memoryview(resp).nbytes
+                    self.send_body(content_type, resp, 503 if r[2].startswith(OVERLOADED) else 200)
+                    if self.rec is not None:
+                        self.rec.sent()
+
+                def finish(self) -> None:
+                    """Count the connection as greeted, when it is closed without a request."""
+                    if not self.messages:
+                        admission.greeted()
+                    super().finish()
+
+                def end_headers(self) -> None:
+                    """Tell the client, when the connection is closed after the response.
 
-                    self.send_response(resp_code)
+                    With compression every response varies with the `Accept-Encoding`,
+                    also an uncompressed one, so that caches do not mix them up.
+                    """
+                    if compress_level:
+                        self.send_header("Vary", "Accept-Encoding")
+                    if self.close_connection and self.request_version == "HTTP/1.1":
+                        self.send_header("Connection", "close")
+                    super().end_headers()
 
-                    if resp_code == 200:
-                        self.send_header("Content-Type", content_type)
-                        self.send_header("Content-Length", str(len(resp)))
+                def send_body(self, content_type: str, resp: t.Union[bytes, bytearray, memoryview],
+                              code: int = 200) -> None:
+                    """Send the response, compressed if negotiated with the client.
 
+                    A rejected request (503) tells the client, when to retry.
+                    """
+                    view = memoryview(resp).cast("B")
+                    coding = self.encoding(view.nbytes)
+
+                    self.send_response(code)
+                    self.send_header("Content-Type", content_type)
+                    if code == 503:
+                        self.send_header("Retry-After", str(RETRY_AFTER))
+                    if coding:
+                        self.send_compressed(coding, (view[i:i + 65536] for i in range(0, view.nbytes, 65536)))
+                    else:
+                        self.send_header("Content-Length", str(view.nbytes))
+                        self.end_headers()
+                        self.wfile.write(resp)
+
+                def send_file(self, response: FileResponse, f: t.BinaryIO) -> None:
+                    """Stream the opened file of the response as body."""
+                    try:
+                        coding = self.encoding(response.size)
+
+                        self.send_response(200)
+                        self.send_header("Content-Type", response.content_type)
+                        if coding:
+                            self.send_compressed(coding, iter(lambda: f.read(65536), b""))
+                        else:
+                            self.send_header("Content-Length", str(response.size))
+                            self.end_headers()
+                            self.connection.sendfile(f, count=response.size)
+                    finally:
+                        response.close(f)
+
+                def encoding(self, size: int) -> t.Union[None, str]:
+                    """Negotiate the content encoding with the `Accept-Encoding` of the client.
+
+                    The q-values rank `gzip` and `deflate`, on a tie `gzip` wins, and
+                    `*` stands for the codings, that are not listed. A coding with
+                    `q=0` is never used. The response is sent uncompressed, when it is
+                    smaller than `compress_min_size` or the client prefers `identity`
+                    explicitly, unless `identity;q=0` (or `*;q=0`) forbids it.
+
+                    Parameters
+                    ----------
+                    size
+                        The size of the uncompressed response in bytes.
+
+                    Returns
+                    -------
+                    None: The response is not compressed.
+                    str: `gzip` or `deflate`.
+
+                    """
+                    if not compress_level:
+                        return None
+                    accepted = {}  # type: t.Dict[str, float]
+                    for item in self.headers.get("Accept-Encoding", "").split(","):
+                        coding, *params = item.split(";")
+                        coding = coding.strip().lower()
+                        if not coding:
+                            continue
+                        q = 1.0
+                        for param in params:
+                            name, _, value = param.partition("=")
+                            if name.strip().lower() == "q":
+                                try:
+                                    q = min(max(float(value), 0.0), 1.0)
+                                except ValueError:
+                                    q = 0.0
+                        accepted[coding] = q
+                    star = accepted.get("*", 0.0)
+                    identity = accepted.get("identity", 1.0 if "*" not in accepted else star)
+                    coding = max(("gzip", "deflate"), key=lambda c: accepted.get(c, star))
+                    q = accepted.get(coding, star)
+                    if q <= 0:
+                        return None
+                    if identity > 0 and (size < compress_min_size or ("identity" in accepted and identity > q)):
+                        return None
+                    return coding
+
+                def send_compressed(self, coding: str, chunks: t.Iterable[t.Any]) -> None:
+                    """End the headers and stream the compressed chunks as body.
+
+                    The compressed size is not known in advance, so the body
+                    is sent with chunked transfer encoding (HTTP/1.1) or ends
+                    with the connection (HTTP/1.0) instead of `Content-Length`.
+                    """
+                    comp = zlib.compressobj(compress_level, zlib.DEFLATED, 31 if coding == "gzip" else 15)
+                    chunked = self.request_version == "HTTP/1.1"
+                    self.send_header("Content-Encoding", coding)
+                    if chunked:
+                        self.send_header("Transfer-Encoding", "chunked")
+                    else:
+                        self.send_header("Connection", "close")
+                        self.close_connection = True
                     self.end_headers()
-                    self.wfile.write(resp)
+                    for chunk in chunks:
+                        self.write_chunk(comp.compress(chunk), chunked)
+                    self.write_chunk(comp.flush(), chunked)
+                    if chunked:
+                        self.wfile.write(b"0\r\n\r\n")
+
+                def write_chunk(self, data: bytes, chunked: bool) -> None:
+                    """Write the data as body, in chunked transfer encoding if requested."""
+                    if not data:
+                        return
+                    if chunked:
+                        self.wfile.write(b"%x\r\n%b\r\n" % (len(data), data))
+                    else:
+                        self.wfile.write(data)
 
-            httpd = http.server.HTTPServer((ip, port), HttpRequestHandler)
+            httpd = HttpRequestServer((ip, port), HttpRequestHandler, bind_and_activate=fd is None)
+            if fd is not None:
+                adopt(httpd, fd)
+            self.httpd = httpd
             httpd.serve_forever()
 
-        thrd_serve = Thread(target=serve, args=(self.q_get, self.q_send), daemon=True)
+        thrd_serve = Thread(target=serve, args=(self.q_get,), daemon=True)
         thrd_serve.start()
 
-    def get_msg(self) -> list:
+    def close(self) -> None:
+        """Stop accepting connections, the open connections are still served."""
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()  # not `shutdown`, the socket may be shared with the next process
+
+    def fileno(self) -> int:
+        """Return the file descriptor of the listening socket, e.g. for the next process."""
+        return t.cast(http.server.ThreadingHTTPServer, self.httpd).fileno()
+
+    def get_msg(self) -> t.Union[t.Literal[False], list]:
         """Receive the message that was sent from the client to the http server.
 
         Receive the message as dict from the daemon thread via the queue and
         return the corresponding argument string for the main `parser`.
 
+        Raises
+        ------
+        Exception
+            When the request waited too long for the main thread, see
+            `health.Load.waited`. The exception is sent as response.
+
         Returns
         -------
-        Argument string for main `parser`.
+        False: The main thread was woken up without a message, see `wakeup`.
+        list: Argument string for main `parser`.
+
+        """
+        self.load.started = True
+        item = self.q_get.get()
+        if item is None:
+            return False
+        self.load.dequeued()
+        args, self.reply, self.rec, self.stamp = item
+        if self.rec is not None:
+            self.rec.mark("dequeued")
+        self.meta = {}
+        d, self.meta = Message.split_meta(args)
+        args_l = Message.dict_to_argslist(d)
+        if self.rec is not None:
+            self.rec.mark("decoded")
+        self.load.waited(self.stamp)
+        return args_l
 
+    def detach(self) -> t.Callable[..., None]:
+        """Return a function, that sends the response to the last message later.
+
+        The main thread can go on with the next messages, while the thread
+        of the connection waits for the response, e.g. to a profiling window.
+        The function takes the same arguments as `send_msg`.
         """
-        d = self.q_get.get()
-        return Message.dict_to_argslist(d)
+        reply = self.reply
+        return lambda *response: reply.put(response)
+
+    def wakeup(self) -> None:
+        """Let the waiting `get_msg` of the main thread return False."""
+        self.q_get.put(None)
 
-    def send_msg(self, autoformat: bool, response: t.Union[dict, str],
-                 exception: str) -> None:
+    def send_msg(self, autoformat: bool, response: t.Union[dict, str, bytes, FileResponse],
+                 exception: str, extra: t.Union[None, dict] = None) -> None:
         """Send the http get request response to the client.
 
         Parameters
@@ -262,12 +1188,191 @@ class HttpServer:
                    in nap mode. The function `func` is required to form a valid
                    response.
         response
-            The information that should be sent in the response section.
+            The information that should be sent in the response section or
+            the binary body.
         exception
             The information that should be sent in the exception section.
+        extra
+            Further fields of the envelope, e.g. the echoed `id`, see `Message.echo`.
 
         """
         try:
-            self.q_send.put((autoformat, response, exception))
+            self.reply.put((autoformat, response, exception, extra))
         except Exception as e:
             print(e)
+
+
+class PipeServer:
+    """The script in pipe mode accepts json lines from stdin without any socket.
+
+    Every line on stdin is one json message with the arguments, and every
+    response is written as one json line to stdout. The parent process,
+    that spawned the script, can therefore talk to it without the overhead
+    of a tcp connection and without the need of a free port.
+
+    Attributes
+    ----------
+    stdin : io.BufferedReader
+        The binary stdin, where the json lines are read from.
+    stdout : io.BufferedWriter
+        The binary stdout, where the json lines are written to. To keep
+        the output clean, `sys.stdout` is redirected to stderr, so a `print`
+        in the function `func` does not break the response.
+    msg_meth : message.MessageJson
+        The message class, because pipe mode only supports json.
+    meta : dict
+        The meta fields (keys starting with `nap_`) of the last message.
+    instrument : None | instrument.Instrumentation
+        The instrumentation, that records the stage boundaries of every message.
+    rec : None | instrument.Record
+        The record of the last message, None without instrumentation.
+    stamp : float
+        The time (`time.monotonic`), when the last message was read.
+    buffer : bytearray
+        The bytes read from stdin, that are not yet returned as line, see `readline`.
+    unflushed : bool
+        True: A response is still in the buffer of `stdout`, see `flush`.
+
+    """
+
+    def __init__(self, instrument: t.Union[None, Instrumentation] = None) -> None:
+        """Take over stdin and stdout for the json lines.
+
+        Parameters
+        ----------
+        instrument
+            The instrumentation, that records the stage boundaries of every message.
+
+        """
+        self.stdin = t.cast(io.BufferedReader, sys.stdin.buffer)
+        self.stdout = sys.stdout.buffer
+        sys.stdout = sys.stderr
+        self.msg_meth = MessageJson()
+        self.meta = {}  # type: dict
+        self.instrument = instrument
+        self.rec = None  # type: t.Union[None, Record]
+        self.stamp = 0.0
+        self.buffer = bytearray()
+        self.unflushed = False
+
+    def readline(self) -> bytes:
+        """Read the next line from stdin, empty at the end of stdin.
+
+        The lines are split from own `buffer` instead of `stdin.readline`,
+        so `flush` sees the lines, that were already read from the pipe.
+        """
+        start = 0
+        while True:
+            end = self.buffer.find(b"\n", start)
+            if end >= 0:
+                line = bytes(self.buffer[:end + 1])
+                del self.buffer[:end + 1]
+                return line
+            start = len(self.buffer)
+            chunk = self.stdin.read1(65536)
+            if not chunk:
+                line = bytes(self.buffer)
+                self.buffer.clear()
+                return line
+            self.buffer += chunk
+
+    def flush(self, force: bool = False) -> None:
+        """Flush the buffered responses to stdout, unless the next line is already waiting.
+
+        When the parent sent several lines at once, their responses are
+        collected in the buffer of `stdout` and flushed together, as soon as
+        no further line waits on stdin (or the buffer is full). Without
+        `select` on stdin (e.g. Windows), every response is flushed.
+
+        Parameters
+        ----------
+        force
+            True: Flush also, when the next line is waiting, e.g. at the end of stdin.
+
+        """
+        if not self.unflushed or (self.buffer and not force):
+            return
+        try:
+            if not force and select.select([self.stdin], [], [], 0)[0]:
+                return
+        except (OSError, ValueError):
+            pass
+        self.unflushed = False
+        try:
+            self.stdout.flush()
+        except OSError as e:
+            print(e, file=sys.stderr)
+
+    def get_msg(self) -> t.Union[None, t.Literal[False], list]:
+        """Read the next json line from stdin.
+
+        Raises
+        ------
+        Exception
+            When the line is no valid json. The exception is sent as response,
+            so every non-empty line has exactly one response line.
+
+        Returns
+        -------
+        None: stdin was closed, so there are no more messages.
+        False: The line was empty and is skipped.
+        list: Argument(s) for the main `parser` of `NetArgumentParser`.
+
+        """
+        self.meta = {}
+        self.rec = None
+        self.flush()  # before waiting for the next line
+        line = self.readline()
+        if not line:
+            self.flush(force=True)
+            return None
+        if not line.strip():
+            return False
+        self.stamp = time.monotonic()
+        if self.instrument is not None:
+            self.rec = self.instrument.record()
+            for boundary in ("recv", "received", "dequeued"):  # the line is read at once
+                self.rec.mark(boundary)
+            self.rec.bytes_in = len(line)
+        d, self.meta = Message.split_meta(self.msg_meth._to_dict(line))
+        args = Message.dict_to_argslist(d)
+        if self.rec is not None:
+            self.rec.mark("decoded")
+        return args
+
+    def send_msg(self, autoformat: bool, response: t.Union[dict, str, bytes, FileResponse],
+                 exception: str, extra: t.Union[None, dict] = None) -> None:
+        """Write the response as one json line to stdout.
+
+        The message and its line break are written in one call to the
+        buffered stdout, which is flushed before the next line is read,
+        unless it is already waiting, see `flush`.
+
+        Parameters
+        ----------
+        autoformat
+            True: The return of the function `func` can be a dict or str and is
+                  automatically formatted to a valid json format as response.
+            False: The return of the function `func` is handed "as is" as response.
+                   The function `func` is required to form a valid response.
+        response
+            The information that should be sent in the response section.
+        exception
+            The information that should be sent in the exception section.
+        extra
+            Further fields of the envelope, e.g. the echoed `id`, see `Message.echo`.
+
+        """
+        if isinstance(response, (*BINARY, FileResponse)):
+            response, exception = "", "Binary responses are not supported in pipe mode."
+        try:
+            msg = self.msg_meth._format(autoformat, response, exception, extra)
+            if self.rec is not None:
+                self.rec.mark("formatted")
+                self.rec.bytes_out = len(msg) + 1
+            self.stdout.write(msg + b"\n")
+            self.unflushed = True
+            if self.rec is not None:
+                self.rec.sent()
+        except Exception as e:
+            print(e, file=sys.stderr)
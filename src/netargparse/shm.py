@@ -0,0 +1,250 @@
+import json
+import os
+import struct
+import sys
+import typing as t
+from multiprocessing import resource_tracker, shared_memory
+
+DTYPES = {"uint8": "B", "int8": "b", "uint16": "H", "int16": "h", "uint32": "I",
+          "int32": "i", "uint64": "Q", "int64": "q", "float32": "f", "float64": "d"}
+_TRACKED = set()  # type: t.Set[str]  # the blocks, that the resource tracker of this process removes
+
+
+def _open_untracked(name: str) -> shared_memory.SharedMemory:
+    """Open an existing block without leaving it registered at the resource tracker.
+
+    Before python 3.13, attaching registers the block like creating it, so
+    it is unregistered right after, like in `SharedArray.untrack`, unless
+    this process created and tracks the block itself. The tracker is not
+    patched, because other threads may create blocks meanwhile.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    if os.name == "posix" and shm._name not in _TRACKED:  # type: ignore[attr-defined]
+        resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore[attr-defined]
+    return shm
+
+
+class SharedArray:
+    """A buffer in shared memory, that is passed by its name instead of its content.
+
+    Only the descriptor (name, shape and dtype) of the buffer is sent in the
+    message, so large arrays are neither converted to text nor copied between
+    the layers. This only works, when the client and the script in nap mode
+    run on the same host.
+
+    Attributes
+    ----------
+    shm : multiprocessing.shared_memory.SharedMemory
+        The shared memory block.
+    dtype : str
+        The format character of `struct` (e.g. `d`) or the name of the
+        numpy dtype (e.g. `float64`) of the items in the buffer.
+    shape : list[int]
+        The shape of the array in the buffer.
+    view : memoryview
+        The zero-copy view on the buffer with the given dtype and shape.
+    tracked : bool
+        Whether the resource tracker of this process removes the block, when
+        the process exits. Only the creator of the block tracks it.
+
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, dtype: str,
+                 shape: t.Sequence[int], tracked: bool) -> None:
+        """Create the view on the shared memory block.
+
+        Parameters
+        ----------
+        shm
+            The shared memory block.
+        dtype
+            The format character of `struct` or the name of the numpy dtype.
+        shape
+            The shape of the array in the buffer.
+        tracked
+            Whether the block is registered at the resource tracker.
+
+        Raises
+        ------
+        Exception
+            When the dtype is unknown or the shape does not fit in the block.
+
+        """
+        self.shm = shm
+        self.dtype = dtype
+        self.shape = list(shape)
+        self.tracked = tracked
+
+        fmt = DTYPES.get(dtype, dtype)
+        nbytes = struct.calcsize(fmt)
+        for dim in self.shape:
+            nbytes *= dim
+        if nbytes > shm.size:
+            raise Exception(f"Shared memory `{shm.name}` is too small for shape {self.shape} of `{dtype}`.")
+        buf = t.cast(memoryview, shm.buf)
+        self.view = buf[:nbytes].cast(fmt, self.shape)  # type: ignore[call-overload]
+
+    @classmethod
+    def create(cls, data: t.Any, dtype: str = "B",
+               shape: t.Union[None, t.Sequence[int]] = None) -> "SharedArray":
+        """Copy `data` once into a new shared memory block.
+
+        The creator owns the block and must `close` and `unlink` it after the
+        receiver is done with it.
+
+        Parameters
+        ----------
+        data
+            Any object supporting the buffer protocol, e.g. bytes, array.array
+            or a numpy array.
+        dtype
+            The format character of `struct` or the name of the numpy dtype.
+        shape
+            The shape of the array. None: one dimension with all items.
+
+        Returns
+        -------
+        The shared array with a copy of `data`.
+
+        """
+        src = memoryview(data).cast("B")
+        shm = shared_memory.SharedMemory(create=True, size=max(src.nbytes, 1))
+        t.cast(memoryview, shm.buf)[:src.nbytes] = src
+        _TRACKED.add(shm._name)  # type: ignore[attr-defined]
+        if shape is None:
+            shape = [src.nbytes // struct.calcsize(DTYPES.get(dtype, dtype))]
+        return cls(shm, dtype, shape, True)
+
+    @classmethod
+    def attach(cls, desc: t.Union[dict, str]) -> "SharedArray":
+        """Map an existing shared memory block without copying it.
+
+        The block is not tracked, so the process, that attaches, does not
+        remove the block of the creator when it exits.
+
+        Parameters
+        ----------
+        desc
+            The descriptor of the block as dict or json string (xml messages).
+
+        Raises
+        ------
+        Exception
+            When the dtype is unknown or the shape does not fit in the block.
+            The block is closed again.
+
+        Returns
+        -------
+        The shared array with the view on the block.
+
+        """
+        d = json.loads(desc) if type(desc) is str else t.cast(dict, desc)
+        shm = _open_untracked(d["name"])
+        try:
+            return cls(shm, d.get("dtype", "B"), d.get("shape", [shm.size]), False)
+        except Exception:
+            shm.close()
+            raise
+
+    def desc(self) -> dict:
+        """Return the descriptor, that is sent in the message instead of the data."""
+        return {"name": self.shm.name, "shape": self.shape, "dtype": self.dtype}
+
+    def close(self) -> None:
+        """Release the view and close the block for this process.
+
+        When the view is still exported, e.g. to a numpy array, that was
+        created from it, the block is left to the garbage collector.
+        """
+        try:
+            self.view.release()
+            self.shm.close()
+        except BufferError:
+            pass
+
+    def untrack(self) -> None:
+        """Hand the ownership of the block over to the receiver."""
+        if self.tracked and os.name == "posix":
+            resource_tracker.unregister(self.shm._name, "shared_memory")  # type: ignore[attr-defined]
+        _TRACKED.discard(self.shm._name)  # type: ignore[attr-defined]
+        self.tracked = False
+
+    def unlink(self) -> None:
+        """Remove the block. Must only be called once by the owner."""
+        if not self.tracked and os.name == "posix":
+            # `unlink` unregisters the block, so it must be registered before
+            resource_tracker.register(self.shm._name, "shared_memory")  # type: ignore[attr-defined]
+        self.shm.unlink()
+        _TRACKED.discard(self.shm._name)  # type: ignore[attr-defined]
+
+
+def handover(data: t.Any, dtype: str = "B",
+             shape: t.Union[None, t.Sequence[int]] = None) -> dict:
+    """Return a large result in shared memory instead of in the message.
+
+    The block is created, filled with `data` and handed over to the receiver,
+    who must `unlink` it after reading, e.g. with
+    `arr = SharedArray.attach(desc); ...; arr.close(); arr.unlink()`.
+    This only works on POSIX, because on Windows the block is freed with the
+    last handle, which `handover` closes before the response is sent.
+
+    Parameters
+    ----------
+    data
+        Any object supporting the buffer protocol.
+    dtype
+        The format character of `struct` or the name of the numpy dtype.
+    shape
+        The shape of the array. None: one dimension with all items.
+
+    Returns
+    -------
+    The descriptor, that can be put in the dict returned by `func`.
+
+    Raises
+    ------
+    Exception
+        When the operating system is not POSIX.
+
+    """
+    if os.name != "posix":
+        raise Exception("`handover` is only supported on POSIX, on Windows the block is freed with its last handle.")
+    arr = SharedArray.create(data, dtype, shape)
+    arr.untrack()
+    desc = arr.desc()
+    arr.close()
+    return desc
+
+
+def attach_all(descs: t.Union[dict, str]) -> t.Dict[str, SharedArray]:
+    """Attach all shared arrays from the `nap_shm` field of a message.
+
+    Parameters
+    ----------
+    descs
+        The descriptors of the blocks with the name of the attribute in the
+        namespace as key. Either as dict (json) or as json string (xml, url).
+
+    Raises
+    ------
+    Exception
+        When a block cannot be attached. The blocks, that were already
+        attached, are closed.
+
+    Returns
+    -------
+    The attached shared arrays with the name of the attribute as key.
+
+    """
+    d = json.loads(descs) if type(descs) is str else t.cast(dict, descs)
+    shared = {}  # type: t.Dict[str, SharedArray]
+    try:
+        for name, desc in d.items():
+            shared[name] = SharedArray.attach(desc)
+    except Exception:
+        for arr in shared.values():
+            arr.close()
+        raise
+    return shared
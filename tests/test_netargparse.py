@@ -1,12 +1,32 @@
+import argparse
+from array import array
+import asyncio
+import io
 import json
+import marshal
+import os
 import requests
+import signal
 import socket
+import subprocess
+import sys
+import tempfile
 from threading import Thread
 import time
 import unittest
+import unittest.mock
 import xml.etree.ElementTree as ElementTree
+import zlib
 
-from netargparse import NetArgumentParser
+from netargparse import FileResponse, NetArgumentParser, bench
+from netargparse.client import AsyncNapClient, DeadlineError, NapClient, OverloadError, RemoteError, _arguments
+from netargparse.instrument import STAGES, Instrumentation
+from netargparse.lanes import Lane, Scheduler
+from netargparse.message import MessageFrame
+from netargparse.metrics import Metrics
+from netargparse.restart import command
+from netargparse.server import Output, PipeServer
+from netargparse.shm import SharedArray, _open_untracked, attach_all, handover
 
 
 port_start = 7200
@@ -107,6 +127,212 @@ def http_autoformat_no_dict():
     parser = NetArgumentParser()
     parser(main, resp_delay=0.2, parse_args=["nap", "--port", str(port_start + 9), "--http"])
 
+def tcp_socket_shm():
+    def main(args):
+        if args.scale == 0:
+            return {"sum": sum(args.data)}
+        return {"sum": sum(args.data), "scaled": handover(array("d", [x * args.scale for x in args.data]), "float64")}
+
+    parser = NetArgumentParser()
+    parser.add_argument("--scale", type=int)
+    parser(main, resp_delay=0.2, parse_args=["nap", "--port", str(port_start + 10)])
+
+def binary_main(args):
+    if args.mode == "reverse":
+        return bytes(args._attachment)[::-1]
+    if args.mode == "raw":
+        return memoryview(b"\x00\x01raw")
+    if args.mode == "file":
+        fd, path = tempfile.mkstemp()
+        os.write(fd, b'{"a": 1}')
+        os.close(fd)
+        return FileResponse(path, "application/json", remove=True)
+    if args.mode == "missing":
+        return FileResponse(os.path.join(tempfile.gettempdir(), "nap_missing_file"))
+    return {"mode": args.mode, "attachment": hasattr(args, "_attachment")}
+
+def tcp_socket_binary():
+    parser = NetArgumentParser()
+    parser.add_argument("--mode", type=str)
+    parser(binary_main, resp_delay=0.2, parse_args=["nap", "--port", str(port_start + 11)])
+
+def http_binary():
+    parser = NetArgumentParser()
+    parser.add_argument("--mode", type=str)
+    parser(binary_main, resp_delay=0.2, parse_args=["nap", "--port", str(port_start + 12), "--http"])
+
+def compress_main(args):
+    if args.mode == "large":
+        return {"data": "abc" * 1000}
+    if args.mode == "binary":
+        return b"\x00" * 10000
+    return {"data": "abc"}
+
+def tcp_socket_compress():
+    parser = NetArgumentParser()
+    parser.add_argument("--mode", type=str)
+    parser(compress_main, resp_delay=0.2, parse_args=["nap", "--port", str(port_start + 13),
+                                                       "--compress-level", "6", "--compress-min-size", "100"])
+
+def http_compress():
+    parser = NetArgumentParser()
+    parser.add_argument("--mode", type=str)
+    parser(compress_main, resp_delay=0.2, parse_args=["nap", "--port", str(port_start + 14), "--http",
+                                                       "--compress-level", "6", "--compress-min-size", "100"])
+
+unix_path = os.path.join(tempfile.gettempdir(), f"nap_test_{os.getpid()}.sock")
+
+def client_main(args):
+    if args.x < 0:
+        raise ValueError("negative")
+    if hasattr(args, "_attachment"):
+        return bytes(args._attachment)[::-1]
+    return {"sum": args.x + args.y, "flag": args.flag}
+
+def client_parser():
+    parser = NetArgumentParser()
+    parser.add_argument("-x", type=int)
+    parser.add_argument("--y", type=int, default=0)
+    parser.add_argument("--flag", action="store_true")
+    return parser
+
+def tcp_socket_client():
+    client_parser()(client_main, resp_delay=0, parse_args=["nap", "--port", str(port_start + 15)])
+
+def unix_socket_client():
+    client_parser()(client_main, resp_delay=0, parse_args=["nap", "--unix", unix_path])
+
+def http_client():
+    client_parser()(client_main, resp_delay=0, parse_args=["nap", "--port", str(port_start + 16), "--http"])
+
+records = {"tcp": [], "http": []}
+
+def tcp_socket_instrument():
+    instrument = Instrumentation(on_request=records["tcp"].append)
+    client_parser()(client_main, resp_delay=0, parse_args=["nap", "--port", str(port_start + 17)], instrument=instrument)
+
+def http_instrument():
+    instrument = Instrumentation(on_request=records["http"].append, timing=True)
+    client_parser()(client_main, resp_delay=0, parse_args=["nap", "--port", str(port_start + 18), "--http"], instrument=instrument)
+
+def http_metrics():
+    client_parser()(client_main, resp_delay=0, parse_args=["nap", "--port", str(port_start + 19), "--http", "--metrics"])
+
+def tcp_socket_metrics():
+    client_parser()(client_main, resp_delay=0, parse_args=["nap", "--port", str(port_start + 20),
+                                                            "--metrics-port", str(port_start + 21)])
+
+def tcp_socket_admin():
+    client_parser()(client_main, resp_delay=0, parse_args=["nap", "--port", str(port_start + 22), "--admin"])
+
+def http_admin():
+    client_parser()(client_main, resp_delay=0, parse_args=["nap", "--port", str(port_start + 23), "--http", "--admin"])
+
+def sleep_parser():
+    nap = NetArgumentParser()
+    nap.add_argument("--sleep", type=float, default=0)
+    nap.add_argument("--file", type=str)
+    return nap
+
+def sleep_main(args):
+    time.sleep(args.sleep)
+    slept.append(args.sleep)
+    if args.file:
+        return FileResponse(args.file, remove=True)
+    return {"slept": args.sleep}
+
+slept = []
+
+def http_health():
+    sleep_parser()(sleep_main, parse_args=["nap", "--port", str(port_start + 24), "--http", "--ready-queue", "1"])
+
+def http_shed():
+    sleep_parser()(sleep_main, parse_args=["nap", "--port", str(port_start + 25), "--http", "--max-in-flight", "1",
+                                          "--metrics"])
+
+def tcp_socket_deadline():
+    sleep_parser()(sleep_main, parse_args=["nap", "--port", str(port_start + 27), "--timeout", "0.3"])
+
+def tcp_socket_limits():
+    client_parser()(client_main, parse_args=["nap", "--port", str(port_start + 28), "--idle-timeout", "0.3",
+                                             "--read-timeout", "0.3", "--max-message-size", "100",
+                                             "--max-messages", "2"])
+
+def http_limits():
+    client_parser()(client_main, parse_args=["nap", "--port", str(port_start + 29), "--http",
+                                             "--max-message-size", "10", "--max-messages", "2"])
+
+def functions_parser():
+    nap = client_parser()
+    add = nap.add_function("add", lambda args: {"sum": args.a + args.b})
+    add.add_argument("-a", type=int)
+    add.add_argument("-b", type=int, default=0)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--text", type=str)
+    nap.add_function("upper", lambda args: {"text": args.text.upper()}, parents=[common])
+    return nap
+
+def tcp_socket_functions():
+    functions_parser()(client_main, parse_args=["nap", "--port", str(port_start + 30)])
+
+def http_functions():
+    functions_parser()(parse_args=["nap", "--port", str(port_start + 31), "--http"])
+
+def tcp_socket_shed():
+    sleep_parser()(sleep_main, parse_args=["nap", "--port", str(port_start + 26), "--max-queue", "1",
+                                           "--max-queue-time", "0.1"])
+
+def tcp_socket_lanes():
+    sleep_parser()(sleep_main, parse_args=["nap", "--port", str(port_start + 32), "--lane", "fast:8",
+                                           "--lane", "slow:1:3"])
+
+def tcp_socket_rate():
+    sleep_parser()(sleep_main, parse_args=["nap", "--port", str(port_start + 34), "--rate-limit", "2",
+                                           "--rate-burst", "2"])
+
+def warm_main(args):
+    args._context["calls"].append(args.sleep)
+    return {"calls": len(args._context["calls"])}
+
+warm = {"calls": []}
+
+def tcp_socket_warm():
+    sleep_parser()(warm_main, setup=lambda: warm, warmup=[{"--sleep": 0.1}, {"--sleep": 0.2}],
+                   parse_args=["nap", "--port", str(port_start + 35)])
+
+def http_lanes():
+    sleep_parser()(sleep_main, parse_args=["nap", "--port", str(port_start + 33), "--http", "--lane", "fast:8"])
+
+restart_script = """
+import os
+import time
+from netargparse import NetArgumentParser
+
+def main(args):
+    time.sleep(args.sleep)
+    return {"pid": os.getpid()}
+
+nap = NetArgumentParser()
+nap.add_argument("--sleep", type=float, default=0)
+nap(main)
+"""
+
+pipe_autoformat = """
+from netargparse import NetArgumentParser
+
+def main(args):
+    print("must not be in the response")
+    if args.var_str == "damn":
+        return args.var_int / 0
+    return vars(args)
+
+parser = NetArgumentParser()
+parser.add_argument("--var_str", type=str)
+parser.add_argument("--var_int", type=int)
+parser.add_argument("--var_true", action="store_true")
+parser(main)
+"""
+
 
 class TcpSocketRequest:
     def __init__(self, port):
@@ -118,6 +344,25 @@ class TcpSocketRequest:
         recv = self.s.recv(1024)
         return recv
 
+    def recv_exact(self, n):
+        data = b""
+        while len(data) < n:
+            data += self.s.recv(n - len(data))
+        return data
+
+    def txrx_complete(self, msg):
+        self.s.sendall(msg)
+        data = b""
+        while not data.endswith(b"}") or data.count(b"{") != data.count(b"}"):
+            data += self.s.recv(1024)
+        return data
+
+    def txrx_frame(self, msg):
+        self.s.sendall(msg)
+        header = self.recv_exact(MessageFrame.HEADER.size)
+        _, self.flags, env_len, att_len = MessageFrame.HEADER.unpack(header)
+        return self.recv_exact(env_len), self.recv_exact(att_len)
+
 class HttpRequest:
     def __init__(self, port):
         self.port = port
@@ -127,6 +372,22 @@ class HttpRequest:
         recv = requests.get(f"http://localhost:{self.port}{msg}")
         return recv.text
 
+    def post(self, msg, data):
+        return requests.post(f"http://localhost:{self.port}{msg}", data=data)
+
+    def get(self, msg, headers):
+        return requests.get(f"http://localhost:{self.port}{msg}", headers=headers)
+
+class PipeRequest:
+    def __init__(self, script):
+        self.p = subprocess.Popen([sys.executable, "-c", script, "pipe"], stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def txrx(self, msg):
+        self.p.stdin.write(msg + b"\n")
+        self.p.stdin.flush()
+        return self.p.stdout.readline().rstrip(b"\n")
+
 
 class TestNetArgumentParser(unittest.TestCase):
     def assertResponse(self, resp, resp_type):
@@ -433,12 +694,1061 @@ class TestNetArgumentParser(unittest.TestCase):
         self.assertEqual(ans, "<nap><response></response><exception>Cannot autoformat non-dict. Check return of the function started by NetArgumentParser.</exception><finished>1</finished></nap>")
         self.assertResponse(ans, "xml")
 
+    # Shared memory
+    @unittest.skipIf(os.name == "nt", "handover is only supported on POSIX")
+    def test_plain_json_shm(self):
+        arr = SharedArray.create(array("d", [1.5, 2.5, 3.0]), "float64")
+        try:
+            ans = s_tcp_shm.txrx(json.dumps({"--scale": 2, "nap_shm": {"data": arr.desc()}}).encode("utf-8"))
+        finally:
+            arr.close()
+            arr.unlink()
+        self.assertResponse(ans, "json")
+        resp = json.loads(ans)["response"]
+        self.assertEqual(resp["sum"], 7.0)
+        scaled = SharedArray.attach(resp["scaled"])
+        self.assertEqual(scaled.view.tolist(), [3.0, 5.0, 6.0])
+        scaled.close()
+        scaled.unlink()
+
+    def test_plain_xml_shm(self):
+        arr = SharedArray.create(array("i", [1, 2, 3, 4]), "int32")
+        try:
+            ans = s_tcp_shm.txrx(f"<nap><__scale>0</__scale><nap_shm>{json.dumps({'data': arr.desc()})}</nap_shm></nap>".encode("utf-8"))
+        finally:
+            arr.close()
+            arr.unlink()
+        self.assertEqual(ans, b"<nap><response><sum>10</sum></response><exception></exception><finished>1</finished></nap>")
+        self.assertResponse(ans, "xml")
+
+    def test_plain_json_shm_too_small(self):
+        arr = SharedArray.create(array("d", [1.5]), "float64")
+        desc = arr.desc()
+        desc["shape"] = [1000000]
+        try:
+            ans = s_tcp_shm.txrx(json.dumps({"--scale": "0", "nap_shm": {"data": desc}}).encode("utf-8"))
+        finally:
+            arr.close()
+            arr.unlink()
+        self.assertEqual(json.loads(ans)["exception"], f"Shared memory `{desc['name']}` is too small for shape [1000000] of `float64`.")
+
+    def test_plain_json_shm_name_taken(self):
+        arr = SharedArray.create(array("d", [1.5]), "float64")
+        try:
+            for name in ("scale", "_cmd"):
+                ans = s_tcp_shm.txrx(json.dumps({"--scale": "0", "nap_shm": {name: arr.desc()}}).encode("utf-8"))
+                self.assertEqual(json.loads(ans)["exception"], f"`{name}` in nap_shm is no free attribute name of the arguments.")
+        finally:
+            arr.close()
+            arr.unlink()
+
+    def test_attach_closes_on_error(self):
+        arr = SharedArray.create(array("d", [1.5]), "float64")
+        opened = []
+        try:
+            with unittest.mock.patch("netargparse.shm._open_untracked", lambda name: opened.append(_open_untracked(name)) or opened[-1]):
+                with self.assertRaises(Exception):
+                    SharedArray.attach({**arr.desc(), "shape": [1000000]})
+        finally:
+            arr.close()
+            arr.unlink()
+        self.assertIsNone(opened[0].buf)
+
+    def test_attach_all_closes_on_error(self):
+        arr = SharedArray.create(array("d", [1.5]), "float64")
+        closed = []
+        close = SharedArray.close
+        SharedArray.close = lambda self: closed.append(self.shm.name) or close(self)
+        try:
+            with self.assertRaises(FileNotFoundError):
+                attach_all({"a": arr.desc(), "b": {"name": "nap_missing_block"}})
+        finally:
+            SharedArray.close = close
+            arr.close()
+            arr.unlink()
+        self.assertEqual(closed, [arr.shm.name])
+
+    def test_handover_posix_only(self):
+        with unittest.mock.patch("netargparse.shm.os.name", "nt"):
+            with self.assertRaises(Exception) as cm:
+                handover(b"abc")
+        self.assertIn("only supported on POSIX", str(cm.exception))
+
+    # Binary frames
+    def test_frame_attachment_binary_response(self):
+        attachment = bytes(range(256)) * 1000
+        env, att = s_tcp_bin.txrx_frame(MessageFrame.pack({"--mode": "reverse"}, attachment) + attachment)
+        self.assertEqual(env, b'{"response": "", "exception": "", "finished": 1}')
+        self.assertEqual(att, attachment[::-1])
+
+    def test_frame_no_attachment_dict_response(self):
+        env, att = s_tcp_bin.txrx_frame(MessageFrame.pack({"--mode": "dict"}))
+        self.assertEqual(env, b'{"response": {"mode": "dict", "attachment": false}, "exception": "", "finished": 1}')
+        self.assertEqual(att, b"")
+
+    def test_frame_func_exc(self):
+        env, att = s_tcp_bin.txrx_frame(MessageFrame.pack({"--mode": "reverse"}))
+        self.assertEqual(env, b'{"response": "", "exception": "\'Namespace\' object has no attribute \'_attachment\'", "finished": 1}')
+        self.assertEqual(att, b"")
+
+    def test_plain_binary_response(self):
+        ans = s_tcp_bin.txrx(b'{"--mode": "raw"}')
+        self.assertEqual(ans, b'{"response": "", "exception": "Binary responses need a frame.", "finished": 1}')
+        ans = s_tcp_bin.txrx(b"<nap><__mode>raw</__mode></nap>")
+        self.assertEqual(ans, b"<nap><response></response><exception>Binary responses need a frame.</exception><finished>1</finished></nap>")
+
+    def test_http_post_binary_response(self):
+        ans = s_http_bin.post("/?--mode=reverse", b"\x00\x01\xff")
+        self.assertEqual(ans.headers["Content-Type"], "application/octet-stream")
+        self.assertEqual(ans.content, b"\xff\x01\x00")
+
+    def test_http_post_dict_response(self):
+        ans = s_http_bin.post("/xml?--mode=dict", b"\x00")
+        self.assertEqual(ans.text, "<nap><response><mode>dict</mode><attachment>True</attachment></response><exception></exception><finished>1</finished></nap>")
+
+    # File responses
+    def test_frame_file_response(self):
+        env, att = s_tcp_bin.txrx_frame(MessageFrame.pack({"--mode": "file"}))
+        self.assertEqual(env, b'{"response": "", "exception": "", "finished": 1}')
+        self.assertEqual(att, b'{"a": 1}')
+
+    def test_plain_json_file_response(self):
+        ans = s_tcp_bin.txrx_complete(b'{"--mode": "file"}')
+        self.assertEqual(ans, b'{"response": {"a": 1}, "exception": "", "finished": 1}')
+        self.assertResponse(ans, "json")
+
+    def test_plain_json_file_response_missing(self):
+        ans = s_tcp_bin.txrx_complete(b'{"--mode": "missing"}')
+        self.assertTrue(json.loads(ans)["exception"].startswith("[Errno 2]"))
+        self.assertResponse(ans, "json")
+
+    def test_http_file_response(self):
+        ans = s_http_bin.post("/?--mode=file", b"")
+        self.assertEqual(ans.headers["Content-Type"], "application/json")
+        self.assertEqual(ans.headers["Content-Length"], "8")
+        self.assertEqual(ans.content, b'{"a": 1}')
+
+    # Compression
+    def test_frame_compressed(self):
+        env, att = s_tcp_comp.txrx_frame(MessageFrame.pack({"--mode": "large"}, flags=MessageFrame.ACCEPT_COMPRESSED))
+        self.assertEqual(s_tcp_comp.flags, MessageFrame.COMPRESSED)
+        self.assertLess(len(env), 100)
+        self.assertEqual(MessageFrame.unpack(s_tcp_comp.flags, env, att), ({"response": {"data": "abc" * 1000}, "exception": "", "finished": 1}, b""))
+
+    def test_frame_compressed_binary(self):
+        env, att = s_tcp_comp.txrx_frame(MessageFrame.pack({"--mode": "binary"}, flags=MessageFrame.ACCEPT_COMPRESSED))
+        self.assertEqual(s_tcp_comp.flags, MessageFrame.COMPRESSED)
+        self.assertEqual(MessageFrame.unpack(s_tcp_comp.flags, env, att), ({"response": "", "exception": "", "finished": 1}, b"\x00" * 10000))
+
+    def test_frame_compressed_not_accepted(self):
+        env, att = s_tcp_comp.txrx_frame(MessageFrame.pack({"--mode": "large"}))
+        self.assertEqual(s_tcp_comp.flags, 0)
+        self.assertEqual(json.loads(env)["response"], {"data": "abc" * 1000})
+
+    def test_frame_compressed_too_small(self):
+        env, att = s_tcp_comp.txrx_frame(MessageFrame.pack({"--mode": "small"}, flags=MessageFrame.ACCEPT_COMPRESSED))
+        self.assertEqual(s_tcp_comp.flags, 0)
+        self.assertEqual(env, b'{"response": {"data": "abc"}, "exception": "", "finished": 1}')
+
+    def test_frame_compressed_request(self):
+        env = zlib.compress(b'{"--mode": "small"}')
+        env, att = s_tcp_comp.txrx_frame(MessageFrame._header(len(env), 0, MessageFrame.COMPRESSED) + env)
+        self.assertEqual(env, b'{"response": {"data": "abc"}, "exception": "", "finished": 1}')
+
+    def test_http_compressed_gzip(self):
+        ans = s_http_comp.get("/?--mode=large", {"Accept-Encoding": "gzip, deflate"})
+        self.assertEqual(ans.headers["Content-Encoding"], "gzip")
+        self.assertEqual(ans.json()["response"], {"data": "abc" * 1000})
+
+    def test_http_compressed_deflate(self):
+        ans = s_http_comp.get("/xml?--mode=large", {"Accept-Encoding": "gzip;q=0, deflate"})
+        self.assertEqual(ans.headers["Content-Encoding"], "deflate")
+        self.assertEqual(ans.text, f"<nap><response><data>{'abc' * 1000}</data></response><exception></exception><finished>1</finished></nap>")
+
+    def test_http_compressed_identity(self):
+        ans = s_http_comp.get("/?--mode=large", {"Accept-Encoding": "identity"})
+        self.assertNotIn("Content-Encoding", ans.headers)
+        self.assertEqual(ans.headers["Content-Length"], str(len(ans.content)))
+
+    def test_http_compressed_too_small(self):
+        ans = s_http_comp.get("/?--mode=small", {"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", ans.headers)
+        self.assertEqual(ans.text, '{"response": {"data": "abc"}, "exception": "", "finished": 1}')
+
+    def test_http_compressed_q_values(self):
+        for accept, mode, coding in [("deflate;q=0.5, gzip;q=0.8", "large", "gzip"),
+                                     ("gzip;q=0.2, deflate;q=0.9", "large", "deflate"),
+                                     ("*", "large", "gzip"),
+                                     ("*, gzip;q=0", "large", "deflate"),
+                                     ("gzip;q=0", "large", None),
+                                     ("gzip;q=0.5, identity", "large", None),
+                                     ("gzip, identity;q=0", "small", "gzip"),
+                                     ("deflate, *;q=0", "small", "deflate"),
+                                     ("", "large", None)]:
+            with self.subTest(accept=accept):
+                ans = s_http_comp.get(f"/?--mode={mode}", {"Accept-Encoding": accept})
+                self.assertEqual(ans.headers.get("Content-Encoding"), coding)
+                self.assertEqual(ans.headers["Vary"], "Accept-Encoding")
+                self.assertEqual(ans.json()["response"], {"data": "abc" * (1000 if mode == "large" else 1)})
+
+    def test_http_compressed_vary(self):
+        self.assertEqual(s_http_comp.get("/?--mode=small", {}).headers["Vary"], "Accept-Encoding")
+        self.assertNotIn("Vary", s_http_a.get("/?--var_str=a", {}).headers)
+
+    # Pipe, json lines, autoformat
+    def test_pipe_json_a_valid_tx(self):
+        ans = s_pipe_a.txrx(b'{"--var_str": "value", "--var_int": "2"}')
+        self.assertEqual(ans, b'{"response": {"var_str": "value", "var_int": 2, "var_true": false, "_cmd": "pipe"}, "exception": "", "finished": 1}')
+        self.assertResponse(ans, "json")
+
+    def test_pipe_json_a_func_exc(self):
+        ans = s_pipe_a.txrx(b'{"--var_str": "damn", "--var_int": "5"}')
+        self.assertEqual(ans, b'{"response": "", "exception": "division by zero", "finished": 1}')
+        self.assertResponse(ans, "json")
+
+    def test_pipe_json_a_invalid_json(self):
+        ans = s_pipe_a.txrx(b'{"--var_str": "value"')
+        self.assertResponse(ans, "json")
+        self.assertEqual(json.loads(ans)["response"], "")
+        self.assertNotEqual(json.loads(ans)["exception"], "")
+
+    def test_pipe_json_a_empty_line(self):
+        ans = s_pipe_a.txrx(b'\n{"--var_int": "3"}')
+        self.assertEqual(ans, b'{"response": {"var_str": null, "var_int": 3, "var_true": false, "_cmd": "pipe"}, "exception": "", "finished": 1}')
+        self.assertResponse(ans, "json")
+
+    def test_pipe_json_a_pipelined(self):
+        p = PipeRequest(pipe_autoformat)
+        p.p.stdin.write(b"".join(b'{"--var_int": "%d"}\n' % i for i in range(100)))
+        p.p.stdin.flush()
+        self.assertEqual([json.loads(p.p.stdout.readline())["response"]["var_int"] for _ in range(100)], list(range(100)))
+        self.assertEqual(json.loads(p.txrx(b'{"--var_int": "100"}'))["response"]["var_int"], 100)
+        p.p.stdin.write(b'{"--var_int": "101"}\n')
+        p.p.stdin.close()  # the response of the last line is flushed at the end of stdin
+        self.assertEqual(json.loads(p.p.stdout.read())["response"]["var_int"], 101)
+        p.p.wait()
+
+    def test_pipe_flush_pipelined(self):
+        writes = []
+
+        class Raw(io.RawIOBase):
+            def writable(self):
+                return True
+
+            def write(self, b):
+                writes.append(bytes(b))
+                return len(b)
+
+        r, w = os.pipe()
+        os.write(w, b'{"--a": "1"}\n{"--a": "2"}\n')
+        with open(r, "rb") as stdin, unittest.mock.patch("sys.stdin", unittest.mock.Mock(buffer=stdin)), \
+             unittest.mock.patch("sys.stdout", unittest.mock.Mock(buffer=io.BufferedWriter(Raw()))):
+            server = PipeServer()
+            for i in range(2):
+                self.assertEqual(server.get_msg(), [f"--a {i + 1}"])
+                server.send_msg(True, {"a": i + 1}, "")
+            self.assertEqual(writes, [])  # the second line was waiting, when the first response was written
+            os.write(w, b'{"--a": "3"}\n')
+            server.flush()
+            self.assertEqual(writes, [])  # the third line is waiting on the pipe
+            self.assertEqual(server.get_msg(), ["--a 3"])
+            server.send_msg(True, {"a": 3}, "")
+            server.flush()
+            self.assertEqual(b"".join(writes).count(b"\n"), 3)
+            self.assertEqual(len(writes), 1)
+            os.close(w)
+            self.assertIsNone(server.get_msg())
+
+    # Client with connection pool
+    def test_client_json_call(self):
+        with NapClient(port=port_start + 15) as c:
+            self.assertEqual(c.call({"--y": 0}, x=2, flag=True), {"sum": 2, "flag": True})
+            self.assertEqual(c.call({"-x": 3}), {"sum": 3, "flag": False})
+
+    def test_client_xml_call(self):
+        with NapClient(port=port_start + 15, fmt="xml") as c:
+            self.assertEqual(c.call({"--y": 5}, x=2), {"sum": "7", "flag": "False"})
+
+    def test_client_frame_attachment(self):
+        with NapClient(port=port_start + 15, fmt="frame") as c:
+            self.assertEqual(c.call(x=1, attachment=b"abc"), b"cba")
+
+    def test_client_remote_exception(self):
+        with NapClient(port=port_start + 15) as c:
+            with self.assertRaisesRegex(RemoteError, "negative"):
+                c.call(x=-1)
+            self.assertEqual(c.call(x=1), {"sum": 1, "flag": False})
+
+    def test_client_arguments(self):
+        self.assertEqual(_arguments({"--var_str": "a"}, {"x": 0, "max_size": 3, "flag": True, "none": None}),
+                         {"--var_str": "a", "-x": "0", "--max-size": "3", "--flag": ""})
+
+    def test_client_pool_reuse(self):
+        with NapClient(port=port_start + 15, pool_size=2) as c:
+            c.call(x=1)
+            conn = c._idle.queue[-1]
+            c.call(x=2)
+            self.assertIs(c._idle.queue[-1], conn)
+            self.assertEqual(c._idle.qsize(), 1)
+
+    def test_client_pipeline(self):
+        with NapClient(port=port_start + 15) as c:
+            ans = c.pipeline([{"-x": i} for i in range(20)] + [{"-x": -1}])
+            self.assertEqual([a["sum"] for a in ans[:-1]], list(range(20)))
+            self.assertIsInstance(ans[-1], RemoteError)
+
+    def test_client_pipeline_in_flight(self):
+        attachment = bytes(range(256)) * 400  # the unread responses would fill the socket buffers
+        with NapClient(port=port_start + 15, fmt="frame", timeout=20, max_in_flight=4) as c:
+            ans = c.pipeline([({"-x": 1}, attachment) for _ in range(300)])
+        self.assertEqual(ans, [attachment[::-1]] * 300)
+
+    def test_client_nodelay(self):
+        with NapClient(port=port_start + 15, fmt="frame") as c:
+            c.call(x=1, attachment=b"ab")
+            self.assertTrue(c._idle.queue[-1].sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+            start = time.monotonic()
+            for _ in range(20):  # header and attachment are not delayed by Nagle and delayed acks
+                self.assertEqual(c.call(x=1, attachment=b"ab" * 1000), b"ba" * 1000)
+            self.assertLess(time.monotonic() - start, 0.5)
+            ans = c.pipeline([({"-x": 1}, b"%d" % i) for i in range(100)])
+            self.assertEqual(ans, [(b"%d" % i)[::-1] for i in range(100)])
+
+    def test_output_not_held_during_func(self):
+        with socket.create_connection(("127.0.0.1", port_start + 27)) as s:
+            start = time.monotonic()
+            s.sendall(b'{"--sleep": "0"}{"--sleep": "0.25"}')  # pipelined
+            ans = b""
+            while not ans.endswith(b"}"):
+                ans += s.recv(1024)
+            self.assertLess(time.monotonic() - start, 0.15)
+            self.assertIn(b'"slept": 0.0', ans)
+            s.settimeout(5)
+            self.assertIn(b'"slept": 0.25', s.recv(1024))
+
+    def test_output_coalesce(self):
+        a, b = socket.socketpair()
+        with a, b:
+            out = Output(a, flush_count=3)
+            out.add(b"1")
+            out.add(b"2", memoryview(array("d", [0.5])))
+            self.assertFalse(out.full())
+            b.setblocking(False)
+            with self.assertRaises(BlockingIOError):
+                b.recv(100)
+            out.add(bytearray(b"3"))
+            self.assertTrue(out.full())
+            out.flush()
+            self.assertEqual(b.recv(100), b"12" + array("d", [0.5]).tobytes() + b"3")
+            self.assertEqual((out.bufs, out.size, out.count), ([], 0, 0))
+
+    def test_client_batch(self):
+        with NapClient(port=port_start + 15, fmt="frame", pool_size=3) as c:
+            ans = c.batch([({"-x": i}, None) for i in range(10)] + [({"-x": 1}, b"xy")])
+            self.assertEqual([a["sum"] for a in ans[:-1]], list(range(10)))
+            self.assertEqual(ans[-1], b"yx")
+            self.assertEqual(c._idle.qsize(), 3)
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "unix sockets are not supported")
+    def test_client_unix(self):
+        with NapClient(unix=unix_path, pool_size=2) as c:
+            self.assertEqual(c.batch([{"-x": i, "--y": 1} for i in range(4)]), [{"sum": i + 1, "flag": False} for i in range(4)])
+
+    def test_client_http_keep_alive(self):
+        with NapClient(port=port_start + 16, http=True, pool_size=1) as c:
+            self.assertEqual(c.call(x=4, flag=True), {"sum": 4, "flag": True})
+            conn = c._idle.queue[-1]
+            sock = conn.sock
+            self.assertEqual(c.pipeline([{"-x": 1}, ({"-x": 1}, b"ab")]), [{"sum": 1, "flag": False}, b"ba"])
+            self.assertIs(conn.sock, sock)
+
+    def test_client_http_xml_exception(self):
+        with NapClient(port=port_start + 16, http=True, fmt="xml") as c:
+            with self.assertRaisesRegex(RemoteError, "negative"):
+                c.call(x=-1)
+
+    # Request id and asyncio client
+    def test_plain_json_id_echo(self):
+        ans = s_tcp_client.txrx_complete(b'{"-x": "1", "nap_id": 7}')
+        self.assertEqual(ans, b'{"response": {"sum": 1, "flag": false}, "exception": "", "id": 7, "finished": 1}')
+
+    def test_plain_xml_id_echo(self):
+        s_tcp_client.s.sendall(b"<nap><_x>-1</_x><nap_id>a1</nap_id></nap>")
+        ans = s_tcp_client.s.recv(1024)
+        self.assertEqual(ans, b"<nap><response></response><exception>negative</exception><id>a1</id><finished>1</finished></nap>")
+
+    def test_frame_id_echo(self):
+        env, att = s_tcp_client.txrx_frame(MessageFrame.pack({"-x": "1", "nap_id": 3}, b"ab") + b"ab")
+        self.assertEqual(json.loads(env), {"response": "", "exception": "", "id": 3, "finished": 1})
+        self.assertEqual(att, b"ba")
+
+    def test_async_client_gather(self):
+        async def run():
+            async with AsyncNapClient(port=port_start + 15, connections=2, max_in_flight=8) as c:
+                ans = await asyncio.gather(*[c.call(x=i, flag=i % 2 == 0) for i in range(50)])
+                self.assertEqual(len(c._conns), 2)
+                return ans
+        ans = asyncio.run(run())
+        self.assertEqual(ans, [{"sum": i, "flag": i % 2 == 0} for i in range(50)])
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "unix sockets are not supported")
+    def test_async_client_xml_frame_unix(self):
+        async def run():
+            async with AsyncNapClient(unix=unix_path, fmt="xml") as c:
+                self.assertEqual(await c.call({"--y": 2}, x=1), {"sum": "3", "flag": "False"})
+            async with AsyncNapClient(port=port_start + 15, fmt="frame") as c:
+                return await asyncio.gather(c.call(x=1, attachment=b"xyz"), c.call(x=2), return_exceptions=True)
+        self.assertEqual(asyncio.run(run()), [b"zyx", {"sum": 2, "flag": False}])
+
+    def test_async_client_remote_exception(self):
+        async def run():
+            async with AsyncNapClient(port=port_start + 15) as c:
+                return await asyncio.gather(c.call(x=-1), c.call(x=1), return_exceptions=True)
+        ans = asyncio.run(run())
+        self.assertIsInstance(ans[0], RemoteError)
+        self.assertEqual(ans[1], {"sum": 1, "flag": False})
+
+    def test_async_client_timeout(self):
+        async def run():
+            async with AsyncNapClient(port=port_start + 1, timeout=0.05) as c:
+                await c.call({"--var_str": "a", "--var_int": 1})
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(run())
+
+    def test_async_client_late_response_without_id(self):
+        async def script(reader, writer):  # answers in order, the first one late and without id
+            await reader.readuntil(b"}")
+            await asyncio.sleep(0.2)
+            writer.write(b'{"response": "late", "exception": "", "finished": 1}')
+            await reader.readuntil(b"}")
+            writer.write(b'{"response": "second", "exception": "", "id": 2, "finished": 1}')
+            await writer.drain()
+
+        async def run():
+            server = await asyncio.start_server(script, "127.0.0.1", 0)
+            async with server, AsyncNapClient(port=server.sockets[0].getsockname()[1], connections=1) as c:
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(c.call(x=1), 0.05)
+                return await c.call(x=2)
+        self.assertEqual(asyncio.run(run()), "second")
+
+    def test_async_client_timeout_keeps_slot(self):
+        received = []
+
+        async def script(reader, writer):  # never answers
+            while True:
+                received.append(await reader.readuntil(b"}"))
+
+        async def run():
+            server = await asyncio.start_server(script, "127.0.0.1", 0)
+            async with server, AsyncNapClient(port=server.sockets[0].getsockname()[1], connections=1,
+                                              max_in_flight=1, timeout=0.1) as c:
+                for i in range(5):
+                    with self.assertRaises(asyncio.TimeoutError):
+                        await c.call(x=i)
+                return len(c._conns[0].pending)
+        self.assertEqual(asyncio.run(run()), 1)
+        self.assertEqual(len(received), 1)
+
+    # Benchmark
+    def bench_args(self, *argv):
+        parser = argparse.ArgumentParser()
+        bench.add_arguments(parser)
+        return parser.parse_args(argv)
+
+    def test_bench_closed_loop(self):
+        out = os.path.join(tempfile.gettempdir(), f"nap_bench_{os.getpid()}.json")
+        bench.main(self.bench_args("-p", str(port_start + 15), "-c", "2", "-n", "40", "--args", '{"-x": "1"}', "-o", out))
+        with open(out) as f:
+            ans = json.load(f)
+        os.remove(out)
+        self.assertEqual((ans["requests"], ans["ok"], ans["errors"]), (40, 40, {"remote": 0, "overload": 0, "connection": 0}))
+        self.assertEqual(list(ans["latency_ms"]), ["min", "mean", "p50", "p90", "p99", "p999", "max"])
+        self.assertLessEqual(ans["latency_ms"]["p50"], ans["latency_ms"]["p999"])
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "unix sockets are not supported")
+    def test_bench_open_loop_errors(self):
+        ans = bench.run(self.bench_args("-u", unix_path, "-r", "200", "-n", "20", "--format", "xml", "--args", '{"-x": "-1"}'))
+        self.assertEqual(ans["config"]["mode"], "open")
+        self.assertEqual(ans["errors"]["remote"], 20)
+        self.assertGreaterEqual(ans["duration_s"], 19 / 200)
+
+    def test_bench_percentile(self):
+        lat = list(range(1, 1001))
+        self.assertEqual([bench.percentile(lat, p) for p in bench.PERCENTILES], [500, 900, 990, 999])
+        self.assertEqual(bench.percentile([], 50), 0.0)
+
+    # Instrumentation
+    def test_instrument_tcp_record(self):
+        records["tcp"].clear()
+        with NapClient(port=port_start + 17) as c:
+            self.assertEqual(c.call(x=1), {"sum": 1, "flag": False})
+        time.sleep(0.1)
+        rec = records["tcp"][-1]
+        self.assertEqual(list(rec), ["recv", "received", "dequeued", "decoded", "split", "parsed", "func",
+                                     "delayed", "formatted", "sent"])
+        self.assertEqual(list(rec.values()), sorted(rec.values()))
+        self.assertEqual(list(Instrumentation.durations(rec)), list(STAGES))
+
+    def test_instrument_tcp_timing_opt_in(self):
+        ans = s_tcp_instr.txrx_complete(b'{"-x": "-1", "nap_timing": 1}')
+        d = json.loads(ans)
+        self.assertEqual(d["exception"], "negative")
+        self.assertEqual(list(d["timing"]), ["receive", "queue", "decode", "split", "parse_args"])
+        ans = s_tcp_instr.txrx_complete(b'{"-x": "1"}')
+        self.assertNotIn(b"timing", ans)
+
+    def test_instrument_http_timing(self):
+        records["http"].clear()
+        ans = requests.get(f"http://localhost:{port_start + 18}/xml?-x=2")
+        root = ElementTree.fromstring(ans.text)
+        self.assertEqual([e.tag for e in root.find("timing")], list(STAGES)[:7])
+        time.sleep(0.1)
+        self.assertIn("sent", records["http"][-1])
+
+    # Metrics
+    def metric(self, text, name):
+        for line in text.splitlines():
+            if line.startswith(name + " "):
+                return float(line.split(" ")[1])
+        return None
+
+    def test_metrics_http(self):
+        before = requests.get(f"http://localhost:{port_start + 19}/metrics").text
+        for x in (1, 2, -1):
+            requests.get(f"http://localhost:{port_start + 19}/?-x={x}")
+        time.sleep(0.1)
+        ans = requests.get(f"http://localhost:{port_start + 19}/metrics")
+        self.assertTrue(ans.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+        for name, diff in (("nap_requests_total", 3), ("nap_errors_total", 1),
+                           ('nap_stage_duration_seconds_count{stage="func"}', 2),
+                           ('nap_stage_duration_seconds_count{stage="parse_args"}', 3),
+                           ("nap_request_duration_seconds_count", 3)):
+            self.assertEqual(self.metric(ans.text, name) - self.metric(before, name), diff, name)
+        self.assertEqual(self.metric(ans.text, "nap_in_flight"), 0)
+        self.assertGreater(self.metric(ans.text, "nap_sent_bytes_total"), 0)
+        self.assertIn('nap_stage_duration_seconds_bucket{stage="func",le="+Inf"}', ans.text)
+
+    def test_metrics_tcp_side_port(self):
+        with NapClient(port=port_start + 20) as c:
+            c.batch([{"-x": str(i)} for i in range(5)])
+        time.sleep(0.1)
+        text = requests.get(f"http://localhost:{port_start + 21}/metrics").text
+        self.assertGreaterEqual(self.metric(text, "nap_requests_total"), 5)
+        self.assertEqual(self.metric(text, "nap_queue_depth"), 0)
+        self.assertEqual(requests.get(f"http://localhost:{port_start + 21}/").status_code, 404)
+
+    def test_metrics_render_merge(self):
+        m = Metrics()
+        snap = m.snapshot()
+        snap["counters"]["requests"] = 4
+        self.assertEqual(self.metric(m.render(snap, snap).decode(), "nap_requests_total"), 8)
+
+    def test_metrics_shards(self):
+        m = Metrics(shards=4)
+        rec = m.record()
+        thrds = [Thread(target=m.on_request, args=(rec,)) for _ in range(4)]
+        for thrd in thrds:
+            thrd.start()
+            thrd.join()  # the threads may get the same id one after another
+        self.assertEqual([shard.counters["requests"] for shard in m.shards], [1, 1, 1, 1])
+        self.assertEqual(m.snapshot()["counters"]["requests"], 4)
+
+    def test_health_http(self):
+        for path in ("healthz", "readyz"):
+            ans = requests.get(f"http://localhost:{port_start + 16}/{path}")
+            self.assertEqual(ans.status_code, 200)
+            self.assertEqual(ans.json(), {"status": "ok", "queue_depth": 0, "in_flight": 0})
+
+    def test_health_http_saturated(self):
+        url = f"http://localhost:{port_start + 24}"
+        thrds = [Thread(target=requests.get, args=(f"{url}/?--sleep=0.5",)) for _ in range(3)]
+        for thrd in thrds:
+            thrd.start()
+        time.sleep(0.2)
+        start = time.monotonic()
+        ans = requests.get(f"{url}/healthz")
+        self.assertLess(time.monotonic() - start, 0.3)  # not queued behind the slow requests
+        self.assertEqual(ans.status_code, 200)
+        self.assertEqual(ans.json()["in_flight"], 3)
+        ans = requests.get(f"{url}/readyz")
+        self.assertEqual(ans.status_code, 503)
+        self.assertEqual(ans.json(), {"status": "saturated", "queue_depth": 2, "in_flight": 3})
+        for thrd in thrds:
+            thrd.join()
+        self.assertEqual(requests.get(f"{url}/readyz").status_code, 200)
+
+    def test_health_tcp_side_port(self):
+        ans = requests.get(f"http://localhost:{port_start + 21}/readyz")
+        self.assertEqual(ans.status_code, 200)
+        self.assertEqual(ans.json()["status"], "ok")
+
+    def test_shed_http_in_flight(self):
+        url = f"http://localhost:{port_start + 25}"
+        thrd = Thread(target=requests.get, args=(f"{url}/?--sleep=0.4",))
+        thrd.start()
+        time.sleep(0.1)
+        ans = requests.get(f"{url}/?--sleep=0&nap_id=3")
+        self.assertEqual(ans.status_code, 503)
+        self.assertEqual(ans.headers["Retry-After"], "1")
+        self.assertTrue(ans.json()["exception"].startswith("Overloaded"))
+        self.assertEqual(ans.json()["id"], "3")
+        with NapClient(port=port_start + 25, http=True) as c:
+            with self.assertRaises(OverloadError):
+                c.call(sleep=0)
+        thrd.join()
+        self.assertEqual(requests.get(f"{url}/?--sleep=0").status_code, 200)
+        text = requests.get(f"{url}/metrics").text  # the rejected requests are not waiting
+        self.assertEqual(self.metric(text, "nap_queue_depth"), 0)
+        self.assertEqual(self.metric(text, "nap_in_flight"), 0)
+
+    def test_shed_tcp_queue(self):
+        results = {}
+
+        def call(name, sleep):
+            with NapClient(port=port_start + 26) as c:
+                try:
+                    results[name] = c.call(sleep=sleep)
+                except OverloadError as e:
+                    results[name] = e
+
+        thrds = [Thread(target=call, args=("running", 0.4))]
+        thrds[0].start()
+        time.sleep(0.1)
+        thrds.append(Thread(target=call, args=("queued", 0.01)))
+        thrds[1].start()
+        time.sleep(0.1)
+        start = time.monotonic()
+        call("rejected", 0.02)
+        self.assertLess(time.monotonic() - start, 0.2)  # not queued behind the running request
+        for thrd in thrds:
+            thrd.join()
+        self.assertEqual(results["running"], {"slept": 0.4})
+        self.assertIn("requests wait", str(results["rejected"]))
+        self.assertIn("waited", str(results["queued"]))  # dropped by the queue time, not run
+        self.assertNotIn(0.01, slept)
+        self.assertNotIn(0.02, slept)
+
+    def test_deadline_running(self):
+        with NapClient(port=port_start + 27) as c:
+            start = time.monotonic()
+            with self.assertRaisesRegex(DeadlineError, "did not return"):
+                c.call(sleep=0.8)
+            self.assertLess(time.monotonic() - start, 0.6)
+            time.sleep(0.6)  # the main function is still running
+            self.assertEqual(c.call(sleep=0), {"slept": 0.0})  # the late response is dropped
+
+    def test_deadline_file_removed(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        with NapClient(port=port_start + 27) as c:
+            with self.assertRaises(DeadlineError):
+                c.call({"nap_timeout": 0.1}, sleep=0.3, file=path)
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(c.call(sleep=0), {"slept": 0.0})  # after the late response
+        self.assertFalse(os.path.exists(path))
+
+    def test_deadline_client_timeout(self):
+        with NapClient(port=port_start + 27) as c:
+            start = time.monotonic()
+            with self.assertRaises(DeadlineError):
+                c.call({"nap_timeout": 0.1, "nap_id": 5}, sleep=0.4)
+            self.assertLess(time.monotonic() - start, 0.3)
+            time.sleep(0.4)
+            self.assertEqual(c.call(sleep=0), {"slept": 0.0})
+
+    def test_deadline_queued(self):
+        thrd = Thread(target=lambda: NapClient(port=port_start + 27).call(sleep=0.25))
+        thrd.start()
+        time.sleep(0.05)
+        with NapClient(port=port_start + 27) as c:
+            with self.assertRaisesRegex(DeadlineError, "before the main function"):
+                c.call({"nap_timeout": 0.1}, sleep=0.051)
+        thrd.join()
+        self.assertNotIn(0.051, slept)
+
+    def assertClosed(self, s, msg=b""):
+        try:
+            self.assertEqual(s.txrx(msg) if msg else s.s.recv(1024), b"")
+        except ConnectionResetError:
+            pass  # closed with unread data
+
+    def test_limits_tcp_idle(self):
+        s = TcpSocketRequest(port_start + 28)
+        self.assertEqual(s.txrx(b'{"-x": "1"}'), b'{"response": {"sum": 1, "flag": false}, "exception": "", "finished": 1}')
+        time.sleep(0.5)
+        self.assertClosed(s)  # closed after the idle timeout
+
+    def test_limits_tcp_read(self):
+        s = TcpSocketRequest(port_start + 28)
+        s.s.sendall(b'{"-x": ')
+        start = time.monotonic()
+        self.assertClosed(s)  # half a message is not completed in time
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_limits_tcp_size(self):
+        s = TcpSocketRequest(port_start + 28)
+        self.assertClosed(s, json.dumps({"-x": "1", "--flag": "x" * 100}).encode())
+        s = TcpSocketRequest(port_start + 28)
+        self.assertClosed(s, b'{"-x": "' + b"1" * 200)
+
+    def test_limits_tcp_compressed(self):
+        env, bomb = zlib.compress(b'{"-x": 1}'), zlib.compress(b"\0" * 10000, 9)  # the frame is within the limit
+        s = TcpSocketRequest(port_start + 28)
+        env, att = s.txrx_frame(MessageFrame._header(len(env), len(bomb), MessageFrame.COMPRESSED) + env + bomb)
+        self.assertIn("exceeds 100 bytes", json.loads(env)["exception"])
+
+    def test_limits_tcp_messages(self):
+        s = TcpSocketRequest(port_start + 28)
+        for x in (1, 2):
+            self.assertIn(b'"sum": %d' % x, s.txrx(b'{"-x": "%d"}' % x))
+        self.assertClosed(s, b'{"-x": "3"}')
+
+    def test_limits_http(self):
+        url = f"http://localhost:{port_start + 29}"
+        self.assertEqual(requests.post(f"{url}/?-x=1", data=b"x" * 11).status_code, 413)
+        with requests.Session() as session:
+            self.assertNotIn("Connection", session.get(f"{url}/?-x=1").headers)
+            self.assertEqual(session.get(f"{url}/?-x=1").headers["Connection"], "close")
+            self.assertEqual(session.get(f"{url}/?-x=2").json()["response"]["sum"], 2)  # on a new connection
+
+    def test_limits_http_content_length(self):
+        for header in (b"Content-Length: -5\r\n", b"Content-Length: abc\r\n", b""):
+            with socket.create_connection(("localhost", port_start + 29)) as sock:
+                sock.sendall(b"POST /?-x=1 HTTP/1.1\r\nHost: localhost\r\n" + header + b"\r\n" + b"x" * 100)
+                self.assertTrue(sock.recv(1024).startswith(b"HTTP/1.1 400"))
+
+    def test_functions_tcp(self):
+        with NapClient(port=port_start + 30) as c:
+            self.assertEqual(c.call({"nap_func": "add"}, a=1, b=2), {"sum": 3})
+            self.assertEqual(c.call({"nap_func": "upper"}, text="abc"), {"text": "ABC"})
+            self.assertEqual(c.call(x=1), {"sum": 1, "flag": False})  # the main function
+            with self.assertRaisesRegex(RemoteError, "Unknown function"):
+                c.call({"nap_func": "nope"})
+        with NapClient(port=port_start + 30, fmt="frame") as c:
+            self.assertEqual(c.call({"nap_func": "add"}, a=2), {"sum": 2})
+
+    def test_functions_http(self):
+        url = f"http://localhost:{port_start + 31}"
+        self.assertEqual(requests.get(f"{url}/add?-a=1&-b=2").json()["response"], {"sum": 3})
+        self.assertEqual(ElementTree.fromstring(requests.get(f"{url}/upper/xml?--text=abc").text).findtext("response/text"),
+                         "ABC")
+        self.assertEqual(requests.get(f"{url}/?nap_func=add&-a=4").json()["response"], {"sum": 4})
+        self.assertIn("`nap_func` is missing", requests.get(f"{url}/?-a=1").json()["exception"])
+        self.assertEqual(requests.get(f"{url}/nope").status_code, 400)
+
+    def test_functions_main(self):
+        nap = NetArgumentParser()
+        called = []
+        nap.add_function("add", lambda args: called.append(args.a)).add_argument("-a", type=int)
+        nap(parse_args=["add", "-a", "5"])
+        self.assertEqual(called, [5])
+        with self.assertRaises(Exception):
+            nap(parse_args=["main"])
+        for name in ("nap", "healthz", "readyz", "metrics", "_nap", "add"):
+            with self.assertRaisesRegex(ValueError, "reserved"):
+                nap.add_function(name, print)
+
+    def test_lanes_order(self):
+        lanes = Scheduler([Lane.parse("a:3"), Lane("b", 1)])
+        for i in range(8):
+            lanes.put(("a", i), "a")
+            lanes.put(("b", i), "b")
+        lanes.put("wakeup")
+        self.assertEqual(lanes.get(), "wakeup")
+        order = [lanes.get() for _ in range(8)]
+        self.assertEqual([item for item in order if item[0] == "a"], [("a", i) for i in range(6)])
+        self.assertEqual([item for item in order if item[0] == "b"], [("b", 0), ("b", 1)])
+        self.assertEqual(lanes.lane({"nap_priority": "b", "nap_func": "a"}), "b")
+        self.assertEqual(lanes.lane({"nap_priority": "c", "nap_func": "a"}), "a")
+        self.assertEqual(lanes.lane({}), "default")
+        with self.assertRaisesRegex(Exception, "Invalid lane"):
+            Lane.parse("a")
+
+    def test_lanes_fair(self):
+        lanes = Scheduler()
+        for i in range(3):
+            lanes.put(("x", i), "default", "x")
+        lanes.put(("y", 0), "default", "y")
+        lanes.put(("z", 0), "default", "z")
+        self.assertEqual([lanes.get() for _ in range(5)], [("x", 0), ("y", 0), ("z", 0), ("x", 1), ("x", 2)])
+        self.assertEqual(Scheduler.client({"nap_key": "k"}, ("1.2.3.4", 5)), "key k")
+        self.assertEqual(Scheduler.client({}, ("1.2.3.4", 5)), "1.2.3.4")
+
+    def test_lanes_rate(self):
+        lanes = Scheduler(rate=10, burst=2)
+        self.assertEqual([lanes.admit("default", "x") is None for _ in range(3)], [True, True, False])
+        self.assertIsNone(lanes.admit("default", "y"))
+        time.sleep(0.25)
+        self.assertIsNone(lanes.admit("default", "x"))  # refilled
+        self.assertEqual(list(lanes.buckets), ["x"])  # the full bucket of y was forgotten
+
+    def test_rate_tcp(self):
+        with NapClient(port=port_start + 34) as c:
+            self.assertEqual(c.call(sleep=0), {"slept": 0.0})
+            self.assertEqual(c.call(sleep=0), {"slept": 0.0})
+            with self.assertRaisesRegex(OverloadError, "client `127.0.0.1` exceeds 2 requests/s"):
+                c.call(sleep=0)
+            self.assertEqual(c.call({"nap_key": "other"}, sleep=0), {"slept": 0.0})
+            time.sleep(0.6)
+            self.assertEqual(c.call(sleep=0), {"slept": 0.0})
+
+    def test_lanes_tcp(self):
+        results = {}
+
+        def call(name, sleep):
+            with NapClient(port=port_start + 32) as c:
+                try:
+                    results[name] = c.call({"nap_priority": "slow"}, sleep=sleep)
+                except OverloadError as e:
+                    results[name] = e
+
+        thrds = [Thread(target=call, args=(f"slow{i}", 0.2 + i / 1000)) for i in range(3)]
+        for thrd in thrds:
+            thrd.start()
+            time.sleep(0.02)
+        call("rejected", 0.01)
+        with NapClient(port=port_start + 32) as c:
+            start = time.monotonic()
+            self.assertEqual(c.call({"nap_priority": "fast"}, sleep=0), {"slept": 0.0})
+            self.assertLess(time.monotonic() - start, 0.3)  # only waits for the running slow request
+        for thrd in thrds:
+            thrd.join()
+        self.assertIn("lane `slow` has 3 requests in flight", str(results["rejected"]))
+        self.assertEqual(results["slow2"], {"slept": 0.202})
+        self.assertLess(slept.index(0.0), slept.index(0.202))
+
+    def test_lanes_http(self):
+        url = f"http://localhost:{port_start + 33}"
+        thrds = [Thread(target=requests.get, args=(f"{url}/?--sleep=0.2{i}",)) for i in range(3)]
+        for thrd in thrds:
+            thrd.start()
+            time.sleep(0.02)
+        start = time.monotonic()
+        self.assertEqual(requests.get(f"{url}/?nap_priority=fast&--sleep=0").json()["response"], {"slept": 0.0})
+        self.assertLess(time.monotonic() - start, 0.35)
+        for thrd in thrds:
+            thrd.join()
+
+    def test_warmup_tcp(self):
+        self.assertEqual(warm["calls"][:2], [0.1, 0.2])  # before the port was reachable
+        with NapClient(port=port_start + 35) as c:
+            self.assertGreaterEqual(c.call(sleep=0)["calls"], 3)
+
+    def test_warmup_main(self):
+        nap = sleep_parser()
+        context = []
+        nap(lambda args: context.append(args._context), setup=lambda: "ctx", warmup=[{"--sleep": 1}],
+            parse_args=["main"])
+        self.assertEqual(context, ["ctx"])  # no warm-up standalone
+        with self.assertRaisesRegex(Exception, "Warm-up with .* failed"):
+            nap(sleep_main, warmup=[{"--nope": 1}], parse_args=["pipe"])
+        with self.assertRaisesRegex(Exception, "Binary responses need a frame"):  # the response is formatted
+            nap(lambda args: b"raw", warmup=[{"--sleep": "0", "nap_id": 1}], parse_args=["pipe"])
+
+    def test_warmup_options_first(self):
+        setups = []
+        with self.assertRaisesRegex(Exception, "only supported for plain tcp"):
+            sleep_parser()(sleep_main, setup=lambda: setups.append(1), warmup=[{"--sleep": "0"}],
+                           parse_args=["nap", "--unix", "nap.sock", "--http"])
+        with self.assertRaisesRegex(Exception, "One of `--port`"):
+            sleep_parser()(sleep_main, setup=lambda: setups.append(1), parse_args=["nap"])
+        self.assertEqual(setups, [])
+
+    def test_call(self):
+        nap = functions_parser()
+        self.assertEqual(nap.call(client_main, {"-x": 2, "--y": 3, "nap_id": 7}),
+                         {"response": {"sum": 5, "flag": False}, "exception": "", "id": 7, "finished": 1})
+        self.assertEqual(nap.call(None, {"nap_func": "add", "-a": 1, "-b": 2})["response"], {"sum": 3})
+        self.assertEqual(nap.call(client_main, {"-x": -1})["exception"], "negative")
+        self.assertIn("Timeout", nap.call(client_main, {"-x": 1, "nap_timeout": 0})["exception"])
+        self.assertIn("`nap_func` is missing", nap.call(None, {"-x": 1})["exception"])
+        context = []
+        nap.call(lambda args: context.append((args._cmd, args._context)) or {}, {"-x": 1}, context="ctx")
+        self.assertEqual(context, [("nap", "ctx")])  # like in nap mode
+
+    def test_call_raw(self):
+        nap = client_parser()
+        self.assertEqual(nap.call_raw(b'{"-x": 2, "nap_id": 1}', client_main),
+                         b'{"response": {"sum": 2, "flag": false}, "exception": "", "id": 1, "finished": 1}')
+        self.assertEqual(nap.call_raw(b"<nap><_x>2</_x><__flag></__flag></nap>", client_main),
+                         b"<nap><response><sum>2</sum><flag>True</flag></response><exception></exception>"
+                         b"<finished>1</finished></nap>")
+        resp = nap.call_raw(MessageFrame.pack({"-x": 1}, b"abc") + b"abc", client_main)
+        flags, env, att = MessageFrame._lengths(resp)
+        self.assertEqual(resp[-att:], b"cba")
+        with self.assertRaisesRegex(Exception, "unknown message format"):
+            nap.call_raw(b"-x 1", client_main)
+        nap = NetArgumentParser()
+        nap.add_argument("--mode", type=str)
+        self.assertEqual(nap.call_raw(b'{"--mode": "file"}', binary_main),
+                         b'{"response": {"a": 1}, "exception": "", "finished": 1}')
+        self.assertIn("need a frame", nap.call(compress_main, {"--mode": "binary"})["exception"])
+
+    @staticmethod
+    def call_script(port, sleep=0):
+        with NapClient(port=port) as c:
+            return c.call(sleep=sleep)["pid"]
+
+    @staticmethod
+    def script_path():
+        path = os.path.join(tempfile.gettempdir(), f"nap_restart_{os.getpid()}.py")
+        with open(path, "w") as f:
+            f.write(restart_script)
+        return path
+
+    def start_script(self, port, *args):
+        p = subprocess.Popen([sys.executable, self.script_path(), "nap", "-p", str(port), *args],
+                             stdout=subprocess.DEVNULL)
+        for _ in range(100):
+            try:
+                return p, self.call_script(port)
+            except OSError:
+                time.sleep(0.1)
+        p.kill()
+        raise ConnectionRefusedError()
+
+    def test_lazy_imports(self):
+        script = ("import sys; from netargparse import NetArgumentParser; "
+                  "lazy = {'netargparse.server', 'netargparse.message', 'json', 'socket', 'http.server'}; "
+                  "print(sorted(lazy & set(sys.modules))); from netargparse import FileResponse")
+        out = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(out.strip(), "[]")
+
+    def test_restart_drain(self):
+        p, pid = self.start_script(port_start + 36)
+        results = []
+        thrd = Thread(target=lambda: results.append(self.call_script(port_start + 36, 1)))
+        thrd.start()
+        time.sleep(0.1)
+        p.send_signal(signal.SIGTERM)
+        time.sleep(0.7)
+        self.assertIsNone(p.poll())  # still answering the request in flight
+        with self.assertRaises(ConnectionRefusedError):
+            self.call_script(port_start + 36)
+        thrd.join()
+        self.assertEqual(results, [pid])
+        self.assertEqual(p.wait(5), 0)
+
+    @unittest.skipUnless(hasattr(signal, "SIGHUP"), "SIGHUP is not supported")
+    def test_restart_reexec(self):
+        p, pid = self.start_script(port_start + 37, "--drain-timeout", "10")
+        p.send_signal(signal.SIGHUP)
+        new = pid
+        end = time.monotonic() + 20
+        while new == pid and time.monotonic() < end:
+            new = self.call_script(port_start + 37)  # never refused during the handoff
+            time.sleep(0.05)
+        self.assertNotEqual(new, pid)
+        self.assertEqual(p.wait(5), 0)
+        os.kill(new, signal.SIGTERM)
+        for _ in range(50):
+            try:
+                self.call_script(port_start + 37)
+                time.sleep(0.1)
+            except OSError:
+                break
+        else:
+            self.fail("The new process did not drain.")
+
+    def test_restart_command(self):
+        orig = ["python", "-X", "dev", "-O", "script.py", "nap", "--port", "1"]
+        with unittest.mock.patch.object(sys, "orig_argv", orig, create=True), \
+                unittest.mock.patch.object(sys, "argv", ["script.py", "nap", "--port", "1"]):
+            self.assertEqual(command(["script.py", "nap", "--port", "2"]),
+                             ["python", "-X", "dev", "-O", "script.py", "nap", "--port", "2"])
+        orig = ["python", "-m", "pkg", "nap"]
+        with unittest.mock.patch.object(sys, "orig_argv", orig, create=True), \
+                unittest.mock.patch.object(sys, "argv", ["/path/pkg/__main__.py", "nap"]):
+            self.assertEqual(command(["/path/pkg/__main__.py", "nap"]), ["python", "-m", "pkg", "nap"])
+
+    @unittest.skipIf(os.name == "nt", "file descriptors of sockets cannot be inherited")
+    def test_inherited_fd(self):
+        with socket.create_server(("127.0.0.1", port_start + 38)) as sock:
+            early = socket.create_connection(("127.0.0.1", port_start + 38))  # queued by the kernel
+            early.sendall(b'{"--sleep": "0"}')
+            p = subprocess.Popen([sys.executable, self.script_path(), "nap", "--fd", str(sock.fileno())],
+                                 pass_fds=(sock.fileno(),), stdout=subprocess.DEVNULL)
+            try:
+                early.settimeout(20)
+                self.assertIn(b'"pid": %d' % p.pid, early.recv(1024))
+                self.assertEqual(self.call_script(port_start + 38), p.pid)
+            finally:
+                early.close()
+                p.terminate()
+                self.assertEqual(p.wait(5), 0)
+
+    @unittest.skipIf(os.name == "nt", "file descriptors of sockets cannot be inherited")
+    def test_inherited_listen_fds(self):
+        with socket.create_server(("127.0.0.1", port_start + 39)) as sock:
+            fd = sock.fileno()
+            systemd = (f"import os, sys; os.dup2({fd}, 3); os.close({fd}); "
+                       f"os.environ.update(LISTEN_FDS='1', LISTEN_PID=str(os.getpid())); "
+                       f"os.execv(sys.executable, [sys.executable, {self.script_path()!r}, 'nap', '--http'])")
+            p = subprocess.Popen([sys.executable, "-c", systemd], pass_fds=(fd,), stdout=subprocess.DEVNULL)
+            try:
+                ans = requests.get(f"http://localhost:{port_start + 39}/?--sleep=0", timeout=20)
+                self.assertEqual(ans.json()["response"], {"pid": p.pid})
+            finally:
+                p.terminate()
+                self.assertEqual(p.wait(5), 0)
+        with self.assertRaisesRegex(Exception, "LISTEN_FDS"):
+            NetArgumentParser()(print, parse_args=["nap"])
+
+    def test_admin_tcp_profile(self):
+        with NapClient(port=port_start + 22) as c:
+            report = []
+            thrd = Thread(target=lambda: report.append(c.call({"nap_cmd": "profile", "nap_seconds": 0.5, "nap_limit": 10})))
+            thrd.start()
+            time.sleep(0.1)
+            self.assertEqual(c.call({"-x": "1", "--y": "2"})["sum"], 3)  # answered during the window
+            thrd.join()
+        self.assertIn("parse_args", report[0]["stats"])
+        self.assertEqual(report[0]["seconds"], 0.5)
+
+    def test_admin_tcp_profile_ends_without_traffic(self):
+        with NapClient(port=port_start + 22) as c:
+            start = time.monotonic()
+            report = c.call({"nap_cmd": "profile", "nap_seconds": 0.2})
+            self.assertLess(time.monotonic() - start, 2)
+            self.assertIn("function calls", report["stats"])
+
+    def test_admin_tcp_profile_pstats(self):
+        with NapClient(port=port_start + 22, fmt="frame") as c:
+            dump = c.call({"nap_cmd": "profile", "nap_seconds": 0.2, "nap_format": "pstats"})
+        self.assertIsInstance(marshal.loads(bytes(dump)), dict)
+
+    def test_admin_tcp_errors(self):
+        with NapClient(port=port_start + 15) as c:
+            with self.assertRaisesRegex(RemoteError, "--admin"):
+                c.call({"nap_cmd": "profile", "nap_seconds": 0.1})
+        with NapClient(port=port_start + 22) as c:
+            with self.assertRaisesRegex(RemoteError, "Unknown"):
+                c.call({"nap_cmd": "nope"})
+
+    def test_admin_http_tracemalloc(self):
+        ans = requests.get(f"http://localhost:{port_start + 23}/_nap/tracemalloc?seconds=0.3&limit=5")
+        self.assertEqual(ans.headers["Content-Type"], "text/plain; charset=utf-8")
+        self.assertLessEqual(len(ans.text.splitlines()), 5)
+
+    def test_admin_http_profile(self):
+        ans = requests.get(f"http://localhost:{port_start + 23}/_nap/profile?seconds=0.2&sort=tottime")
+        self.assertIn("Ordered by: internal time", ans.text)
+        ans = requests.get(f"http://localhost:{port_start + 16}/_nap/profile?seconds=0.1").json()
+        self.assertIn("--admin", ans["exception"])
+
 
 if __name__ == "__main__":
     for t in [tcp_socket_no_autoformat, tcp_socket_autoformat, tcp_socket_autoformat_nargs_append, tcp_socket_no_args,
               http_no_autoformat, http_autoformat, http_autoformat_nargs_append, http_no_args, http_nested_dict,
-              http_autoformat_no_dict]:
+              http_autoformat_no_dict, tcp_socket_shm, tcp_socket_binary, http_binary,
+              tcp_socket_compress, http_compress, tcp_socket_client, http_client,
+              tcp_socket_instrument, http_instrument, http_metrics, tcp_socket_metrics, tcp_socket_admin, http_admin,
+              http_health, http_shed, tcp_socket_shed, tcp_socket_deadline, tcp_socket_limits, http_limits,
+              tcp_socket_functions, http_functions, tcp_socket_lanes, http_lanes, tcp_socket_rate, tcp_socket_warm]:
         Thread(target=t, daemon=True).start()
+    if hasattr(socket, "AF_UNIX"):
+        Thread(target=unix_socket_client, daemon=True).start()
 
     for i in range(10):
         if i == 9:
@@ -464,6 +1774,60 @@ if __name__ == "__main__":
                 s_http_a_nest_d = HttpRequest(port_start + 8)
             if not "s_http_a_no_d" in globals():
                 s_http_a_no_d = HttpRequest(port_start + 9)
+            if not "s_tcp_shm" in globals():
+                s_tcp_shm = TcpSocketRequest(port_start + 10)
+            if not "s_tcp_bin" in globals():
+                s_tcp_bin = TcpSocketRequest(port_start + 11)
+            if not "s_http_bin" in globals():
+                s_http_bin = HttpRequest(port_start + 12)
+            if not "s_tcp_comp" in globals():
+                s_tcp_comp = TcpSocketRequest(port_start + 13)
+            if not "s_http_comp" in globals():
+                s_http_comp = HttpRequest(port_start + 14)
+            if not "s_tcp_client" in globals():
+                s_tcp_client = TcpSocketRequest(port_start + 15)
+            if not "s_http_client" in globals():
+                s_http_client = HttpRequest(port_start + 16)
+            if not "s_tcp_instr" in globals():
+                s_tcp_instr = TcpSocketRequest(port_start + 17)
+            if not "s_http_instr" in globals():
+                s_http_instr = HttpRequest(port_start + 18)
+            if not "s_http_metrics" in globals():
+                s_http_metrics = HttpRequest(port_start + 19)
+            if not "s_tcp_metrics" in globals():
+                s_tcp_metrics = TcpSocketRequest(port_start + 20)
+            if not "s_tcp_admin" in globals():
+                s_tcp_admin = TcpSocketRequest(port_start + 22)
+            if not "s_http_admin" in globals():
+                s_http_admin = HttpRequest(port_start + 23)
+            if not "s_http_health" in globals():
+                s_http_health = HttpRequest(port_start + 24)
+            if not "s_http_shed" in globals():
+                s_http_shed = HttpRequest(port_start + 25)
+            if not "s_tcp_shed" in globals():
+                s_tcp_shed = TcpSocketRequest(port_start + 26)
+            if not "s_tcp_deadline" in globals():
+                s_tcp_deadline = TcpSocketRequest(port_start + 27)
+            if not "s_tcp_limits" in globals():
+                s_tcp_limits = TcpSocketRequest(port_start + 28)
+            if not "s_http_limits" in globals():
+                s_http_limits = HttpRequest(port_start + 29)
+            if not "s_tcp_functions" in globals():
+                s_tcp_functions = TcpSocketRequest(port_start + 30)
+            if not "s_http_functions" in globals():
+                s_http_functions = HttpRequest(port_start + 31)
+            if not "s_tcp_lanes" in globals():
+                s_tcp_lanes = TcpSocketRequest(port_start + 32)
+            if not "s_http_lanes" in globals():
+                s_http_lanes = HttpRequest(port_start + 33)
+            if not "s_tcp_rate" in globals():
+                s_tcp_rate = TcpSocketRequest(port_start + 34)
+            if not "s_tcp_warm" in globals():
+                s_tcp_warm = TcpSocketRequest(port_start + 35)
+            if hasattr(socket, "AF_UNIX") and not os.path.exists(unix_path):
+                raise ConnectionRefusedError()
+            if not "s_pipe_a" in globals():
+                s_pipe_a = PipeRequest(pipe_autoformat)
             break
         except (ConnectionRefusedError, requests.exceptions.ConnectionError):
             time.sleep(1)